@@ -0,0 +1,353 @@
+import argparse
+import glob
+import json
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from src.Log import Log
+from src.AnnotationCache import AnnotationCache
+from src.ExtractionPlan import ExtractionPlan
+from src.EnsemblBackend import EnsemblBackend
+from src.VCFReader import VCFReader
+from src.VCFProcessor import VCFProcessor
+
+
+class LegacyExtractor:
+    '''
+    Estrazione come veniva fatta da EnsemblAPI prima di ExtractionPlan, tenuta come riferimento per il confronto
+    '''
+    def __init__(self, path:str = "key.json") -> None:
+        keys = json.load(open(path))
+        self.transcript_consequences_info_column = keys["transcript_consequences"]
+        self.colocated_variants_info_column = keys["colocated_variants"]
+        self.frequencies_key = keys["frequencies_key"]
+
+    def get_transcript_consequences_info(self, transcript_consequences:dict):
+        api_dict = {}
+        for key in self.transcript_consequences_info_column:
+            try:
+                if "count" in key:
+                    api_dict[key] = len(transcript_consequences[key.replace("_count", "")][0])
+                else:
+                    api_dict[key] = transcript_consequences[key]
+            except KeyError:
+                pass
+        return api_dict
+
+    def get_colocated_variants_info(self, colocated_variants:dict):
+        for dictionary in colocated_variants:
+            for key in self.colocated_variants_info_column:
+                if key not in dictionary :
+                    break
+                if isinstance(dictionary, dict):
+                    colocated_variants = dictionary
+
+        api_dict = {}
+        for key in self.colocated_variants_info_column:
+            try:
+                if "count" in key:
+                    api_dict[key] = len(colocated_variants[key.replace("_count", "")])
+                elif key == "frequencies":
+                    alt = list(colocated_variants[key].keys())[0]
+                    for frequencies_key in self.frequencies_key:
+                        api_dict[frequencies_key] = colocated_variants[key][alt][frequencies_key.replace("frequencies_", "")]
+                else:
+                    api_dict[key] = colocated_variants[key]
+            except KeyError:
+                pass
+            except TypeError:
+                try:
+                    if "count" in key:
+                        api_dict[key] = len(colocated_variants[0][key.replace("_count", "")])
+                    elif key == "frequencies":
+                        alt = list(colocated_variants[0][key].keys())[0]
+                        for frequencies_key in self.frequencies_key:
+                            api_dict[frequencies_key] = colocated_variants[0][key][alt][frequencies_key.replace("frequencies_", "")]
+                    else:
+                        api_dict[key] = colocated_variants[0][key]
+                except KeyError:
+                    pass
+        return api_dict
+
+    def get_clean_clin_sig_allele(self, clin_sig_allele, alt):
+        weight = ExtractionPlan.CLIN_SIG_WEIGHT
+        allele_sig = []
+        value = 0
+        for allele in clin_sig_allele.split(";"):
+            if allele[0] == alt[0]:
+                allele_sig.append(allele)
+
+        if len(allele_sig) == 1:
+            value = weight[allele_sig[0].split(":")[1]]
+        elif len(allele_sig) == 0:
+            return None
+
+        for allele in allele_sig:
+            value += weight[allele.split(":")[1]]
+        value /= len(allele_sig)
+
+        if value >= 0.3: return "NEG"
+        elif value <= -0.3: return "POS"
+        else: return "VUS"
+
+    def extract(self, api:dict, alt:str)->dict:
+        api_dict = {}
+        try:
+            api_dict = self.get_transcript_consequences_info(api["transcript_consequences"][0])
+        except KeyError:
+            pass
+        try:
+            api_dict = {**self.get_colocated_variants_info(api["colocated_variants"]), **api_dict}
+        except KeyError:
+            pass
+        if len(api_dict) == 0:
+            return api_dict
+        try:
+            api_dict["clin_sig_allele"] = self.get_clean_clin_sig_allele(api_dict["clin_sig_allele"], alt)
+        except KeyError:
+            pass
+        for key in ["most_severe_consequence", "variant_class"]:
+            try:
+                api_dict["variant_class"] = api[key]
+            except KeyError:
+                pass
+        api_dict["seq_region_name"] = api["seq_region_name"]
+        return api_dict
+
+
+def benchmark_extraction(path_cache:str, limit:int, repeat:int, log:Log):
+    # Confronto tra estrazione per risposta (legacy) e piano compilato su risposte registrate nella cache
+    cache = AnnotationCache(path_cache, log)
+    records = [(key, api) for key, api in cache.items(limit=limit) if api]
+    cache.close()
+    responses = [api for _, api in records]
+    alts = [key.split()[4] for key, _ in records]
+    print(f"Responses: {len(responses)}")
+
+    legacy = LegacyExtractor()
+    plan = ExtractionPlan.from_json("key.json")
+
+    mismatches = sum(1 for api, alt in zip(responses, alts) if legacy.extract(api, alt) != plan.apply_one(api, alt))
+    print(f"Mismatching responses: {mismatches}")
+
+    for name, function in [
+        ("legacy", lambda: [legacy.extract(api, alt) for api, alt in zip(responses, alts)]),
+        ("plan.apply_one", lambda: [plan.apply_one(api, alt) for api, alt in zip(responses, alts)]),
+        ("plan.apply", lambda: plan.apply(responses, alts)),
+    ]:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(f"{name:>16}: {best:.4f} s  ({best / max(len(responses), 1) * 1e6:.2f} us/response)")
+
+
+def benchmark_annotation(path_input:str, path_archive:str, mode:str, serve:bool, latency:float, error_rate:float,
+                         concurrency:int, rate:float, batch:bool, repeat:int, seed:int, log:Log):
+    # Annotazione completa con backend registrato o in replay, ogni ripetizione parte da una cache vuota
+    from src.EnsemblAPI import EnsemblAPI
+    df = pd.read_csv(path_input, dtype=str)[["CHROM", "POS", "REF", "ALT"]]
+    print(f"Rows: {df.shape[0]}, distinct variants: {df.drop_duplicates().shape[0]}")
+
+    for i in range(repeat if mode == "replay" else 1):
+        backend = EnsemblBackend(log, mode=mode, archive_path=path_archive, latency=latency, error_rate=error_rate,
+                                 seed=seed, serve=serve)
+        api = EnsemblAPI(log, concurrency=concurrency, rate=rate, backend=backend)
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            result = api.get_api_info_from_df(df.copy(), path_cache=os.path.join(tmp, "memory.sqlite"), batch=batch,
+                                              checkpoint_dir=os.path.join(tmp, "vep_parts"))
+            elapsed = time.perf_counter() - start
+            api.close()
+        annotated = result["variant_class"].notna().sum() if "variant_class" in result.columns else 0
+        stats = backend.responder.stats if backend.responder is not None else {}
+        print(f"run {i}: {elapsed:.3f} s, annotated rows {annotated}/{result.shape[0]} {stats}")
+
+
+def legacy_read_vcf(vcf_file:str):
+    # Lettura come veniva fatta da VCFProcessor prima di VCFReader: header, allel e ciclo GT riga per riga
+    import allel
+    identifier = None
+    with open(vcf_file, 'r') as f:
+        for line in f:
+            if line.startswith("#CHROM"):
+                identifier = VCFReader.parse_identifier(line.strip().split('\t')[-1], vcf_file)
+                break
+    temp_df = allel.vcf_to_dataframe(vcf_file, fields='*', alt_number=1)
+    with open(vcf_file, 'r') as f:
+        index = 0
+        for line in f.readlines():
+            if not line.startswith("#"):
+                try:
+                    gt = line.split('GT:')[1].split('/')
+                    temp_df.loc[index, "GT"] = f"{gt[0][-1]}/{gt[1][0]}"
+                    index += 1
+                except Exception as e:
+                    temp_df.loc[index, "GT"] = np.nan
+    return identifier, temp_df
+
+
+def write_synthetic_vcf(path:str, lines:int, seed:int):
+    # VCF a campione singolo con INFO simili a quelli dei nostri pannelli
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">\n')
+        f.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n')
+        f.write('##INFO=<ID=GENEINFO,Number=1,Type=String,Description="Gene">\n')
+        f.write('##INFO=<ID=CLINVARPAT,Number=1,Type=String,Description="ClinVar">\n')
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">\n')
+        f.write(f"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tBRCA-{seed}-23_S1\n")
+        pos = 32890000
+        for _ in range(lines):
+            pos += rng.randint(1, 50)
+            ref, alt = rng.choice([("A", "T"), ("G", "C"), ("GA", "G"), ("C", "CT")])
+            gt = rng.choice(["0/1", "1/1", "0/1"])
+            f.write(f"chr13\t{pos}\t.\t{ref}\t{alt}\t{rng.randint(20, 99)}\tPASS\t"
+                    f"AF=0.{rng.randint(1, 99):02d};DP={rng.randint(10, 500)};GENEINFO=BRCA2:675;CLINVARPAT=Benign\t"
+                    f"GT:DP\t{gt}:{rng.randint(10, 500)}\n")
+
+
+def benchmark_vcf(path:str, files:int, lines:int, repeat:int):
+    # Confronto tra lettura legacy (tre passaggi) e VCFReader (un passaggio) sugli stessi file
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is not None:
+            vcf_files = sorted(glob.glob(os.path.join(path, "**", "*.vcf"), recursive=True))
+        else:
+            vcf_files = [os.path.join(tmp, f"BRCA_{i}.vcf") for i in range(files)]
+            for i, vcf_file in enumerate(vcf_files):
+                write_synthetic_vcf(vcf_file, lines, i)
+        print(f"Files: {len(vcf_files)}")
+
+        reader = VCFReader()
+        mismatches = 0
+        for vcf_file in vcf_files:
+            legacy_id, legacy_df = legacy_read_vcf(vcf_file)
+            identifier, df = reader.read(vcf_file)
+            if legacy_id != identifier or not legacy_df.drop(columns="GT").equals(df.drop(columns="GT")):
+                mismatches += 1
+        print(f"Mismatching files: {mismatches}")
+
+        for name, function in [
+            ("legacy", lambda: [legacy_read_vcf(vcf_file) for vcf_file in vcf_files]),
+            ("VCFReader", lambda: [reader.read(vcf_file) for vcf_file in vcf_files]),
+        ]:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function()
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            print(f"{name:>16}: {best:.4f} s  ({best / max(len(vcf_files), 1) * 1e3:.2f} ms/file)")
+
+
+def benchmark_schema(path:str, files:int, lines:int, repeat:int, log:Log):
+    # Memoria e tempi del dataset pulito: schema tipizzato contro tutte le colonne convertite in str come in passato
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is None:
+            os.makedirs(os.path.join(tmp, "SOMATIC"))
+            for i in range(files):
+                write_synthetic_vcf(os.path.join(tmp, "SOMATIC", f"BRCA_{i}.vcf"), lines, i)
+            path = tmp
+        typed = VCFProcessor(log).get_dataframe(path=path, workers=1)
+    frames = {"str": typed.astype(str), "schema": typed}
+    print(f"Rows: {typed.shape[0]}, samples: {typed['NAME'].nunique()}")
+    for name, df in frames.items():
+        print(f"{name:>8}: {df.memory_usage(deep=True).sum() / 2**20:.2f} MiB")
+        for column, size in df.memory_usage(deep=True, index=False).items():
+            print(f"{column:>16}: {size / 2**20:.2f} MiB  {df[column].dtype}")
+
+    for name, df in frames.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            variants = df[["CHROM", "POS", "REF", "ALT"]].drop_duplicates()
+            df.merge(variants, on=["CHROM", "POS", "REF", "ALT"], how="left")
+            timings.append(time.perf_counter() - start)
+        print(f"{name:>8}: drop_duplicates + merge {min(timings):.4f} s")
+
+
+def benchmark_log(calls:int, repeat:int):
+    # Costo per chiamata di write_log e count, su un file temporaneo con sink sincrono e in coda
+    with tempfile.TemporaryDirectory() as tmp:
+        for enqueue in [False, True]:
+            for level in ["DEBUG", "INFO"]:
+                log = Log(dir_path=tmp, level=level, enqueue=enqueue)
+                variant = "13 32890000 . A T . . ."
+                cases = [
+                    ("eager f-string", lambda i: log.write_log(f"Updated variant {variant} {i} to memory", "DEBUG")),
+                    ("lazy lambda", lambda i: log.write_log(lambda: f"Updated variant {variant} {i} to memory", "DEBUG")),
+                    ("count", lambda i: log.count("Updated variants in memory")),
+                ]
+                for name, function in cases:
+                    timings = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        for i in range(calls):
+                            function(i)
+                        timings.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    log.close()
+                    drain = time.perf_counter() - start
+                    log = Log(dir_path=tmp, level=level, enqueue=enqueue)
+                    print(f"enqueue={enqueue!s:>5} level={level:>5} {name:>15}: {min(timings) / calls * 1e6:.2f} us/call (close {drain * 1e3:.0f} ms)")
+                log.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark della pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    extraction = subparsers.add_parser("extraction", help="Estrazione delle risposte VEP: legacy contro ExtractionPlan")
+    extraction.add_argument("--cache", default="memory.sqlite")
+    extraction.add_argument("--limit", type=int, default=None)
+    extraction.add_argument("--repeat", type=int, default=5)
+
+    annotation = subparsers.add_parser("annotation", help="Annotazione VEP con backend registrato (record) o offline (replay)")
+    annotation.add_argument("--input", required=True, help="CSV con le colonne CHROM, POS, REF, ALT")
+    annotation.add_argument("--archive", default="data/ensembl_archive.jsonl.gz")
+    annotation.add_argument("--mode", choices=["record", "replay"], default="replay")
+    annotation.add_argument("--serve", action="store_true", help="Replay da un server su localhost invece che in-process")
+    annotation.add_argument("--latency", type=float, default=0.0)
+    annotation.add_argument("--error-rate", type=float, default=0.0)
+    annotation.add_argument("--concurrency", type=int, default=10)
+    annotation.add_argument("--rate", type=float, default=15)
+    annotation.add_argument("--no-batch", action="store_true")
+    annotation.add_argument("--repeat", type=int, default=3)
+    annotation.add_argument("--seed", type=int, default=0)
+
+    vcf = subparsers.add_parser("vcf", help="Lettura dei VCF: allel + ciclo GT contro VCFReader")
+    vcf.add_argument("--path", default=None, help="Cartella con i VCF, altrimenti vengono generati file sintetici")
+    vcf.add_argument("--files", type=int, default=3)
+    vcf.add_argument("--lines", type=int, default=5000)
+    vcf.add_argument("--repeat", type=int, default=3)
+
+    schema = subparsers.add_parser("schema", help="Memoria del dataset pulito: schema tipizzato contro astype(str)")
+    schema.add_argument("--path", default=None, help="Cartella con i VCF, altrimenti vengono generati file sintetici")
+    schema.add_argument("--files", type=int, default=200)
+    schema.add_argument("--lines", type=int, default=300)
+    schema.add_argument("--repeat", type=int, default=3)
+
+    log_parser = subparsers.add_parser("log", help="Costo per chiamata di Log.write_log e Log.count")
+    log_parser.add_argument("--calls", type=int, default=20000)
+    log_parser.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args()
+    log = Log(save_file=False)
+    if args.benchmark == "extraction":
+        benchmark_extraction(args.cache, args.limit, args.repeat, log)
+    elif args.benchmark == "annotation":
+        benchmark_annotation(args.input, args.archive, args.mode, args.serve, args.latency, args.error_rate,
+                             args.concurrency, args.rate, not args.no_batch, args.repeat, args.seed, log)
+    elif args.benchmark == "vcf":
+        benchmark_vcf(args.path, args.files, args.lines, args.repeat)
+    elif args.benchmark == "log":
+        benchmark_log(args.calls, args.repeat)
+    elif args.benchmark == "schema":
+        benchmark_schema(args.path, args.files, args.lines, args.repeat, log)
@@ -1,36 +1,125 @@
+import argparse
 import warnings
 import time
+import os
 import pandas as pd
 import numpy as np
 from src.Log import Log
-from src.VCFProcessor import VCFProcessor, DataCleaner
+from src.VCFProcessor import VCFProcessor
 from src.EnsemblAPI import EnsemblAPI
+from src.Liftover import Liftover
 from src.MSPUpdater import MSPUpdater
 from src.RisComparator import RisComparator
+from src.ReferenceLoader import ReferenceLoader
+from src.Metrics import Metrics
+from src.Pipeline import Pipeline, Stage
+from src.Sharding import ShardCoordinator, run_local
 
 warnings.filterwarnings('ignore')
 
+STAGES = ["ingestion", "annotation", "msp", "ris", "export"]
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Costruzione del dataset delle varianti")
+    parser.add_argument("--rebuild", action="store_true", help="Rilegge tutti i VCF ignorando la cache di ingestione")
+    parser.add_argument("--dataset", default=None, help="Ingestione in streaming nel dataset Parquet partizionato indicato (es. data/vcf_dataset)")
+    parser.add_argument("--metrics-dir", default="logs/metrics", help="Cartella del report JSON e del file Prometheus del run")
+    parser.add_argument("--profile", action="append", default=[], choices=STAGES, help="Stage da eseguire sotto cProfile (ripetibile)")
+    parser.add_argument("--stage", default=None, choices=STAGES, help="Esegue solo lo stage indicato, gli ingressi vengono letti da --cache-dir")
+    parser.add_argument("--from", dest="start", default=None, choices=STAGES, help="Primo stage da eseguire")
+    parser.add_argument("--to", dest="stop", default=None, choices=STAGES, help="Ultimo stage da eseguire")
+    parser.add_argument("--force", action="store_true", help="Riesegue gli stage selezionati anche se i loro ingressi non sono cambiati")
+    parser.add_argument("--cache-dir", default="data/pipeline", help="Cartella dei risultati intermedi (Parquet) e del manifest degli stage")
+    parser.add_argument("--vcf-dir", default="Data/VCF", help="Cartella dei VCF")
+    parser.add_argument("--workers", type=int, default=None, help="Processi per la lettura dei VCF (default: numero di CPU)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Richieste contemporanee alle API di Ensembl")
+    parser.add_argument("--gmo", default="data/Estrazione GMO 2018-2023.xls", help="Estrazione GMO con nome campione e MSP")
+    parser.add_argument("--brca", default="data/BRCA_completo_nuovo.xlsx", help="Database BRCA")
+    parser.add_argument("--hc", default="data/Database HC.xlsx", help="Database HC")
+    parser.add_argument("--chain", default="data/hg19ToHg38.over.chain.gz", help="Chain file per il liftover locale")
+    parser.add_argument("--output", default="Data/dataset.csv", help="CSV finale")
+    parser.add_argument("--shards", type=int, default=0, help="Annotazione divisa in questo numero di shard (0: un solo processo)")
+    parser.add_argument("--shard-workers", type=int, default=None,
+                        help="Worker locali per gli shard (default: min(shard, CPU); 0: solo worker remoti avviati con shard_worker.py)")
+    parser.add_argument("--coord-dir", default="data/shards", help="Cartella di coordinamento degli shard, condivisa tra le macchine")
+    parser.add_argument("--block-size", type=int, default=None, help="Shard per cromosoma e blocchi di posizioni di questa dimensione invece che per variante")
+    args = parser.parse_args()
+    if args.stage is not None:
+        args.start = args.stop = args.stage
+
     start_program_time = time.time()
     log = Log()
-    processor = VCFProcessor(log)
-    cleaner = DataCleaner(log)
-    api = EnsemblAPI(log)
-    msp = MSPUpdater("data/Estrazione GMO 2018-2023.xls", log)
-    ris = RisComparator("data/BRCA_completo_nuovo.xlsx", "data/Database HC.xlsx", log)
+    metrics = Metrics(log, profile=args.profile)
+    references = ReferenceLoader(log)
+    processor = VCFProcessor(log, cache_dir="data/vcf_cache", metrics=metrics)
+    # EnsemblAPI legge i file di supporto all'avvio: viene creata solo se lo stage di annotazione viene eseguito
+    apis = []
+
+    def ingestion():
+        if args.dataset is not None:
+            processor.write_dataset(args.dataset, path=args.vcf_dir, workers=args.workers, rebuild=args.rebuild)
+            return VCFProcessor.load_dataset(args.dataset)
+        return processor.get_dataframe(path=args.vcf_dir, workers=args.workers, rebuild=args.rebuild)
+
+    def sharded_annotation(df):
+        # Il piano viene sostituito se il dataset è cambiato, gli shard già completati di un run interrotto vengono tenuti
+        # I segmenti degli shard partono dalle voci della cache principale (con il vecchio memory.json importato)
+        coordinator = ShardCoordinator(args.coord_dir, log)
+        coordinator.prepare(df, args.shards, block_size=args.block_size, reset=True)
+        api = EnsemblAPI(log, concurrency=args.concurrency, metrics=metrics)
+        try:
+            cache = api.open_cache("memory.sqlite", "memory.json")
+            coordinator.seed(cache)
+            workers = args.shard_workers if args.shard_workers is not None else min(args.shards, os.cpu_count() or 1)
+            if workers > 0:
+                run_local(args.coord_dir, workers, {"concurrency": args.concurrency, "chain": args.chain})
+            coordinator.wait()
+            df = coordinator.merge(df, cache)
+        finally:
+            api.close()
+        df.to_csv("data/data_vep.csv", index=False)
+        return df
+
+    def annotation(df):
+        if args.shards > 0:
+            return sharded_annotation(df)
+        liftover = Liftover(args.chain, log) if os.path.exists(args.chain) else None
+        apis.append(EnsemblAPI(log, concurrency=args.concurrency, liftover=liftover, metrics=metrics))
+        return apis[-1].get_api_info_from_df(df, path_cache="memory.sqlite", path_json="memory.json")
+
+    def ris(df):
+        df = RisComparator(args.brca, args.hc, log, references).compare_vcf_xlsx(df)
+        return df[df["MSP"].notna() & df["RIS."].notna()]
+
+    def export(df):
+        df.to_csv(args.output, index=False)
+        return df
+
+    pipeline = Pipeline(log, cache_dir=args.cache_dir, metrics=metrics)
+    pipeline.add(Stage("ingestion", ingestion, files=lambda: processor.list_vcf_files(args.vcf_dir),
+                       sources=["src/VCFProcessor.py", "src/VCFReader.py", "src/DuplicatePolicy.py"],
+                       config={"vcf_dir": args.vcf_dir, "dataset": args.dataset}))
+    pipeline.add(Stage("annotation", annotation, inputs=["ingestion"],
+                       files=["key.json", "data/HCS_region_map.bed", "data/GRCh38_genes_MANE_Select.txt"] + ([args.chain] if os.path.exists(args.chain) else []),
+                       sources=["src/EnsemblAPI.py", "src/ExtractionPlan.py", "src/VariantNormalizer.py", "src/GeneIndex.py", "src/Liftover.py"]))
+    pipeline.add(Stage("msp", lambda df: MSPUpdater(args.gmo, log, references).aggiungi_colonna_msp(df), inputs=["annotation"],
+                       files=[args.gmo], sources=["src/MSPUpdater.py", "src/ReferenceLoader.py"]))
+    pipeline.add(Stage("ris", ris, inputs=["msp"], files=[args.brca, args.hc], sources=["src/RisComparator.py", "src/ReferenceLoader.py"]))
+    pipeline.add(Stage("export", export, inputs=["ris"], config={"output": args.output}, outputs=[args.output]))
+
     log.write_log("Starting program", level="INFO")
     try:
-        df = processor.get_dataframe()
-        df = api.get_api_info_from_df(df, path_json="memory.json")
-        df = msp.aggiungi_colonna_msp(df)
-        df = ris.compare_vcf_xlsx(df)
-        df = df[df["MSP"].notna()]
-        df = df[df["RIS."].notna()]
-        df = df[df["RIS."] != "nan"]
-        df.to_csv("Data/dataset.csv", index=False)
+        # --rebuild rilegge i VCF: lo stage di ingestione viene rieseguito anche se i file non sono cambiati
+        force = True if args.force else (["ingestion"] if args.rebuild else [])
+        executed = pipeline.run(args.start, args.stop, force=force)
+        log.write_log(f"Stages executed: {executed}", level="INFO")
         log.write_log("Program finished successfully", level="SUCCESS")
         log.write_log(f"Total time: {time.time() - start_program_time} seconds", level="DEBUG")
     except KeyboardInterrupt:
         log.write_log("Program interrupted by user", level="CRITICAL")
         log.write_log(f"Total time: {time.time() - start_program_time} seconds", level="DEBUG")
-        
+    finally:
+        for api in apis:
+            api.close()
+        metrics.write(args.metrics_dir)
+        log.close()
@@ -0,0 +1,27 @@
+import argparse
+import json
+import socket
+import os
+from src.Log import Log
+from src.Sharding import ShardCoordinator, run_worker, run_local
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker di annotazione a shard: prende shard dalla cartella di coordinamento preparata da main.py --shards")
+    parser.add_argument("coord_dir", help="Cartella di coordinamento condivisa")
+    parser.add_argument("--workers", type=int, default=1, help="Processi worker su questa macchina")
+    parser.add_argument("--concurrency", type=int, default=10, help="Richieste contemporanee alle API di Ensembl per worker")
+    parser.add_argument("--rate", type=float, default=15, help="Richieste al secondo per worker")
+    parser.add_argument("--chain", default="data/hg19ToHg38.over.chain.gz", help="Chain file per il liftover locale")
+    parser.add_argument("--lease", type=float, default=600, help="Secondi dopo i quali il claim di un worker fermo può essere preso da un altro")
+    parser.add_argument("--status", action="store_true", help="Mostra lo stato degli shard ed esce")
+    args = parser.parse_args()
+
+    if args.status:
+        print(json.dumps(ShardCoordinator(args.coord_dir, Log(save_file=False)).status()))
+    else:
+        options = {"concurrency": args.concurrency, "rate": args.rate, "chain": args.chain, "lease": args.lease}
+        if args.workers > 1:
+            completed = run_local(args.coord_dir, args.workers, options)
+        else:
+            completed = run_worker(args.coord_dir, f"{socket.gethostname()}-{os.getpid()}", options)
+        print(f"Completed {completed} shards")
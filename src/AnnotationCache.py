@@ -0,0 +1,191 @@
+import sqlite3, zlib, json, os, time
+from src.Log import Log
+
+try:
+    # Decoder JSON più veloce, se installato
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class AnnotationCache:
+    '''
+    Cache persistente delle risposte VEP indicizzata per variante.
+    Ogni risposta viene salvata compressa insieme alla release di Ensembl che l'ha prodotta,
+    le scritture vengono accumulate e salvate in blocchi da batch_size.
+    L'ultima release vista è salvata nella tabella meta: le voci di un'altra release vengono rimosse una sola volta,
+    quando set_release riceve una release nota diversa. Le voci con release NULL (release mai letta) non sono mai considerate vecchie.
+    '''
+    # Numero massimo di parametri per query SQLite
+    MAX_VARIABLES = 900
+
+    def __init__(self, path:str, log:Log, release:str = None, batch_size:int = 500) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.__log = log
+        self.__pending = {}
+        self.__connection = sqlite3.connect(path)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS variants (key TEXT PRIMARY KEY, release TEXT, data BLOB) WITHOUT ROWID")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.__connection.commit()
+        # Senza release la cache usa l'ultima vista, anche per le nuove voci
+        self.release = self.__meta("release")
+        if release is not None:
+            self.set_release(release)
+
+    def __meta(self, name:str)->str:
+        row = self.__connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __set_meta(self, name:str, value:str):
+        self.__connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    @staticmethod
+    def __encode(value:dict)->bytes:
+        return zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+
+    @staticmethod
+    def __decode(data:bytes)->dict:
+        if orjson is not None:
+            return orjson.loads(zlib.decompress(data))
+        return json.loads(zlib.decompress(data))
+
+    def __is_valid(self, release:str)->bool:
+        # Le voci prodotte da un'altra release nota di Ensembl sono considerate assenti
+        return self.release is None or release is None or release == self.release
+
+    def get(self, key:str)->dict:
+        if key in self.__pending:
+            return self.__pending[key]
+        row = self.__connection.execute("SELECT release, data FROM variants WHERE key = ?", (key,)).fetchone()
+        if row is None or not self.__is_valid(row[0]):
+            return None
+        return self.__decode(row[1])
+
+    def get_many(self, keys:list)->dict:
+        result = {}
+        keys = list(keys)
+        for i in range(0, len(keys), self.MAX_VARIABLES):
+            chunk = keys[i:i + self.MAX_VARIABLES]
+            query = f"SELECT key, release, data FROM variants WHERE key IN ({','.join('?' * len(chunk))})"
+            for key, release, data in self.__connection.execute(query, chunk):
+                if self.__is_valid(release):
+                    result[key] = self.__decode(data)
+        for key in keys:
+            if key in self.__pending:
+                result[key] = self.__pending[key]
+        return result
+
+    def items(self, limit:int = None):
+        # Iterazione sulle voci valide della cache
+        self.flush()
+        query = "SELECT key, release, data FROM variants" + (f" LIMIT {int(limit)}" if limit is not None else "")
+        for key, release, data in self.__connection.execute(query):
+            if self.__is_valid(release):
+                yield key, self.__decode(data)
+
+    def __contains__(self, key:str)->bool:
+        return self.get(key) is not None
+
+    def put(self, key:str, value:dict):
+        self.__pending[key] = value
+        if len(self.__pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.__pending) == 0:
+            return
+        self.__connection.executemany(
+            "INSERT OR REPLACE INTO variants (key, release, data) VALUES (?, ?, ?)",
+            [(key, self.release, self.__encode(value)) for key, value in self.__pending.items()]
+        )
+        self.__connection.commit()
+        self.__pending = {}
+
+    def release_checked(self)->float:
+        # Istante (epoch) dell'ultima lettura riuscita della release, None se mai letta
+        checked = self.__meta("release_checked")
+        return float(checked) if checked is not None else None
+
+    def set_release(self, release:str)->int:
+        '''
+        Release corrente di Ensembl. Se è nota e diversa dall'ultima vista vengono rimosse le voci di altre release note.
+        Con release None (release non letta) la cache resta com'è. Ritorna il numero di voci rimosse
+        '''
+        if release is None:
+            return 0
+        self.flush()
+        deleted = 0
+        if release != self.release:
+            deleted = self.__connection.execute("DELETE FROM variants WHERE release IS NOT NULL AND release != ?", (release,)).rowcount
+            if deleted > 0:
+                self.__log.write_log(f"Removed {deleted} variants annotated with an old Ensembl release", "INFO")
+            self.__set_meta("release", release)
+            self.release = release
+        self.__set_meta("release_checked", str(time.time()))
+        self.__connection.commit()
+        return deleted
+
+    def import_json(self, path_json:str)->int:
+        '''
+        Importazione una tantum di un vecchio memory.json.
+        Le voci importate prendono la release corrente (NULL se mai letta) e vengono rimosse come le altre quando la release cambia
+        '''
+        if not os.path.exists(path_json):
+            return 0
+        if self.__meta(f"import:{os.path.abspath(path_json)}") is not None:
+            return 0
+
+        memory = json.load(open(path_json, "r"))
+        self.flush()
+        self.__connection.executemany(
+            "INSERT OR IGNORE INTO variants (key, release, data) VALUES (?, ?, ?)",
+            [(key, self.release, self.__encode(value)) for key, value in memory.items()]
+        )
+        self.__set_meta(f"import:{os.path.abspath(path_json)}", str(len(memory)))
+        self.__connection.commit()
+        self.__log.write_log(f"Imported {len(memory)} variants from {path_json} into {self.path}", "INFO")
+        return len(memory)
+
+    def merge_from(self, path:str)->int:
+        '''
+        Copia delle voci di un'altra cache (es. il segmento di uno shard), che sostituiscono quelle con la stessa chiave
+        '''
+        self.flush()
+        self.__connection.execute("ATTACH DATABASE ? AS segment", (path,))
+        try:
+            copied = self.__connection.execute("INSERT OR REPLACE INTO variants (key, release, data) SELECT key, release, data FROM segment.variants").rowcount
+            self.__connection.commit()
+        finally:
+            self.__connection.execute("DETACH DATABASE segment")
+        return copied
+
+    def copy_to(self, path:str, keys:list)->int:
+        '''
+        Copia delle voci valide con chiave in keys in un'altra cache (es. il segmento di uno shard) con la loro release.
+        Le voci già presenti nella destinazione vengono tenute
+        '''
+        self.flush()
+        target = AnnotationCache(path, self.__log)
+        copied = 0
+        try:
+            keys = list(keys)
+            for i in range(0, len(keys), self.MAX_VARIABLES):
+                chunk = keys[i:i + self.MAX_VARIABLES]
+                query = f"SELECT key, release, data FROM variants WHERE key IN ({','.join('?' * len(chunk))})"
+                rows = [row for row in self.__connection.execute(query, chunk) if self.__is_valid(row[1])]
+                copied += target.__connection.executemany("INSERT OR IGNORE INTO variants (key, release, data) VALUES (?, ?, ?)", rows).rowcount
+            target.__connection.commit()
+        finally:
+            target.close()
+        return copied
+
+    def __len__(self)->int:
+        self.flush()
+        return self.__connection.execute("SELECT COUNT(*) FROM variants").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.__connection.close()
@@ -0,0 +1,183 @@
+import asyncio, random, time
+import httpx
+from src.Log import Log
+
+
+class TokenBucket:
+    '''
+    Token bucket condiviso tra le richieste in volo.
+    Il rate viene adattato agli header X-RateLimit-* restituiti dal server
+    e sospeso completamente quando arriva un Retry-After.
+    '''
+    def __init__(self, rate:float, capacity:float = None, min_rate:float = 0.5):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity if capacity is not None else rate
+        self.__tokens = self.capacity
+        self.__last = time.monotonic()
+        self.__paused_until = 0.0
+        self.__lock = asyncio.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    async def acquire(self):
+        async with self.__lock:
+            while True:
+                wait = self.__paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self.__refill()
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.__tokens) / self.rate)
+
+    def pause(self, seconds:float):
+        # Retry-After: nessuna richiesta parte prima della scadenza
+        self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+        self.__tokens = 0
+
+    def update(self, headers:httpx.Headers):
+        # Distribuisce le richieste rimanenti sul tempo che manca al reset della finestra
+        try:
+            remaining = float(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        rate = remaining / max(reset, 1.0)
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+
+
+class AsyncRequester:
+    '''
+    Motore asincrono per le chiamate REST di Ensembl.
+    Event loop, httpx.AsyncClient (pool di connessioni limitato), semaforo e TokenBucket vengono creati alla prima chiamata
+    e condivisi da tutte le chiamate di run fino a close: anche le richieste singole riusano le connessioni aperte
+    e rispettano i Retry-After e gli X-RateLimit ricevuti in precedenza.
+    '''
+    def __init__(self, log:Log, base_url:str = "https://rest.ensembl.org", headers:dict = None,
+                 concurrency:int = 10, rate:float = 15, max_retries:int = 5,
+                 backoff:float = 0.5, max_backoff:float = 30, timeout:float = 120,
+                 transport:httpx.AsyncBaseTransport = None, on_response = None, metrics = None) -> None:
+        self.__log = log
+        self.base_url = base_url.rstrip("/")
+        self.headers = headers if headers is not None else {}
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.transport = transport
+        # Callback (method, path, payload, status, body) per le risposte definitive, usata per la registrazione
+        self.on_response = on_response
+        # Metrics opzionale: chiamate HTTP, retry, errori e byte ricevuti
+        self.__metrics = metrics
+        self.__loop = None
+        self.__client = None
+        self.__semaphore = None
+        self.__bucket = None
+
+    def __backoff_time(self, try_count:int)->float:
+        # Backoff esponenziale con full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** try_count))
+
+    async def __request(self, client:httpx.AsyncClient, semaphore:asyncio.Semaphore, bucket:TokenBucket,
+                        method:str, path:str, payload:dict = None):
+        try_count = 0
+        while try_count < self.max_retries:
+            try_count += 1
+            if self.__metrics is not None:
+                self.__metrics.inc("http_requests")
+                if try_count > 1:
+                    self.__metrics.inc("http_retries")
+            async with semaphore:
+                await bucket.acquire()
+                try:
+                    r = await client.request(method, path, json=payload)
+                except httpx.HTTPError as e: # Errore nella chiamata
+                    self.__log.write_log(f"Could not connect to Ensembl API: {e}. Try: {try_count}", "ERROR")
+                    await asyncio.sleep(self.__backoff_time(try_count))
+                    continue
+
+            bucket.update(r.headers)
+            if self.__metrics is not None:
+                self.__metrics.inc("http_bytes_received", len(r.content))
+                if r.status_code != 200:
+                    self.__metrics.inc("http_errors")
+            if r.status_code == 200:
+                try:
+                    body = r.json()
+                except ValueError as e:
+                    # 200 con un corpo non JSON (es. pagina HTML di un proxy): ritentata come un errore del server
+                    self.__log.write_log(f"Invalid JSON from Ensembl API: {e}. Try: {try_count}", "ERROR")
+                    if self.__metrics is not None:
+                        self.__metrics.inc("http_errors")
+                    await asyncio.sleep(self.__backoff_time(try_count))
+                    continue
+                if self.on_response is not None:
+                    self.on_response(method, path, payload, r.status_code, body)
+                return body
+            if r.status_code == 400: # Bad Request
+                self.__log.write_log(f"Could not connect to Ensembl API: {r.status_code}. Try: {try_count}", "ERROR")
+                if self.on_response is not None:
+                    self.on_response(method, path, payload, r.status_code, None)
+                return None
+
+            self.__log.write_log(f"Could not connect to Ensembl API: {r.status_code}. Try: {try_count}", "ERROR")
+            retry_after = r.headers.get("Retry-After")
+            if retry_after is not None:
+                try:
+                    bucket.pause(float(retry_after))
+                    continue
+                except ValueError:
+                    pass
+            await asyncio.sleep(self.__backoff_time(try_count))
+        return None
+
+    async def __run(self, requests:list)->list:
+        # Client, semaforo e bucket vengono creati dentro il loop del requester, che resta lo stesso fino a close
+        if self.__client is None:
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self.__client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, limits=limits,
+                                              timeout=self.timeout, transport=self.transport)
+            self.__semaphore = asyncio.Semaphore(self.concurrency)
+            self.__bucket = TokenBucket(self.rate)
+        return await asyncio.gather(*[
+            self.__request(self.__client, self.__semaphore, self.__bucket, method, path, payload)
+            for method, path, payload in requests
+        ])
+
+    def run(self, requests:list)->list:
+        '''
+        Esegue le richieste in parallelo e ritorna le risposte JSON nello stesso ordine.
+        requests: lista di tuple (method, path, payload), le richieste fallite ritornano None
+        '''
+        if len(requests) == 0:
+            return []
+        if self.__loop is None:
+            self.__loop = asyncio.new_event_loop()
+        return self.__loop.run_until_complete(self.__run(requests))
+
+    def get(self, path:str):
+        return self.run([("GET", path, None)])[0]
+
+    def post(self, path:str, payload:dict):
+        return self.run([("POST", path, payload)])[0]
+
+    def close(self):
+        # Chiusura delle connessioni e del loop, una chiamata successiva a run ne apre di nuovi
+        if self.__loop is None:
+            return
+        if self.__client is not None:
+            self.__loop.run_until_complete(self.__client.aclose())
+        self.__loop.close()
+        self.__loop = None
+        self.__client = None
+        self.__semaphore = None
+        self.__bucket = None
@@ -0,0 +1,153 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+
+class HyperLogLog:
+    '''
+    Stima del numero di valori distinti con 2^precision registri (errore standard circa 1.04 / sqrt(2^precision)).
+    I valori arrivano già come hash a 64 bit (pd.util.hash_pandas_object), l'aggiornamento è vettoriale
+    '''
+    def __init__(self, precision:int = 14) -> None:
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, hashes:np.ndarray):
+        hashes = hashes.astype(np.uint64)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        # Posizione del primo bit a 1 nei 64 - precision bit rimanenti
+        bit_length = np.zeros(len(rest), dtype=np.int64)
+        nonzero = rest > 0
+        bit_length[nonzero] = np.frexp(rest[nonzero].astype(np.float64))[1]
+        rank = (64 - self.precision) - bit_length + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def estimate(self)->int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Correzione per i piccoli numeri: linear counting
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class DatasetProfiler:
+    '''
+    Profilo di un dataset letto a chunk: righe, valori nulli, valori distinti e top-k per colonna.
+    Ogni chunk viene letto una sola volta con un value_counts per colonna.
+    Finché una colonna ha al più exact_limit valori distinti i conteggi sono esatti,
+    oltre si passa a HyperLogLog per i distinti e a un riassunto Misra-Gries (capacità 10 * top_k) per i valori frequenti,
+    così la memoria non dipende dalla cardinalità (POS, hgvsc). Il risultato è un JSON piccolo e stabile, confrontabile tra run.
+    '''
+    def __init__(self, top_k:int = 10, exact_limit:int = 10000, precision:int = 14) -> None:
+        self.top_k = top_k
+        self.exact_limit = exact_limit
+        self.precision = precision
+        self.capacity = 10 * top_k
+        self.rows = 0
+        self.columns = {}
+
+    def __column(self, name:str, dtype)->dict:
+        if name not in self.columns:
+            self.columns[name] = {"dtype": str(dtype), "nulls": 0, "rows": 0, "counts": pd.Series(dtype=np.int64),
+                                  "hll": None, "min": None, "max": None}
+        return self.columns[name]
+
+    def __to_sketch(self, column:dict):
+        # Passaggio ai riassunti approssimati: i conteggi esatti diventano il primo riassunto Misra-Gries
+        column["hll"] = HyperLogLog(self.precision)
+        column["hll"].update(pd.util.hash_pandas_object(column["counts"].index.to_series(), index=False).to_numpy())
+        column["counts"] = self.__trim(column["counts"])
+
+    def __trim(self, counts:pd.Series)->pd.Series:
+        # Misra-Gries con pesi: oltre capacity valori si sottrae il conteggio del (capacity + 1)-esimo a tutti
+        if len(counts) <= self.capacity:
+            return counts
+        threshold = counts.nlargest(self.capacity + 1).iloc[-1]
+        counts = counts - threshold
+        return counts[counts > 0]
+
+    def update(self, chunk:pd.DataFrame):
+        self.rows += chunk.shape[0]
+        for name in chunk.columns:
+            values = chunk[name]
+            column = self.__column(name, values.dtype)
+            column["rows"] += values.shape[0]
+            counts = values.value_counts(dropna=True, sort=False)
+            counts = counts[counts > 0]
+            if isinstance(counts.index, pd.CategoricalIndex):
+                counts.index = counts.index.astype(object)
+            column["nulls"] += values.shape[0] - int(counts.sum())
+            if len(counts) > 0 and pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+                low, high = counts.index.min(), counts.index.max()
+                column["min"] = low if column["min"] is None else min(column["min"], low)
+                column["max"] = high if column["max"] is None else max(column["max"], high)
+
+            if column["hll"] is None:
+                column["counts"] = column["counts"].add(counts, fill_value=0).astype(np.int64)
+                if len(column["counts"]) > self.exact_limit:
+                    self.__to_sketch(column)
+            else:
+                column["hll"].update(pd.util.hash_pandas_object(counts.index.to_series(), index=False).to_numpy())
+                column["counts"] = self.__trim(column["counts"].add(counts, fill_value=0).astype(np.int64))
+        return self
+
+    @staticmethod
+    def __plain(value):
+        # Valori numpy in tipi JSON
+        return value.item() if isinstance(value, np.generic) else value
+
+    def result(self)->dict:
+        columns = {}
+        for name, column in self.columns.items():
+            exact = column["hll"] is None
+            top = column["counts"].sort_values(ascending=False, kind="stable").head(self.top_k)
+            rows = max(column["rows"], 1)
+            columns[name] = {
+                "dtype": column["dtype"],
+                "nulls": column["nulls"],
+                "null_rate": round(column["nulls"] / rows, 6),
+                "distinct": len(column["counts"]) if exact else column["hll"].estimate(),
+                "exact": exact,
+                # Per i riassunti approssimati i conteggi sono limiti inferiori (errore al più rows / capacity)
+                "top": [[str(value), int(count), round(count / rows, 6)] for value, count in top.items()],
+            }
+            if column["min"] is not None:
+                columns[name]["min"] = self.__plain(column["min"])
+                columns[name]["max"] = self.__plain(column["max"])
+        return {"rows": self.rows, "columns": columns}
+
+    def write(self, path:str)->dict:
+        # Chiavi ordinate e una riga per colonna: il file resta piccolo e un diff tra due run mostra solo le colonne cambiate
+        result = self.result()
+        lines = [f"  {json.dumps(name)}: {json.dumps(column, sort_keys=True, default=str)}" for name, column in sorted(result["columns"].items())]
+        with open(path, "w") as f:
+            f.write(f'{{"rows": {result["rows"]}, "columns": {{\n' + ",\n".join(lines) + "\n}}\n")
+        return result
+
+    @classmethod
+    def profile_frame(cls, df:pd.DataFrame, chunk_size:int = 100000, **kwargs)->"DatasetProfiler":
+        profiler = cls(**kwargs)
+        for start in range(0, df.shape[0], chunk_size):
+            profiler.update(df.iloc[start:start + chunk_size])
+        return profiler
+
+    @classmethod
+    def profile_csv(cls, path:str, chunk_size:int = 100000, **kwargs)->"DatasetProfiler":
+        profiler = cls(**kwargs)
+        for chunk in pd.read_csv(path, chunksize=chunk_size, low_memory=False):
+            profiler.update(chunk)
+        return profiler
+
+    @classmethod
+    def profile_parquet(cls, path:str, batch_size:int = 100000, **kwargs)->"DatasetProfiler":
+        # File Parquet o dataset partizionato (es. VCFProcessor.write_dataset), letto un batch alla volta
+        profiler = cls(**kwargs)
+        dataset = ds.dataset(path, format="parquet", partitioning=ds.partitioning(flavor="hive"))
+        for batch in dataset.to_batches(batch_size=batch_size):
+            profiler.update(batch.to_pandas())
+        return profiler
@@ -0,0 +1,49 @@
+import os
+from abc import ABC, abstractmethod
+
+
+class DuplicatePolicy(ABC):
+    '''
+    Scelta del VCF da usare tra più file con lo stesso identificativo di campione.
+    I candidati arrivano nell'ordine dei file come dict con path, identifier, records, mtime e order;
+    i file senza record (vuoti o campioni esclusi) vengono scelti solo se nessun altro ne ha.
+    A parità vince il primo file, così la scelta è deterministica.
+    '''
+    def choose(self, candidates:list)->dict:
+        usable = [candidate for candidate in candidates if candidate["records"] > 0]
+        return self.select(usable if len(usable) > 0 else candidates)
+
+    @abstractmethod
+    def select(self, candidates:list)->dict:
+        # Scelta tra candidati tutti utilizzabili (o tutti senza record)
+        ...
+
+
+class MostRecordsPolicy(DuplicatePolicy):
+    # Il file con più record
+    def select(self, candidates:list)->dict:
+        return max(candidates, key=lambda candidate: candidate["records"])
+
+
+class NewestFilePolicy(DuplicatePolicy):
+    # Il file modificato più di recente
+    def select(self, candidates:list)->dict:
+        return max(candidates, key=lambda candidate: candidate["mtime"])
+
+
+class PreferredFolderPolicy(DuplicatePolicy):
+    '''
+    I file nelle cartelle indicate, in ordine di preferenza (es. ["GERMLINE", "HC"]),
+    tra quelli della cartella migliore decide fallback (default MostRecordsPolicy)
+    '''
+    def __init__(self, folders:list, fallback:DuplicatePolicy = None) -> None:
+        self.folders = [folder.upper() for folder in folders]
+        self.fallback = fallback if fallback is not None else MostRecordsPolicy()
+
+    def __rank(self, candidate:dict)->int:
+        folder = os.path.basename(os.path.dirname(candidate["path"])).upper()
+        return self.folders.index(folder) if folder in self.folders else len(self.folders)
+
+    def select(self, candidates:list)->dict:
+        best = min(self.__rank(candidate) for candidate in candidates)
+        return self.fallback.select([candidate for candidate in candidates if self.__rank(candidate) == best])
@@ -1,14 +1,35 @@
-import httpx, urllib, json, os
+import os, glob, time
 import pandas as pd
 from tqdm import tqdm
 from src.Log import Log
+from src.AsyncRequester import AsyncRequester
+from src.EnsemblBackend import EnsemblBackend
+from src.AnnotationCache import AnnotationCache
+from src.Liftover import Liftover
+from src.GeneIndex import GeneIndex
+from src.ExtractionPlan import ExtractionPlan
+from src.VariantNormalizer import VariantNormalizer
+from src.utils import arrow_compatible, from_arrow
 import numpy as np
 
 class EnsemblAPI:
-    def __init__(self, log:Log) -> None:
+    # Parametri comuni alle chiamate VEP (GET singola e POST batch)
+    VEP_PARAMS = "mane=1&LoF=1&dbNSFP=ALL&variant_class=1&Geno2MP=1&domains=1&dbscSNV=1&hgvs=1"
+    # Cache delle risposte usata se open_cache non è stato chiamato
+    DEFAULT_CACHE = "memory.sqlite"
+    # Secondi tra due letture della release di Ensembl per la stessa cache
+    RELEASE_CHECK_INTERVAL = 24 * 3600
+    # Numero massimo di varianti accettate dall'endpoint POST /vep/human/region
+    VEP_BATCH_SIZE = 200
+
+    def __init__(self, log:Log, server:str = "https://rest.ensembl.org", concurrency:int = 10, rate:float = 15,
+                 liftover:Liftover = None, remote_liftover:bool = True, backend:EnsemblBackend = None, metrics = None) -> None:
         self.__log = log
+        self.__metrics = metrics
+        # Liftover locale da chain file, /map di Ensembl solo per le posizioni non mappate
+        self.__liftover = liftover
+        self.__remote_liftover = remote_liftover
         self.__headers = {
-            "Host": "rest.ensembl.org",
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:42.0) Gecko/20100101 Firefox/42.0",
             "Accept": "application/json, text/javascript, */*; q=0.01",
             "Accept-Language": "en-US,en;q=0.5",
@@ -16,415 +37,358 @@ class EnsemblAPI:
             "Origin": "http://asia.ensembl.org",
             "Connection": "keep-alive",
         }
+        # Backend delle chiamate: live, registrazione o replay da archivio
+        self.__backend = backend if backend is not None else EnsemblBackend(log)
+        self.__requester = AsyncRequester(log, base_url=self.__backend.server_url(server), headers=self.__headers,
+                                          concurrency=concurrency, rate=rate,
+                                          transport=self.__backend.transport, on_response=self.__backend.on_response,
+                                          metrics=metrics)
         
-        # GeneInfo DataFrame
-        self.__geneinfo_df = pd.read_csv("data/HCS_region_map.bed", sep="\t", comment="t", header=None)
-        header = ["chrom", "chromStart", "chromEnd", "Exon", "GENEINFO"]
-        self.__geneinfo_df.columns = header[:len(self.__geneinfo_df.columns)]
-        # Raggruppamento per geneinfo prendendo il minimo dello start e il massimo dello stop
-        self.__geneinfo_df = self.__geneinfo_df.groupby("GENEINFO").agg({"chrom": "mean", "chromStart": "min", "chromEnd": "max"})
-        self.__geneinfo_df.reset_index(inplace=True)
+        # Indice delle regioni per la ricerca delle GENEINFO
+        self.__gene_index = GeneIndex("data/HCS_region_map.bed", log)
         
-        # DataFrame dei identificativi dei geni
-        self.__transcript_id_df = pd.read_csv("data/GRCh38_genes_MANE_Select.txt", sep="\t", comment="t", header=None)
+        # Identificativi dei transcript MANE per gene
+        transcript_id_df = pd.read_csv("data/GRCh38_genes_MANE_Select.txt", sep="\t", comment="t", header=None)
         header = ["Gene", "ENST", "NM"]
-        self.__transcript_id_df.columns = header[:len(self.__geneinfo_df.columns)]
+        transcript_id_df.columns = header[:len(transcript_id_df.columns)]
+        transcript_id_df = transcript_id_df.drop_duplicates(subset="Gene")
+        self.__transcript_ids = dict(zip(transcript_id_df["Gene"], transcript_id_df["ENST"].str.split(".").str[0]))
         
-        self.__memory = {}
+        self.__cache = None
         
-        # Chiavi delle api dentro transcript_consequence
-        self.__transcript_consequences_info_column = json.load(open("key.json"))["transcript_consequences"]
+        # Piano di estrazione delle chiavi di transcript_consequences e colocated_variants
+        self.__plan = ExtractionPlan.from_json("key.json")
         
-        # Chiavi delle api dentro colocated_variants
-        self.__colocated_variants_info_column = json.load(open("key.json"))["colocated_variants"]
+        # Notazioni delle varianti per le API
+        self.__normalizer = VariantNormalizer(log)
+    
+    def __get_transcript_ids(self, chrom:pd.Series, pos:pd.Series)->pd.Series:
+        # Assegnazione vettoriale di GENEINFO e transcript MANE
+        genes = self.__gene_index.annotate(chrom, pos)["GENEINFO"]
+        return genes.map(self.__transcript_ids)
+       
+    def __grch37_to_grch38(self, r:dict):
+        # r: risposta di /map/human/GRCh37/{chrom}:{pos}..{pos}:1/GRCh38
+        if r == None or len(r.get("mappings", [])) == 0:
+            return None
         
-        self.__frequencies_key = json.load(open("key.json"))["frequencies_key"]
+        mapped = r["mappings"][0]["mapped"]
+        return (str(mapped["seq_region_name"]), mapped["start"], mapped["strand"])
     
-    def __request_data(self, url:str)->dict:
-        try_count = 0
-        while True:
-            try_count += 1
-            try:
-                if try_count > 5: return None
-                r = httpx.get(url, headers=self.__headers)
-                if r.status_code != 200 and r.status_code != 400: # Random error
-                    self.__log.write_log(f"Could not connect to Ensembl API: {r.status_code}. Try: {try_count}", "ERROR")
-                    continue
-                elif r.status_code == 400: # Bad Request
-                    self.__log.write_log(f"Could not connect to Ensembl API: {r.status_code}. Try: {try_count}", "ERROR")
-                    return None
-                return r.json()
-            except Exception as e: # Errore nella chiamata
-                self.__log.write_log(f"Could not connect to Ensembl API: {e}", "ERROR")
-            
+    def get_release(self):
+        # Release corrente di Ensembl, usata per invalidare la cache
+        r = self.__requester.get("/info/software")
+        if not isinstance(r, dict) or "release" not in r:
+            self.__log.write_log("Could not read the Ensembl release, cache entries will not be invalidated", "WARNING")
+            return None
+        return str(r["release"])
     
-    def __get_variant_type(self, variant):
-        '''
-        Simple heuristics to get the variant type
-
-        1 182712 182712 A/C 1  --> 1:182712-182712:1/C
-        3 319781 319781 A/- 1  --> 3:319781-319781:1/-
-        19 110748 110747 -/T 1 --> 19:110748-110747:1/T
-        1 160283 471362 DUP 1 --> 1:160283-471362:1/DUP
-        1 1385015 1387562 DEL 1 --> 1:1385015-1387562:1/DEL  
-
-        1 182712 . A C . . . --> 1:182712-182712:1/C
-        3 319780 . GA G . . . --> 3:319781-319781:1/- 
-        3 319780 . GAA G . . . --> 3:319781-319782:1/- 
-        19 110747 . G GT . . . --> 9:110748-110747:1/T 
-        19 110747 . G GTT . . . --> 19:110748-110747:1/TT 
-        1 160283 sv1 . <DUP> . . SVTYPE=DUP;END=471362 . --> UNABLE TO GENERATE PREVIEW!
-        1 1385015 sv2 . <DEL> . . SVTYPE=DEL;END=1387562 . --> UNABLE TO GENERATE PREVIEW!
-        '''
-
-        new_variant = variant
-        variant_splitted = variant.split()
-        if len(variant_splitted) == 5:
-            # Ensembl default
-
-            ref_alt = variant_splitted[3].split('/')
-            if len(ref_alt) == 2:
-                if ref_alt[1] == '-':
-                    new_variant = ''.join([
-                        variant_splitted[0], 
-                        ':', 
-                        variant_splitted[1], 
-                        '-', 
-                        variant_splitted[2],
-                        ':',
-                        variant_splitted[4],
-                        '/',
-                        '-',
-                        ])
-                else:
-                    new_variant = ''.join([
-                        variant_splitted[0], 
-                        ':', 
-                        variant_splitted[1], 
-                        '-', 
-                        variant_splitted[2],
-                        ':',
-                        variant_splitted[4],
-                        '/',
-                        ref_alt[1],
-                        ])
-            elif variant_splitted[3] in ['DUP', 'DEL']:
-                new_variant = ''.join([
-                    variant_splitted[0], 
-                    ':', 
-                    variant_splitted[1], 
-                    '-', 
-                    variant_splitted[2],
-                    ':',
-                    variant_splitted[4],
-                    '/',
-                    variant_splitted[3],
-                    ])
-            else:
-                self.__log.write_log(f"Impossibile riconoscere questa variante {variant}", "ERROR")
-
-            return 'region', new_variant
+    def open_cache(self, path_cache:str, path_json:str = None):
+        # Apertura della cache e importazione di un eventuale memory.json
+        if self.__cache is not None and self.__cache.path == path_cache:
+            return self.__cache
+        if self.__cache is not None:
+            self.__cache.close()
+        # La release viene letta dal server al più una volta ogni RELEASE_CHECK_INTERVAL secondi, l'avvio resta senza chiamate
+        self.__cache = AnnotationCache(path_cache, self.__log)
+        checked = self.__cache.release_checked()
+        if checked is None or time.time() - checked > self.RELEASE_CHECK_INTERVAL:
+            self.__cache.set_release(self.get_release())
+        if path_json is not None:
+            self.__cache.import_json(path_json)
+        return self.__cache
 
-        if len(variant_splitted) == 8:
-            if len(variant_splitted[3]) == 1 and len(variant_splitted[4]) == 1:
-                #Simple SNP
-                new_variant = ''.join([
-                    variant_splitted[0],
-                    ':',
-                    variant_splitted[1],
-                    '-',
-                    variant_splitted[1],
-                    ':',
-                    '1', # Not sure what this is..
-                    '/',
-                    variant_splitted[4],
-                    ])
-            elif len(variant_splitted[3]) > len(variant_splitted[4]):
-                # Deletion
-                new_variant = ''.join([
-                    variant_splitted[0],
-                    ':',
-                    str(int(variant_splitted[1]) + len(variant_splitted[4])),
-                    '-',
-                    str(int(variant_splitted[1]) + len(variant_splitted[3]) - len(variant_splitted[4])),
-                    ':',
-                    '1', # Not sure what this is..
-                    '/',
-                    '-',
-                    ])
-            elif len(variant_splitted[3]) < len(variant_splitted[4]):
-                # Insertion
-                # 19 110747 . G GT . . . --> 9:110748-110747:1/T 
-                # 19 110747 . G GTT . . . --> 19:110748-110747:1/TT 
-                new_variant = ''.join([
-                    variant_splitted[0],
-                    ':',
-                    str(int(variant_splitted[1]) + len(variant_splitted[3])),
-                    '-',
-                    variant_splitted[1],
-                    ':',
-                    '1', # Not sure what this is..
-                    '/',
-                    variant_splitted[4][len(variant_splitted[3]):],
-                    ])
-            else:
-                self.__log.write_log(f"Impossibile riconoscere questa variante {variant}", "ERROR")
+    def __memory(self)->AnnotationCache:
+        # Cache aperta alla prima chiamata che ne ha bisogno (es. get_api_info senza open_cache), sul percorso di default
+        if self.__cache is None:
+            self.open_cache(self.DEFAULT_CACHE)
+        return self.__cache
 
-            return 'region', new_variant
+    def close(self):
+        # Chiusura della cache, delle connessioni e del backend (salvataggio dell'archivio registrato)
+        if self.__cache is not None:
+            self.__cache.close()
+            self.__cache = None
+        self.__requester.close()
+        self.__backend.close()
 
-        if variant[0:2] == 'rs':
-            # Variant identifier
-            return 'id', new_variant
-
-        if ':' in variant:
-            # HGVS notation 
-            return 'hgvs', new_variant
-
-        if len(variant_splitted) > 1:
-            self.__log.write_log(f"Impossibile riconoscere questa variante {variant}", "ERROR")
-
-        return 'id', new_variant # Hoping for the best
-        
-    def __get_transcript_id(self, gene:str):
-        if self.__transcript_id_df[self.__transcript_id_df["Gene"] == gene].shape[0] == 0:
-            return None
-        transcript_id = self.__transcript_id_df[self.__transcript_id_df["Gene"] == gene]["ENST"].values[0]
-        return transcript_id.split(".")[0]
-       
-    def __grch37_to_grch38(self, grch37:str, ref:str, alt:str, chrom:str):
-        url = f"https://rest.ensembl.org/map/human/GRCh37/{grch37}/GRCh38?"
-        r = self.__request_data(url)
-        if r == None:
-            return (None, None)
+    def __lift(self, pending:pd.DataFrame)->pd.DataFrame:
+        '''
+        Conversione GRCh37 a GRCh38 delle varianti in pending (CHROM, POS, LIFTOVER_KEY).
+        Ritorna CHROM, POS e STRAND con lo stesso indice, STRAND vale 0 per le varianti non mappate
+        '''
+        if self.__liftover is not None:
+            lifted = self.__liftover.lift(pending["CHROM"], pending["POS"])
+        else:
+            lifted = pd.DataFrame({"CHROM": None, "POS": pd.array([pd.NA] * len(pending), dtype="Int64"), "STRAND": 0}, index=pending.index)
+        lifted["CHROM"] = lifted["CHROM"].astype(object)
         
-        start = r["mappings"][0]["mapped"]["start"]
-        variant = f"{chrom} {start} . {ref} {alt} . . ."
-        variant_type, variant = self.__get_variant_type(variant)
-        variant = urllib.parse.quote(variant)
-        return (variant_type, variant)
+        if not self.__remote_liftover:
+            return lifted
+        remote = lifted.index[lifted["STRAND"] == 0]
+        results = self.__requester.run([("GET", f"/map/human/GRCh37/{key}/GRCh38", None) for key in pending.loc[remote, "LIFTOVER_KEY"]])
+        for index, r in zip(remote, results):
+            mapped = self.__grch37_to_grch38(r)
+            if mapped is not None:
+                lifted.loc[index, ["CHROM", "POS", "STRAND"]] = mapped
+        return lifted
     
-    def __get_geneinfo(self, chrom:str, pos:str):
-        return self.__geneinfo_df[(self.__geneinfo_df["chrom"] == int(chrom)) & 
-                                  (self.__geneinfo_df["chromStart"] <= int(pos)) & 
-                                  (self.__geneinfo_df["chromEnd"] >= int(pos))
-                                  ]["GENEINFO"].values[0]
-
-    def __get_transcript_consequences_info(self, transcript_consequences:dict):
-        api_dict = {}
-        for key in self.__transcript_consequences_info_column:
-            try:
-                if "count" in key:
-                    api_dict[key] = len(transcript_consequences[key.replace("_count", "")][0])
-                else:
-                    api_dict[key] = transcript_consequences[key]
-            except KeyError:
-                pass
-            
-        return api_dict
-
-    def __get_colocated_variants_info(self, colocated_variants:dict):
-        for dictionary in colocated_variants:
-            for key in self.__colocated_variants_info_column:
-                if key not in dictionary :
-                    break
-                
-                if isinstance(dictionary, dict):
-                    colocated_variants = dictionary
+    def __prepare_variants(self, pending:pd.DataFrame, lifted:pd.DataFrame)->pd.DataFrame:
+        '''
+        Costruzione delle varianti GRCh38 per VEP, solo per le varianti mappate.
+        Ritorna REGION_QUOTED e VCF_INPUT con l'indice di pending, VCF_INPUT è nullo per le varianti da richiedere
+        solo con la notazione region (inserzioni e delezioni sul filamento opposto)
+        '''
+        mapped = lifted["STRAND"] != 0
+        grch38 = pd.DataFrame({
+            "CHROM": lifted["CHROM"],
+            "POS": lifted["POS"].astype("Int64"),
+            "REF": pending["REF"].astype(str),
+            "ALT": pending["ALT"].astype(str),
+        })[mapped]
+        if "END" in pending.columns:
+            # Le varianti strutturali mantengono la lunghezza
+            end = pd.Series(VariantNormalizer.end_positions(pending), index=pending.index)
+            grch38["END"] = end[mapped] + (grch38["POS"] - pd.to_numeric(pending["POS"])[mapped])
         
-        api_dict = {}
-        for key in self.__colocated_variants_info_column:
-            try:
-                if "count" in key:
-                    api_dict[key] = len(colocated_variants[key.replace("_count", "")])
-                elif key == "frequencies":
-                    alt = list(colocated_variants[key].keys())[0]
-                    for frequencies_key in self.__frequencies_key:
-                        api_dict[frequencies_key] = colocated_variants[key][alt][frequencies_key.replace("frequencies_", "")]
-                else:
-                    api_dict[key] = colocated_variants[key]
-            except KeyError:
-                pass
-            except TypeError:
-                try:
-                    if "count" in key:
-                        api_dict[key] = len(colocated_variants[0][key.replace("_count", "")])
-                        
-                    elif key == "frequencies":
-                        alt = list(colocated_variants[0][key].keys())[0]
-                        for frequencies_key in self.__frequencies_key:
-                            api_dict[frequencies_key] = colocated_variants[0][key][alt][frequencies_key.replace("frequencies_", "")]
-                    else:
-                        api_dict[key] = colocated_variants[0][key]
-                except KeyError:
-                    pass
-            
-        return api_dict
+        # Catena invertita: alleli e coordinate riportati sul filamento positivo
+        normalized = self.__normalizer.normalize_lifted(grch38, lifted.loc[mapped, "STRAND"])
+        return normalized[["REGION_QUOTED", "VCF_INPUT"]].dropna(subset=["REGION_QUOTED"])
     
-    def __get_clean_clin_sig_allele(self, clin_sig_allele, alt):
-        weight = {
-            "uncertain_significance": 0,
-            "conflicting_interpretations_of_pathogenicity": 0,
-            "not_provided": 0,
-            "benign/likely_benign": 0.8,
-            "benign": 1,
-            "likely_benign": 0.5,
-            "pathogenic": -1,
-            "likely_pathogenic": -0.5,
-            "pathogenic/likely_pathogenic": -0.8,
-            "other": 0
-        }
-        
-        
-        allele_sig = []
-        value = 0
-        for allele in clin_sig_allele.split(";"):
-            if allele[0] == alt[0]:
-                allele_sig.append(allele)
+    def __select_pending(self, pending:pd.DataFrame)->pd.DataFrame:
+        '''
+        Ricerca vettoriale del transcript MANE per le varianti in pending (CHROM, POS, ...), aggiunto come TRANSCRIPT_ID.
+        Le varianti fuori dalle regioni del pannello vengono scartate prima di qualsiasi chiamata
+        '''
+        pending = pending.assign(TRANSCRIPT_ID=self.__get_transcript_ids(pending["CHROM"], pending["POS"]))
+        missing = pending.loc[pending["TRANSCRIPT_ID"].isna(), "KEY"]
+        if missing.shape[0] > 0:
+            self.__log.write_log(lambda: f"Could not find geneinfo for {missing.shape[0]} variants: {'; '.join(missing)}", "ERROR")
+        return pending[pending["TRANSCRIPT_ID"].notna()]
+    
+    def __normalize_variants(self, variants:pd.DataFrame)->pd.DataFrame:
+        # Notazioni GRCh37 delle varianti (chiave in memoria e query di liftover), calcolate una sola volta
+        if "KEY" in variants.columns and "LIFTOVER_KEY" in variants.columns:
+            return variants
+        return pd.concat([variants, self.__normalizer.normalize(variants)[["KEY", "VARIANT_CLASS", "LIFTOVER_KEY"]]], axis=1)
+    
+    def __vep_request(self, region:str, transcript_id:str):
+        # Chiamata VEP per informazioni utili
+        return ("GET", f"/vep/human/region/{region}?transcript_id={transcript_id}&{self.VEP_PARAMS}", None)
+    
+    def __vep_batch_request(self, transcript_id:str, variants:dict):
+        # Chiamata POST di VEP per un gruppo di varianti con lo stesso transcript MANE
+        return ("POST", f"/vep/human/region?transcript_id={transcript_id}&{self.VEP_PARAMS}", {"variants": list(variants)})
+    
+    def __map_vep_batch(self, r:list, variants:dict)->dict:
+        '''
+        variants: input VCF GRCh38 -> first_variant
+        Ritorna first_variant -> risposta VEP per le varianti annotate
+        '''
+        if r == None:
+            return {}
         
-        if len(allele_sig) == 1:
-            value = weight[allele_sig[0].split(":")[1]]
-        elif len(allele_sig) == 0:
-            return None
+        responses = {}
+        for response in r:
+            first_variant = variants.get(response.get("input"))
+            if first_variant is not None:
+                responses[first_variant] = response
+        return responses
 
-        
-        for allele in allele_sig:
-            value += weight[allele.split(":")[1]]
-            
-        value /= len(allele_sig)
-        
-        if value >= 0.3: return "NEG"
-        elif value <= -0.3: return "POS"
-        else: return "VUS"
+    def get_api_info(self, chrom:str, pos:str, ref:str, alt:str, end:int = None):
+        api = self.get_api_response(chrom, pos, ref, alt, end)
+        if api is None:
+            return None
+        return self.__plan.apply_one(api, alt)
     
-    def get_api_info(self, chrom:str, pos:str, ref:str, alt:str, path_json:str):
-        first_variant = f"{chrom} {pos} . {ref} {alt} . . ."
-        api_dict = {}
+    def get_api_response(self, chrom:str, pos:str, ref:str, alt:str, end:int = None):
+        # Risposta VEP grezza della variante, dalla memoria o dalle API. end: INFO/END delle varianti strutturali
+        variant = {"CHROM": [chrom], "POS": [pos], "REF": [ref], "ALT": [alt]}
+        if end is not None:
+            variant["END"] = [end]
+        variant = self.__normalize_variants(pd.DataFrame(variant))
+        first_variant = variant["KEY"].iloc[0]
         # Controllo in memoria
-        if first_variant in self.__memory:
-            api = self.__memory[first_variant]
-            try:
-                api_dict = self.__get_transcript_consequences_info(api["transcript_consequences"][0])
-            except KeyError:
-                pass
-            
-            try:
-                api_dict = {**self.__get_colocated_variants_info(api["colocated_variants"]), **api_dict}
-            except KeyError:
-                pass
-            
-            if len(api_dict) == 0:
-                return api_dict
-            
-            # Pulizia del clin_sig_allele
-            try:
-                api_dict["clin_sig_allele"] = self.__get_clean_clin_sig_allele(api_dict["clin_sig_allele"], alt)
-            except KeyError:
-                pass
-
-            for key in ["most_severe_consequence", "variant_class"]:
-                try:
-                    api_dict["variant_class"] = api[key]
-                except KeyError:
-                    pass
-            
-            api_dict["seq_region_name"] = api["seq_region_name"]
-            return api_dict
+        api = self.__memory().get(first_variant)
+        if self.__metrics is not None:
+            self.__metrics.inc("cache_hits" if api is not None else "cache_misses")
+        if api is not None:
+            return api
         
         # Allocazione in memoria
-        self.__memory[first_variant] = {}
-        self.__log.write_log(f"Added variant {first_variant} to memory", "DEBUG")
-        with open(path_json, "w") as f:
-            json.dump(self.__memory, f, indent=4)
+        self.__memory().put(first_variant, {})
+        self.__log.count("Added variants to memory")
         
-        # Valore per la richiesta api di VEP
-        result = self.__get_variant_type(first_variant)
-        if result is None:
-            self.__log.write_log(f"Risultato del calcolo per la chiamata VEP è {result} quindi non è possibile fare la chiamata", level="ERROR")
+        pending = self.__select_pending(variant[variant["VARIANT_CLASS"] != "UNSUPPORTED"])
+        if pending.shape[0] == 0:
             return None
-        
-        # Conversione GRCh37 a GRCh38
-        grch37 = result[1].split("/")[0]
-        variant_type, variant = self.__grch37_to_grch38(grch37, ref, alt, chrom)
-
-        # Ricerca delle GENEINFO
-        try:
-            geneinfo = self.__get_geneinfo(chrom, pos)
-        except IndexError:
-            self.__log.write_log(f"Could not find geneinfo for variant {variant}", "ERROR")
+        prepared = self.__prepare_variants(pending, self.__lift(pending))
+        if prepared.shape[0] == 0:
             return None
         
-        # Chiamata VEP per informazioni utili
-        transcript_id = self.__get_transcript_id(geneinfo)
-        if transcript_id == None:
-            return None
-        url = f"http://rest.ensembl.org/vep/human/{variant_type}/{variant}?mane=1&transcript_id={transcript_id}&LoF=1&dbNSFP=ALL&variant_class=1&Geno2MP=1&domains=1&dbscSNV=1&hgvs=1"
-        r = self.__request_data(url)
+        r = self.__requester.run([self.__vep_request(prepared["REGION_QUOTED"].iloc[0], pending["TRANSCRIPT_ID"].iloc[0])])[0]
         if r == None:
             return None
         
         # Salvataggio in memoria
-        self.__memory[first_variant] = r[0]
-        self.__log.write_log(f"Updated variant {first_variant} to memory", "DEBUG")
-        with open(path_json, "w") as f:
-            json.dump(self.__memory, f, indent=4)
+        self.__memory().put(first_variant, r[0])
+        self.__log.count("Updated variants in memory")
+        return r[0]
+    
+    def get_api_info_batch(self, variants:pd.DataFrame):
+        '''
+        Annotazione delle varianti non ancora in memoria tramite POST /vep/human/region.
+        Le liftover vengono eseguite in parallelo, le varianti vengono raggruppate per transcript MANE
+        in blocchi da VEP_BATCH_SIZE e solo quelle non restituite dal batch vengono richieste singolarmente.
+
+        variants: DataFrame con CHROM, POS, REF, ALT (ed eventualmente KEY e LIFTOVER_KEY già calcolate)
+        '''
+        # Allocazione in memoria e liftover
+        variants = self.__normalize_variants(variants.reset_index(drop=True))
+        cached = self.__memory().get_many(variants["KEY"])
+        pending = variants[~variants["KEY"].isin(list(cached))]
+        if self.__metrics is not None:
+            self.__metrics.inc("cache_hits", len(cached))
+            self.__metrics.inc("cache_misses", pending.shape[0])
+        for first_variant in pending["KEY"]:
+            self.__memory().put(first_variant, {})
+        self.__log.count("Added variants to memory", n=pending.shape[0])
+        pending = self.__select_pending(pending[pending["VARIANT_CLASS"] != "UNSUPPORTED"])
+        prepared = self.__prepare_variants(pending, self.__lift(pending)).join(pending[["KEY", "TRANSCRIPT_ID"]])
+        self.__memory().flush()
         
-        # Ricerca dei transcript_consequences e colocated_variants
-        try:
-            transcript_consequences = r[0]["transcript_consequences"][0]
-            colocated_variants = r[0]["colocated_variants"]
-        except KeyError:
-            return None
-         
+        chunks = []
+        for transcript_id, group in prepared[prepared["VCF_INPUT"].notna()].groupby("TRANSCRIPT_ID", sort=False):
+            for i in range(0, group.shape[0], self.VEP_BATCH_SIZE):
+                chunk = group.iloc[i:i + self.VEP_BATCH_SIZE]
+                chunks.append((transcript_id, dict(zip(chunk["VCF_INPUT"], chunk["KEY"]))))
+        results = self.__requester.run([self.__vep_batch_request(transcript_id, chunk) for transcript_id, chunk in chunks])
         
+        # Salvataggio in memoria, le varianti senza notazione VCF vengono richieste singolarmente
+        missing = prepared.loc[prepared["VCF_INPUT"].isna(), "KEY"].tolist()
+        for (_, chunk), r in zip(chunks, results):
+            responses = self.__map_vep_batch(r, chunk)
+            for first_variant in chunk.values():
+                if first_variant in responses:
+                    self.__memory().put(first_variant, responses[first_variant])
+                    self.__log.count("Updated variants in memory")
+                else:
+                    missing.append(first_variant)
+        self.__memory().flush()
         
+        # Chiamate singole per le varianti non restituite dal batch
+        if len(missing) > 0:
+            self.__log.write_log(f"{len(missing)} variants not returned by VEP batch or without a VCF notation, falling back to single requests", "WARNING")
+            fallback = prepared.set_index("KEY").loc[missing]
+            results = self.__requester.run([self.__vep_request(region, transcript_id) for region, transcript_id in zip(fallback["REGION_QUOTED"], fallback["TRANSCRIPT_ID"])])
+            for first_variant, r in zip(missing, results):
+                if r == None:
+                    continue
+                self.__memory().put(first_variant, r[0])
+                self.__log.count("Updated variants in memory")
+            self.__memory().flush()
         
-        # Estrazione delle informazioni utili
-        api_dict = self.__get_transcript_consequences_info(transcript_consequences)
-        api_dict = {**self.__get_colocated_variants_info(colocated_variants), **api_dict}
+        self.__log.write_log(f"Annotated {prepared.shape[0]} variants with {len(chunks) + len(missing)} VEP requests", "DEBUG")
+        self.__log.flush_counters()
         
-        # Pulizia del clin_sig_allele
-        try:
-            api_dict["clin_sig_allele"] = self.__get_clean_clin_sig_allele(api_dict["clin_sig_allele"], alt)
-        except KeyError:
-            pass
+    def __write_checkpoint(self, shard:pd.DataFrame, checkpoint_dir:str, part:int):
+        # Shard con le sole righe annotate dall'ultimo checkpoint
+        shard = arrow_compatible(shard, self.__log)
+        path = os.path.join(checkpoint_dir, f"part-{part:05d}.parquet")
+        shard.to_parquet(path, index=False)
+        self.__log.write_log(f"Saved {shard.shape[0]} annotated variants in '{path}'", level="SUCCESS")
+    
+    def load_checkpoint(self, checkpoint_dir:str)->pd.DataFrame:
+        # Lettura degli shard di un run precedente
+        parts = sorted(glob.glob(os.path.join(checkpoint_dir, "part-*.parquet")))
+        if len(parts) == 0:
+            return pd.DataFrame(columns=VariantNormalizer.KEY_COLUMNS)
+        annotations = pd.concat([from_arrow(pd.read_parquet(part)) for part in parts], ignore_index=True)
+        annotations = annotations.drop_duplicates(subset=VariantNormalizer.key_columns(annotations), keep="last")
+        self.__log.write_log(f"Resumed {annotations.shape[0]} annotated variants from {len(parts)} shards in '{checkpoint_dir}'", "INFO")
+        return annotations
+    
+    def annotate_variants(self, variants:pd.DataFrame, checkpoint_dir:str = None, checkpoint_every:int = 1000, part:int = 0)->pd.DataFrame:
+        '''
+        Annotazione di una tabella di varianti distinte (CHROM, POS, REF, ALT ed eventualmente END).
+        Le risposte vengono lette dalla memoria a blocchi di checkpoint_every varianti ed estratte in colonne dal piano,
+        ogni blocco viene salvato in checkpoint_dir come shard part-NNNNN.parquet.
+        Ritorna una riga per variante con le colonne delle informazioni VEP
+        '''
+        keys = self.__normalize_variants(variants.reset_index(drop=True))
+        key_columns = VariantNormalizer.key_columns(keys)
+        blocks = []
+        for start in tqdm(range(0, keys.shape[0], checkpoint_every), leave=False):
+            block = keys.iloc[start:start + checkpoint_every].reset_index(drop=True)
+            cached = self.__memory().get_many(block["KEY"])
+            responses = []
+            ends = block["END"].tolist() if "END" in block.columns else [None] * block.shape[0]
+            for (first_variant, chrom, pos, ref, alt), end in zip(block[["KEY", "CHROM", "POS", "REF", "ALT"]].itertuples(index=False, name=None), ends):
+                api = cached.get(first_variant)
+                responses.append(api if api is not None else self.get_api_response(chrom, pos, ref, alt, end))
+            self.__memory().flush()
+            
+            block = pd.concat([block[key_columns], self.__plan.apply(responses, block["ALT"].tolist())], axis=1)
+            if checkpoint_dir is not None:
+                self.__write_checkpoint(block, checkpoint_dir, part)
+                part += 1
+            blocks.append(block)
         
-        # Estrazione del variant_class
-        for key in ["most_severe_consequence", "variant_class"]:
-            try:
-                api_dict["variant_class"] = r[0][key]
-            except KeyError:
-                pass
-        api_dict["seq_region_name"] = r[0]["seq_region_name"]
-        return api_dict
+        annotations = pd.concat(blocks, ignore_index=True) if len(blocks) > 0 else keys[key_columns]
+        columns = self.__plan.columns
+        annotations[[c for c in columns if c not in annotations.columns]] = np.nan
+        columns = key_columns + columns
+        return annotations[columns + [c for c in annotations.columns if c not in columns]]
+    
+    @staticmethod
+    def merge_annotations(df:pd.DataFrame, annotations:pd.DataFrame)->pd.DataFrame:
+        # Unione delle annotazioni (una riga per variante) con il dataset dei campioni
+        keys = [column for column in VariantNormalizer.key_columns(df) if column in annotations.columns]
+        index = df.index
+        dtypes = df.dtypes
+        df = df.drop(columns=[c for c in annotations.columns if c in df.columns and c not in keys])
+        df = df.merge(annotations, on=keys, how="left")
+        df.index = index
+        # Il merge con chiavi object perde le categorie, lo schema del dataset viene ripristinato
+        return df.astype({column: dtypes[column] for column in keys})
+
+    def get_api_info_from_df(self, df:pd.DataFrame, path_cache:str = DEFAULT_CACHE, path_json:str = None, batch:bool = True,
+                             checkpoint_dir:str = "data/vep_parts", checkpoint_every:int = 1000, resume:bool = False,
+                             path_csv:str = "data/data_vep.csv"):
+        # Apertura della memoria
+        self.open_cache(path_cache, path_json)
         
-    def get_api_info_from_df(self, df:pd.DataFrame, path_json:str):
-        # Creazione delle colonne
-        df[self.__transcript_consequences_info_column] = np.nan
-        df[self.__colocated_variants_info_column] = np.nan
+        # Ogni variante viene annotata una sola volta, indipendentemente dal numero di campioni
+        # Le chiavi categoriche del dataset vengono annotate come valori semplici
+        key_columns = VariantNormalizer.key_columns(df)
+        variants = df[key_columns].drop_duplicates()
+        variants = variants.astype({key: object for key in variants.columns if isinstance(variants[key].dtype, pd.CategoricalDtype)})
+        self.__log.write_log(f"Annotating {variants.shape[0]} distinct variants for {df.shape[0]} rows", "INFO")
         
-        # Caricamento della memoria
-        if os.path.exists(path_json):
-            self.__memory = json.load(open(path_json, "r"))
-            self.__log.write_log(f"Loaded {len(self.__memory)} variants from {path_json}", "DEBUG")
-    
-        for index, row in tqdm(df.iterrows(), total=df.shape[0]):
-            chrom = row["CHROM"]
-            pos = row["POS"]
-            ref = row["REF"]
-            alt = row["ALT"]
-            api_dict = self.get_api_info(chrom, pos, ref, alt, path_json)
-            
-            if api_dict is None:
-                continue
-            
-            # Assegnazione dei valori nelle colonne
-            for key in api_dict:
-                df.at[index, key] = api_dict[key]
-            
-            # Salvataggio dei dati in un CSV
-            if index % 1000 == 0 and index > 0:
-                df.head(index).to_csv("data/data_vep.csv", index=False)
-                self.__log.write_log(f"Saved the first {index} in '{path_json}'", level="SUCCESS")
-                
-        df.to_csv("data/data_vep.csv", index=False)
-        return df
\ No newline at end of file
+        # Ripresa da un run interrotto: le varianti già presenti negli shard non vengono riannotate
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        if resume:
+            done = self.load_checkpoint(checkpoint_dir)
+            done = done.reindex(columns=list(dict.fromkeys(key_columns + list(done.columns))))
+            done = done.astype({key: variants[key].dtype for key in key_columns})
+            todo = variants.merge(done[key_columns], how="left", indicator=True)
+            variants = todo[todo["_merge"] == "left_only"].drop(columns="_merge")
+        else:
+            for old_part in glob.glob(os.path.join(checkpoint_dir, "part-*.parquet")):
+                os.remove(old_part)
+            done = None
+        part = len(glob.glob(os.path.join(checkpoint_dir, "part-*.parquet")))
+        
+        # Annotazione in batch delle varianti non presenti in memoria
+        variants = self.__normalize_variants(variants.reset_index(drop=True))
+        if batch:
+            self.get_api_info_batch(variants)
+        annotations = self.annotate_variants(variants, checkpoint_dir, checkpoint_every, part)
+        if done is not None and done.shape[0] > 0:
+            columns = list(annotations.columns) + [c for c in done.columns if c not in annotations.columns]
+            annotations = pd.concat([done, annotations], ignore_index=True)[columns]
+        
+        df = self.merge_annotations(df, annotations)
+        if path_csv is not None:
+            df.to_csv(path_csv, index=False)
+        return df
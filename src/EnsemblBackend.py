@@ -0,0 +1,218 @@
+import asyncio, gzip, json, os, random, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import httpx
+from src.Log import Log
+
+
+class ResponseArchive:
+    '''
+    Archivio delle risposte REST di Ensembl in JSON Lines compresso (gzip).
+    Ogni riga contiene method, path, payload, status e body della risposta.
+    Le risposte dei POST /vep/human/region sono indicizzate anche per singola variante (campo input),
+    così il replay funziona anche con una composizione dei batch diversa da quella registrata.
+    '''
+    VEP_BATCH_PATH = "/vep/human/region"
+
+    def __init__(self, path:str, log:Log) -> None:
+        self.path = path
+        self.__log = log
+        self.__responses = {}
+        self.__variants = {}
+        self.__handle = None
+        self.__lock = threading.Lock()
+        if os.path.exists(path):
+            self.__load()
+
+    @staticmethod
+    def key(method:str, path:str, payload:dict = None)->str:
+        return f"{method} {path} {json.dumps(payload, sort_keys=True, separators=(',', ':')) if payload is not None else ''}"
+
+    @staticmethod
+    def __batch_path(path:str)->str:
+        # Path del POST senza query string, i parametri restano nella chiave delle singole varianti
+        return path.split("?")[0]
+
+    def __index(self, record:dict):
+        self.__responses[self.key(record["method"], record["path"], record["payload"])] = (record["status"], record["body"])
+        if record["method"] == "POST" and self.__batch_path(record["path"]) == self.VEP_BATCH_PATH and isinstance(record["body"], list):
+            query = record["path"].partition("?")[2]
+            for variant in record["body"]:
+                if isinstance(variant, dict) and "input" in variant:
+                    self.__variants[(query, variant["input"])] = variant
+
+    def __load(self):
+        count = 0
+        try:
+            with gzip.open(self.path, "rt") as f:
+                for line in f:
+                    self.__index(json.loads(line))
+                    count += 1
+        except (EOFError, json.JSONDecodeError):
+            # Archivio troncato da un run interrotto: si tengono le righe complete
+            self.__log.write_log(f"Archive {self.path} is truncated, keeping the first {count} responses", "WARNING")
+        self.__log.write_log(f"Loaded {count} responses from {self.path}", "DEBUG")
+
+    def record(self, method:str, path:str, payload:dict, status:int, body):
+        record = {"method": method, "path": path, "payload": payload, "status": status, "body": body}
+        with self.__lock:
+            if self.__handle is None:
+                self.__handle = gzip.open(self.path, "at")
+            self.__handle.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.__index(record)
+
+    def respond(self, method:str, path:str, payload:dict = None):
+        '''
+        Ritorna (status, body) della risposta registrata oppure None se assente
+        '''
+        response = self.__responses.get(self.key(method, path, payload))
+        if response is not None:
+            return response
+        if method == "POST" and self.__batch_path(path) == self.VEP_BATCH_PATH and isinstance(payload, dict):
+            # Batch mai visto: si ricompone dalle varianti registrate, quelle assenti vengono omesse come fa VEP
+            query = path.partition("?")[2]
+            found = [self.__variants[(query, v)] for v in payload.get("variants", []) if (query, v) in self.__variants]
+            if len(found) > 0:
+                return (200, found)
+        return None
+
+    def __len__(self)->int:
+        return len(self.__responses)
+
+    def close(self):
+        with self.__lock:
+            if self.__handle is not None:
+                self.__handle.close()
+                self.__handle = None
+
+
+class ReplayResponder:
+    '''
+    Risposte di replay con latenza e tasso di errore iniettati.
+    Gli errori sono 503 (oppure 429 con Retry-After se retry_after è impostato),
+    le richieste non registrate ritornano 400 così l'AsyncRequester non le ritenta
+    '''
+    def __init__(self, archive:ResponseArchive, latency:float = 0.0, error_rate:float = 0.0, retry_after:float = None, seed:int = None) -> None:
+        self.archive = archive
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.stats = {"served": 0, "missing": 0, "errors": 0}
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def respond(self, method:str, path:str, payload:dict = None):
+        '''
+        Ritorna (status, body, headers) per la richiesta
+        '''
+        with self.__lock:
+            error = self.__random.random() < self.error_rate
+            response = None if error else self.archive.respond(method, path, payload)
+            self.stats["errors" if error else "missing" if response is None else "served"] += 1
+        if error:
+            if self.retry_after is not None:
+                return 429, {"error": "Injected rate limit"}, {"Retry-After": str(self.retry_after)}
+            return 503, {"error": "Injected error"}, {}
+        if response is None:
+            return 400, {"error": f"No recorded response for {method} {path}"}, {}
+        return response[0], response[1], {}
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    # Transport httpx in-process: nessun socket, le risposte arrivano dal ReplayResponder
+    def __init__(self, responder:ReplayResponder) -> None:
+        self.responder = responder
+
+    async def handle_async_request(self, request:httpx.Request)->httpx.Response:
+        body = await request.aread()
+        payload = json.loads(body) if body else None
+        if self.responder.latency > 0:
+            await asyncio.sleep(self.responder.latency)
+        status, body, headers = self.responder.respond(request.method, request.url.raw_path.decode(), payload)
+        return httpx.Response(status, json=body, headers=headers, request=request)
+
+
+class ReplayServer:
+    '''
+    Stand-in HTTP di Ensembl su localhost, per misurare anche il costo di rete e del pool di connessioni
+    '''
+    def __init__(self, responder:ReplayResponder, host:str = "127.0.0.1", port:int = 0) -> None:
+        self.responder = responder
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def __reply(self, payload:dict = None):
+                if responder.latency > 0:
+                    time.sleep(responder.latency)
+                status, body, headers = responder.respond(self.command, self.path, payload)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.__reply()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.__reply(json.loads(self.rfile.read(length)) if length > 0 else None)
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        self.url = f"http://{host}:{self.__server.server_address[1]}"
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class EnsemblBackend:
+    '''
+    Backend delle chiamate REST di Ensembl usato da EnsemblAPI.
+      - live:   server reale, comportamento invariato
+      - record: server reale, ogni risposta viene salvata nell'archivio
+      - replay: risposte servite dall'archivio, in-process (ReplayTransport) oppure da un server su localhost (serve=True),
+                con latenza ed errori iniettati per benchmark deterministici senza rete
+    '''
+    MODES = ["live", "record", "replay"]
+
+    def __init__(self, log:Log, mode:str = "live", archive_path:str = None, latency:float = 0.0, error_rate:float = 0.0,
+                 retry_after:float = None, seed:int = None, serve:bool = False) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown backend mode {mode}, expected one of {self.MODES}")
+        if mode != "live" and archive_path is None:
+            raise ValueError(f"Backend mode {mode} needs an archive_path")
+        if mode == "replay" and not os.path.exists(archive_path):
+            raise FileNotFoundError(f"Archive {archive_path} not found")
+
+        self.mode = mode
+        self.__log = log
+        self.archive = ResponseArchive(archive_path, log) if mode != "live" else None
+        self.responder = ReplayResponder(self.archive, latency, error_rate, retry_after, seed) if mode == "replay" else None
+        self.__server = ReplayServer(self.responder) if mode == "replay" and serve else None
+        self.transport = ReplayTransport(self.responder) if mode == "replay" and not serve else None
+        log.write_log(f"Ensembl backend: {mode}" + (f" ({archive_path}, {len(self.archive)} responses)" if self.archive is not None else ""), "DEBUG")
+
+    def server_url(self, server:str)->str:
+        # URL effettivo delle chiamate: il server richiesto oppure lo stand-in su localhost
+        return self.__server.url if self.__server is not None else server
+
+    @property
+    def on_response(self):
+        # Hook dell'AsyncRequester, solo in registrazione
+        return self.archive.record if self.mode == "record" else None
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+        if self.__server is not None:
+            self.__server.close()
+        if self.responder is not None:
+            self.__log.write_log(f"Replay stats: {self.responder.stats}", "DEBUG")
@@ -0,0 +1,143 @@
+import json
+import pandas as pd
+
+
+class ExtractionPlan:
+    '''
+    Piano di estrazione delle informazioni dalle risposte VEP, compilato una sola volta da key.json.
+    Ogni chiave diventa una regola con il percorso già risolto:
+      - transcript_consequences[0]: "get" oppure "len_first" per le chiavi *_count (lunghezza del primo elemento)
+      - colocated_variants: "get", "len" per le chiavi *_count e "frequencies" per le frequenze dell'allele
+    La variante colocalizzata usata è l'ultima che contiene la prima chiave di colocated_variants, altrimenti la prima.
+    '''
+    CLIN_SIG_WEIGHT = {
+        "uncertain_significance": 0,
+        "conflicting_interpretations_of_pathogenicity": 0,
+        "not_provided": 0,
+        "benign/likely_benign": 0.8,
+        "benign": 1,
+        "likely_benign": 0.5,
+        "pathogenic": -1,
+        "likely_pathogenic": -0.5,
+        "pathogenic/likely_pathogenic": -0.8,
+        "other": 0
+    }
+
+    def __init__(self, transcript_consequences:list, colocated_variants:list, frequencies_key:list) -> None:
+        self.transcript_rules = []
+        for key in dict.fromkeys(transcript_consequences):
+            if "count" in key:
+                self.transcript_rules.append((key, "len_first", key.replace("_count", "")))
+            else:
+                self.transcript_rules.append((key, "get", key))
+
+        self.colocated_rules = []
+        for key in dict.fromkeys(colocated_variants):
+            if "count" in key:
+                self.colocated_rules.append((key, "len", key.replace("_count", "")))
+            elif key == "frequencies":
+                self.colocated_rules.append((key, "frequencies", [(k, k.replace("frequencies_", "")) for k in frequencies_key]))
+            else:
+                self.colocated_rules.append((key, "get", key))
+        self.colocated_selector = colocated_variants[0] if len(colocated_variants) > 0 else None
+
+        # Colonne prodotte, nell'ordine di key.json
+        self.columns = list(dict.fromkeys(transcript_consequences + colocated_variants))
+        self.output_columns = list(dict.fromkeys([key for key, _, _ in self.colocated_rules if key != "frequencies"] +
+                                                 [k for k in frequencies_key if "frequencies" in colocated_variants] +
+                                                 [key for key, _, _ in self.transcript_rules] +
+                                                 ["variant_class", "seq_region_name"]))
+
+    @classmethod
+    def from_json(cls, path:str = "key.json"):
+        keys = json.load(open(path))
+        return cls(keys["transcript_consequences"], keys["colocated_variants"], keys["frequencies_key"])
+
+    def __apply_transcript(self, transcript:dict, api_dict:dict):
+        for key, rule, source in self.transcript_rules:
+            if source not in transcript:
+                continue
+            if rule == "get":
+                api_dict[key] = transcript[source]
+            elif len(transcript[source]) > 0:
+                api_dict[key] = len(transcript[source][0])
+
+    def __select_colocated(self, colocated_variants:list)->dict:
+        selected = None
+        for dictionary in colocated_variants:
+            if isinstance(dictionary, dict) and self.colocated_selector in dictionary:
+                selected = dictionary
+        if selected is None and len(colocated_variants) > 0 and isinstance(colocated_variants[0], dict):
+            selected = colocated_variants[0]
+        return selected
+
+    def __apply_colocated(self, colocated:dict, api_dict:dict):
+        for key, rule, source in self.colocated_rules:
+            if rule == "frequencies":
+                frequencies = colocated.get(key)
+                if not frequencies:
+                    continue
+                frequencies = next(iter(frequencies.values()))
+                for frequencies_key, allele_key in source:
+                    if allele_key not in frequencies:
+                        break
+                    api_dict[frequencies_key] = frequencies[allele_key]
+            elif source not in colocated:
+                continue
+            elif rule == "get":
+                api_dict[key] = colocated[source]
+            else:
+                api_dict[key] = len(colocated[source])
+
+    def clean_clin_sig_allele(self, clin_sig_allele:str, alt:str):
+        # Classificazione NEG/POS/VUS dal clin_sig_allele della variante, la stringa resta invariata se contiene significati sconosciuti
+        allele_sig = [allele for allele in clin_sig_allele.split(";") if allele[:1] == alt[:1]]
+        if len(allele_sig) == 0:
+            return None
+        try:
+            weights = [self.CLIN_SIG_WEIGHT[allele.split(":")[1]] for allele in allele_sig]
+        except (KeyError, IndexError):
+            return clin_sig_allele
+
+        value = weights[0] if len(weights) == 1 else 0
+        value = (value + sum(weights)) / len(weights)
+        if value >= 0.3: return "NEG"
+        elif value <= -0.3: return "POS"
+        else: return "VUS"
+
+    def apply_one(self, api:dict, alt:str)->dict:
+        '''
+        Estrazione delle informazioni utili da una singola risposta VEP
+        '''
+        api_dict = {}
+        colocated_variants = api.get("colocated_variants")
+        if colocated_variants:
+            colocated = self.__select_colocated(colocated_variants)
+            if colocated is not None:
+                self.__apply_colocated(colocated, api_dict)
+
+        transcript_consequences = api.get("transcript_consequences")
+        if transcript_consequences:
+            self.__apply_transcript(transcript_consequences[0], api_dict)
+
+        if len(api_dict) == 0:
+            return api_dict
+
+        if isinstance(api_dict.get("clin_sig_allele"), str):
+            api_dict["clin_sig_allele"] = self.clean_clin_sig_allele(api_dict["clin_sig_allele"], alt)
+
+        for key in ["most_severe_consequence", "variant_class"]:
+            if key in api:
+                api_dict["variant_class"] = api[key]
+        if "seq_region_name" in api:
+            api_dict["seq_region_name"] = api["seq_region_name"]
+        return api_dict
+
+    def apply(self, responses:list, alts:list)->pd.DataFrame:
+        '''
+        Estrazione di un blocco di risposte VEP in colonne tipizzate.
+        Le risposte nulle o vuote producono righe nulle; le colonne solo numeriche diventano float64, le altre object
+        '''
+        rows = [self.apply_one(api, alt) if api else {} for api, alt in zip(responses, alts)]
+        result = pd.DataFrame.from_records(rows, index=pd.RangeIndex(len(rows)))
+        return result.reindex(columns=self.output_columns + [c for c in result.columns if c not in self.output_columns])
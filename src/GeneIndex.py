@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from src.Log import Log
+
+
+class GeneIndex:
+    '''
+    Indice delle regioni di HCS_region_map.bed per l'assegnazione del gene alle varianti.
+    Le regioni (a livello di esone) di ogni cromosoma vengono scomposte in segmenti elementari disgiunti,
+    ad ogni segmento è associata la regione che lo copre con GENEINFO minore in ordine alfabetico,
+    così le regioni sovrapposte hanno un risultato deterministico.
+    Gli estremi delle regioni sono inclusi, come nel confronto chromStart <= POS <= chromEnd.
+    '''
+    def __init__(self, bed_path:str, log:Log) -> None:
+        self.__log = log
+        self.regions = pd.read_csv(bed_path, sep="\t", comment="t", header=None)
+        header = ["chrom", "chromStart", "chromEnd", "Exon", "GENEINFO"]
+        self.regions.columns = header[:len(self.regions.columns)]
+        self.regions["chrom"] = self.regions["chrom"].astype(str).map(self.normalize_chrom)
+        self.__build_index()
+
+    @staticmethod
+    def normalize_chrom(chrom:str)->str:
+        chrom = str(chrom)
+        if chrom.startswith("chr"):
+            chrom = chrom[3:]
+        if chrom.endswith(".0"):
+            chrom = chrom[:-2]
+        return chrom
+
+    def __build_index(self):
+        self.__index = {}
+        # Rank delle regioni: ordine alfabetico di GENEINFO, a parità l'ordine del file
+        regions = self.regions.reset_index(drop=True)
+        rank = np.argsort(regions.sort_values("GENEINFO", kind="stable").index.to_numpy())
+        for chrom, group in regions.groupby("chrom", sort=False):
+            starts = group["chromStart"].to_numpy(dtype=np.int64)
+            ends = group["chromEnd"].to_numpy(dtype=np.int64) + 1
+            breakpoints = np.unique(np.concatenate([starts, ends]))
+            label = np.full(len(breakpoints) - 1, -1, dtype=np.int64)
+
+            # Dalla regione peggiore alla migliore, così vince quella con rank minore
+            rows = group.index.to_numpy()
+            order = np.argsort(-rank[rows], kind="stable")
+            for i in order:
+                lo = np.searchsorted(breakpoints, starts[i])
+                hi = np.searchsorted(breakpoints, ends[i])
+                label[lo:hi] = rows[i]
+            self.__index[chrom] = (breakpoints, label)
+        self.regions = regions
+
+    def intervals(self)->dict:
+        '''
+        Regioni del pannello fuse per cromosoma: chrom -> (starts, ends) ordinati e disgiunti, estremi inclusi
+        '''
+        intervals = {}
+        for chrom, (breakpoints, label) in self.__index.items():
+            covered = label >= 0
+            # Inizio e fine dei tratti contigui di segmenti coperti
+            edges = np.diff(np.concatenate([[False], covered, [False]]).astype(np.int8))
+            starts = breakpoints[:-1][edges[:-1] == 1]
+            ends = breakpoints[1:][edges[1:] == -1] - 1
+            intervals[chrom] = (starts, ends)
+        return intervals
+
+    def annotate(self, chrom:pd.Series, pos:pd.Series, columns:list = ["GENEINFO"])->pd.DataFrame:
+        '''
+        Assegnazione vettoriale delle regioni a coppie (CHROM, POS).
+        Ritorna un DataFrame con lo stesso indice e le colonne richieste, nulle dove nessuna regione copre la posizione
+        '''
+        index = chrom.index
+        chrom = chrom.astype(str).map(self.normalize_chrom).to_numpy()
+        pos = pd.to_numeric(pos, errors="coerce").to_numpy(dtype=float)
+        region = np.full(len(chrom), -1, dtype=np.int64)
+
+        for c in pd.unique(chrom):
+            if c not in self.__index:
+                continue
+            breakpoints, label = self.__index[c]
+            rows = np.flatnonzero((chrom == c) & ~np.isnan(pos))
+            segment = np.searchsorted(breakpoints, pos[rows], side="right") - 1
+            inside = (segment >= 0) & (segment < len(label))
+            region[rows[inside]] = label[segment[inside]]
+
+        found = region >= 0
+        result = pd.DataFrame(np.full((len(chrom), len(columns)), None, dtype=object), columns=columns)
+        result.loc[found, columns] = self.regions.loc[region[found], columns].to_numpy()
+        result.index = index
+        return result
+
+    def lookup(self, chrom:str, pos:str)->str:
+        gene = self.annotate(pd.Series([chrom]), pd.Series([pos]))["GENEINFO"].iloc[0]
+        return None if pd.isna(gene) else gene
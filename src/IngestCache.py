@@ -0,0 +1,106 @@
+import os, sqlite3, hashlib, glob
+import numpy as np
+import pandas as pd
+from src.Log import Log
+from src.utils import file_hash
+
+
+class IngestCache:
+    '''
+    Cache incrementale dell'ingestione dei VCF.
+    Il manifest (SQLite) tiene per ogni file path, size, mtime, hash del contenuto, identificativo e numero di record;
+    i record letti di ogni file sono salvati in parts/<file>.parquet.
+    Un file è considerato cambiato solo se size o mtime sono diversi e il nuovo hash non coincide.
+    Il fingerprint della configurazione di lettura (campi, regioni) invalida tutta la cache quando cambia.
+    '''
+    def __init__(self, cache_dir:str, log:Log, fingerprint:str = "") -> None:
+        self.cache_dir = cache_dir
+        self.__log = log
+        os.makedirs(os.path.join(cache_dir, "parts"), exist_ok=True)
+        self.__connection = sqlite3.connect(os.path.join(cache_dir, "manifest.sqlite"))
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, identifier TEXT, records INTEGER) WITHOUT ROWID")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.__connection.commit()
+
+        row = self.__connection.execute("SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+        if row is not None and row[0] != fingerprint:
+            self.__log.write_log("VCF reader configuration changed, rebuilding the ingestion cache", "WARNING")
+            self.clear()
+        self.__connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('fingerprint', ?)", (fingerprint,))
+        self.__connection.commit()
+
+    def part_path(self, path:str)->str:
+        name = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=12).hexdigest()
+        return os.path.join(self.cache_dir, "parts", f"{name}.parquet")
+
+    def changed(self, paths:list)->list:
+        '''
+        File nuovi o modificati rispetto al manifest, nell'ordine di paths.
+        I file toccati ma con lo stesso contenuto aggiornano solo mtime
+        '''
+        manifest = {path: (size, mtime, hash) for path, size, mtime, hash in self.__connection.execute("SELECT path, size, mtime, hash FROM files")}
+        changed = []
+        for path in paths:
+            stat = os.stat(path)
+            entry = manifest.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                continue
+            if entry is not None and entry[0] == stat.st_size and entry[2] == file_hash(path):
+                self.__connection.execute("UPDATE files SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+                continue
+            changed.append(path)
+        self.__connection.commit()
+        return changed
+
+    @staticmethod
+    def fingerprint_file(path:str)->tuple:
+        # (size, mtime, hash) letti prima del parsing, così una modifica durante la lettura viene rilevata al run successivo
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime, file_hash(path)
+
+    def update(self, path:str, fingerprint:tuple, identifier:str, records:int):
+        # Da chiamare dopo aver scritto (o rimosso) il part del file
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime, hash, identifier, records) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, *fingerprint, identifier, records)
+        )
+
+    def commit(self):
+        self.__connection.commit()
+
+    def entries(self, paths:list)->list:
+        '''
+        (path, identifier, records, mtime) dal manifest nell'ordine di paths, i file assenti dal manifest vengono saltati
+        '''
+        manifest = {path: (identifier, records, mtime) for path, identifier, records, mtime in self.__connection.execute("SELECT path, identifier, records, mtime FROM files")}
+        return [(path, *manifest[path]) for path in paths if path in manifest]
+
+    def load(self, path:str)->pd.DataFrame:
+        df = pd.read_parquet(self.part_path(path))
+        # Parquet rilegge i valori mancanti delle colonne object come None
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].where(df[column].notna(), np.nan)
+        return df
+
+    def prune(self, paths:list)->int:
+        # Rimozione dal manifest e dalla cache dei file non più presenti
+        keep = set(paths)
+        removed = [path for (path,) in self.__connection.execute("SELECT path FROM files") if path not in keep]
+        for path in removed:
+            if os.path.exists(self.part_path(path)):
+                os.remove(self.part_path(path))
+        self.__connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+        self.__connection.commit()
+        if len(removed) > 0:
+            self.__log.write_log(f"Removed {len(removed)} deleted files from the ingestion cache", "INFO")
+        return len(removed)
+
+    def clear(self):
+        for part in glob.glob(os.path.join(self.cache_dir, "parts", "*.parquet")):
+            os.remove(part)
+        self.__connection.execute("DELETE FROM files")
+        self.__connection.commit()
+
+    def close(self):
+        self.__connection.commit()
+        self.__connection.close()
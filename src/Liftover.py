@@ -0,0 +1,173 @@
+import gzip, os
+import numpy as np
+import pandas as pd
+from src.Log import Log
+
+
+class Liftover:
+    '''
+    Liftover locale da GRCh37 a GRCh38 a partire da un chain file UCSC/Ensembl.
+    I blocchi allineati di ogni cromosoma sono ordinati per inizio e interrogati con np.searchsorted,
+    il chain file già letto viene salvato in un .npz accanto all'originale per i caricamenti successivi.
+
+    Coordinate dei chain file: 0-based, semiaperte. Le posizioni in ingresso e in uscita sono 1-based (VCF).
+    '''
+    CACHE_VERSION = 1
+
+    def __init__(self, chain_path:str, log:Log, cache_path:str = None) -> None:
+        self.chain_path = chain_path
+        self.cache_path = cache_path if cache_path is not None else chain_path + ".npz"
+        # np.savez aggiunge .npz ai percorsi che non lo hanno: il controllo di esistenza deve usare lo stesso nome
+        if not self.cache_path.endswith(".npz"):
+            self.cache_path += ".npz"
+        self.__log = log
+
+        if os.path.exists(self.cache_path) and os.path.getmtime(self.cache_path) >= os.path.getmtime(chain_path):
+            arrays = self.__load_cache()
+        else:
+            arrays = None
+        if arrays is None:
+            arrays = self.__parse_chain()
+            np.savez(self.cache_path, **arrays)
+            self.__log.write_log(f"Saved parsed chain file to {self.cache_path}", "DEBUG")
+        self.__build_index(arrays)
+
+    @staticmethod
+    def normalize_chrom(chrom:str)->str:
+        chrom = str(chrom)
+        if chrom.startswith("chr"):
+            chrom = chrom[3:]
+        if chrom == "M":
+            chrom = "MT"
+        return chrom
+
+    def __load_cache(self):
+        with np.load(self.cache_path) as data:
+            if int(data["version"]) != self.CACHE_VERSION:
+                return None
+            return {key: data[key] for key in data.files}
+
+    def __parse_chain(self)->dict:
+        t_chrom, t_start, t_end, q_chrom, q_start, q_size, q_strand, score = [], [], [], [], [], [], [], []
+        opener = gzip.open if self.chain_path.endswith(".gz") else open
+        with opener(self.chain_path, "rt") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                if fields[0] == "chain":
+                    # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+                    chain_score = float(fields[1])
+                    chain_t_chrom = self.normalize_chrom(fields[2])
+                    chain_q_chrom = self.normalize_chrom(fields[7])
+                    chain_q_size = int(fields[8])
+                    chain_q_strand = 1 if fields[9] == "+" else -1
+                    t = int(fields[5])
+                    q = int(fields[10])
+                    continue
+
+                # size [dt dq]
+                size = int(fields[0])
+                t_chrom.append(chain_t_chrom)
+                t_start.append(t)
+                t_end.append(t + size)
+                q_chrom.append(chain_q_chrom)
+                q_start.append(q)
+                q_size.append(chain_q_size)
+                q_strand.append(chain_q_strand)
+                score.append(chain_score)
+                if len(fields) == 3:
+                    t += size + int(fields[1])
+                    q += size + int(fields[2])
+
+        self.__log.write_log(f"Parsed {len(t_start)} aligned blocks from {self.chain_path}", "DEBUG")
+        q_chroms, q_chrom_index = np.unique(np.array(q_chrom, dtype=str), return_inverse=True)
+        return {
+            "version": np.array(self.CACHE_VERSION),
+            "t_chrom": np.array(t_chrom, dtype=str),
+            "t_start": np.array(t_start, dtype=np.int32),
+            "t_end": np.array(t_end, dtype=np.int32),
+            "q_chroms": q_chroms,
+            "q_chrom": q_chrom_index.astype(np.int16),
+            "q_start": np.array(q_start, dtype=np.int32),
+            "q_size": np.array(q_size, dtype=np.int32),
+            "q_strand": np.array(q_strand, dtype=np.int8),
+            "score": np.array(score, dtype=np.float32),
+        }
+
+    def __build_index(self, arrays:dict):
+        # Indice per cromosoma: blocchi ordinati per inizio e massimo cumulativo delle fini
+        self.__q_chroms = arrays["q_chroms"]
+        self.__index = {}
+        order = np.lexsort((arrays["t_start"], arrays["t_chrom"]))
+        t_chrom = arrays["t_chrom"][order]
+        chroms, first = np.unique(t_chrom, return_index=True)
+        bounds = list(first) + [len(order)]
+        for i, chrom in enumerate(chroms):
+            idx = order[bounds[i]:bounds[i + 1]]
+            block = {key: arrays[key][idx] for key in ["t_start", "t_end", "q_chrom", "q_start", "q_size", "q_strand", "score"]}
+            block["max_end"] = np.maximum.accumulate(block["t_end"])
+            # Blocchi che si sovrappongono ad uno precedente (catene diverse)
+            block["overlap"] = np.concatenate([[False], block["t_start"][1:] < block["max_end"][:-1]])
+            self.__index[str(chrom)] = block
+
+    def __resolve_overlap(self, block:dict, idx:int, pos0:int)->int:
+        # Scansione all'indietro: tra i blocchi che contengono pos0 vince la catena con score più alto
+        best = -1
+        j = idx
+        while j >= 0 and block["max_end"][j] > pos0:
+            if block["t_start"][j] <= pos0 < block["t_end"][j]:
+                if best < 0 or block["score"][j] > block["score"][best]:
+                    best = j
+            j -= 1
+        return best
+
+    def lift(self, chrom:pd.Series, pos:pd.Series)->pd.DataFrame:
+        '''
+        Liftover vettoriale di una colonna di posizioni.
+        Ritorna un DataFrame con lo stesso indice e colonne CHROM, POS e STRAND:
+        STRAND vale 1 o -1 (catena invertita) per le posizioni mappate e 0 per quelle non mappate, che hanno CHROM e POS nulli
+        '''
+        chrom = chrom.astype(str).map(self.normalize_chrom)
+        pos = pd.to_numeric(pos, errors="coerce")
+        result_chrom = np.full(len(chrom), None, dtype=object)
+        result_pos = np.full(len(chrom), -1, dtype=np.int64)
+        result_strand = np.zeros(len(chrom), dtype=np.int8)
+
+        for c in chrom.unique():
+            block = self.__index.get(c)
+            if block is None:
+                continue
+            rows = np.flatnonzero((chrom == c).to_numpy() & pos.notna().to_numpy())
+            pos0 = pos.to_numpy()[rows].astype(np.int64) - 1
+            idx = np.searchsorted(block["t_start"], pos0, side="right") - 1
+
+            # Percorso vettoriale: il blocco trovato contiene la posizione e non si sovrappone ad altri
+            valid = idx >= 0
+            safe_idx = np.where(valid, idx, 0)
+            contained = valid & (pos0 < block["t_end"][safe_idx])
+            slow = valid & (block["overlap"][safe_idx] | (~contained & (block["max_end"][safe_idx] > pos0)))
+            for k in np.flatnonzero(slow):
+                j = self.__resolve_overlap(block, idx[k], pos0[k])
+                contained[k] = j >= 0
+                safe_idx[k] = max(j, 0)
+
+            rows, pos0, safe_idx = rows[contained], pos0[contained], safe_idx[contained]
+            q0 = block["q_start"][safe_idx].astype(np.int64) + (pos0 - block["t_start"][safe_idx])
+            strand = block["q_strand"][safe_idx]
+            # Catena sul filamento opposto: coordinate sul reverse complement del cromosoma di arrivo
+            q0 = np.where(strand < 0, block["q_size"][safe_idx].astype(np.int64) - 1 - q0, q0)
+            result_chrom[rows] = self.__q_chroms[block["q_chrom"][safe_idx]]
+            result_pos[rows] = q0 + 1
+            result_strand[rows] = strand
+
+        result = pd.DataFrame({
+            "CHROM": result_chrom,
+            "POS": pd.array(np.where(result_strand != 0, result_pos, 0), dtype="Int64"),
+            "STRAND": result_strand,
+        }, index=chrom.index)
+        result.loc[result["STRAND"] == 0, "POS"] = pd.NA
+        unmapped = int((result_strand == 0).sum())
+        if unmapped > 0:
+            self.__log.write_log(f"{unmapped} positions could not be lifted over with {self.chain_path}", "WARNING")
+        return result
@@ -1,25 +1,79 @@
 from loguru import logger
 import pendulum
+import atexit
+import time
 import os
 
 class Log:
-    def __init__(self, save_file:bool = True, dir_path:str = "logs"):
+    '''
+    Log su file con loguru.
+    I messaggi possono essere funzioni senza argomenti, chiamate solo se il livello è abbastanza alto da essere scritto,
+    gli eventi ripetuti nei cicli vanno contati con count e vengono scritti come totali ogni counter_interval secondi.
+    Con enqueue il file viene scritto da un thread separato: il chiamante non attende il disco
+    ma paga la serializzazione del messaggio nella coda (più lenta della scrittura diretta, vedi benchmark.py log).
+    '''
+    def __init__(self, save_file:bool = True, dir_path:str = "logs", level:str = "DEBUG", enqueue:bool = False, counter_interval:float = 30.0):
         self.save_file = save_file
         self.dir_path = dir_path
+        self.counter_interval = counter_interval
         self.__level_list = ["TRACE", "DEBUG", "INFO", "SUCCESS", "WARNING", "ERROR", "CRITICAL"]
+        self.__levels = {name: logger.level(name).no for name in self.__level_list}
         self.__date = pendulum.now()
-        self.__add_log_file(level="DEBUG")
-        logger.remove(0)
-        
-    def __add_log_file(self, level:str = "INFO"):
+        self.__handler = None
+        self.__counters = {}
+        self.__last_flush = time.monotonic()
+        self.__add_log_file(level=level, enqueue=enqueue)
+        # Senza file nessun messaggio viene scritto: tutti i messaggi lazy vengono saltati
+        self.__min_level = self.__levels[level] if self.__handler is not None else self.__levels["CRITICAL"] + 1
+        try:
+            logger.remove(0)
+        except ValueError:
+            # Sink di default già rimosso da un Log precedente
+            pass
+        atexit.register(self.flush_counters)
+
+    def __add_log_file(self, level:str = "INFO", enqueue:bool = False):
         if self.save_file:
             if not os.path.exists(self.dir_path):
                 os.mkdir(self.dir_path)
             file_name = f"{self.__date.year}-{self.__date.month}-{self.__date.day}-{self.__date.hour}-{self.__date.minute}-{self.__date.second}.log"
-            logger.add(f"{self.dir_path}/{file_name}", format="{time} {level} {message}", level=level)
+            self.__handler = logger.add(f"{self.dir_path}/{file_name}", format="{time} {level} {message}", level=level, enqueue=enqueue)
 
-    def write_log(self, message:str, level:str = "INFO"):
-        if level not in self.__level_list:
+    def __level_no(self, level:str)->int:
+        no = self.__levels.get(level)
+        if no is None:
             raise ValueError(f"Invalid level: {level}. Level must be one of the following values: {self.__level_list}")
-        logger.log(level, message)
-        
+        return no
+
+    def is_enabled(self, level:str)->bool:
+        return self.__level_no(level) >= self.__min_level
+
+    def write_log(self, message, level:str = "INFO"):
+        # message: stringa oppure funzione che la costruisce, chiamata solo se il messaggio viene scritto
+        if self.__level_no(level) < self.__min_level:
+            return
+        logger.log(level, message() if callable(message) else message)
+
+    def count(self, event:str, level:str = "DEBUG", n:int = 1):
+        # Evento ripetuto: incrementa il contatore, i totali vengono scritti ogni counter_interval secondi
+        if self.__level_no(level) < self.__min_level or n == 0:
+            return
+        key = (event, level)
+        self.__counters[key] = self.__counters.get(key, 0) + n
+        if time.monotonic() - self.__last_flush >= self.counter_interval:
+            self.flush_counters()
+
+    def flush_counters(self):
+        elapsed = time.monotonic() - self.__last_flush
+        for (event, level), n in self.__counters.items():
+            logger.log(level, f"{event}: {n} in {elapsed:.1f} seconds")
+        self.__counters.clear()
+        self.__last_flush = time.monotonic()
+
+    def close(self):
+        # Scrive i contatori e attende che il thread del file abbia scritto tutti i messaggi in coda
+        self.flush_counters()
+        if self.__handler is not None:
+            logger.remove(self.__handler)
+            self.__handler = None
+        self.__min_level = self.__levels["CRITICAL"] + 1
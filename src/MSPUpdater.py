@@ -1,11 +1,15 @@
+import numpy as np
 import pandas as pd
 import re
+from src.ReferenceLoader import ReferenceLoader
 
 class MSPUpdater:
-    def __init__(self, gmo_path, log):
+    def __init__(self, gmo_path, log, loader:ReferenceLoader = None):
         self.gmo_path = gmo_path
         self.log = log
+        self.loader = loader if loader is not None else ReferenceLoader(log)
         self.nomi_non_trovati_registrati = set()
+        self.__indice = None
 
     @staticmethod
     def pulisci_stringa(s):
@@ -15,43 +19,71 @@ class MSPUpdater:
         s = s.upper()
         return s
 
+    # Zero iniziale del numero nei nomi dei campioni (BRCA05 -> BRCA5, HC07 -> HC7)
+    ZERI_INIZIALI = re.compile(r"^(BRCA|HC)0(?=\d)")
+    COLONNA_NOME = "Informazione addizionale: GEN-MOL1"
+    COLONNA_MSP = "Codice Esterno"
+
+    def normalizza_nomi(self, nomi:pd.Series)->pd.Series:
+        # Per le colonne categoriche la regex viene applicata solo alle categorie;
+        # categorie che diventano uguali (BRCA05 e BRCA5) vengono unite rimappando i codici
+        if isinstance(nomi.dtype, pd.CategoricalDtype):
+            nuove = nomi.cat.categories.astype(str).str.replace(self.ZERI_INIZIALI, r"\1", regex=True)
+            categorie = nuove.unique()
+            mappa = np.append(categorie.get_indexer(nuove), -1)
+            return pd.Series(pd.Categorical.from_codes(mappa[nomi.cat.codes.to_numpy()], categories=categorie), index=nomi.index, name=nomi.name)
+        return nomi.str.replace(self.ZERI_INIZIALI, r"\1", regex=True)
+
     def rimuovi_zero_dopo_brca_hc_dataset(self, df):
         # Applica la rimozione degli zeri alla colonna "NAME" del DataFrame
-        #df["NAME"] = df["NAME"].apply(lambda s: re.sub(r'BRCA0(\d)', r'BRCA\1', s) if pd.notna(s) else s)
-        #df["NAME"] = df["NAME"].apply(lambda s: re.sub(r'HC0(\d)', r'HC\1', s) if pd.notna(s) else s)
-        for _,row in df.iterrows():
-            nome = row["NAME"]
-            if nome[2] == 0 and nome[:2] == "HC":
-                nome[2].pop()
-            elif nome[4] == 0 and nome[:4] == "BRCA":
-                nome[4].pop()
-            else:
-                ...
-            row["NAME"] = nome
+        df["NAME"] = self.normalizza_nomi(df["NAME"])
         return df
 
-    def aggiungi_colonna_msp(self, df):
-        # Carica il file GMO come DataFrame
-        origine = pd.read_excel(self.gmo_path, engine="xlrd")
-        origine.iloc[:, 1] = origine.iloc[:, 1].apply(self.pulisci_stringa)
+    def indice_msp(self)->pd.Series:
+        '''
+        Indice nome -> MSP dal file GMO, costruito una sola volta: nomi puliti e senza zeri iniziali come nel dataset,
+        righe senza MSP scartate e un solo MSP per nome (il primo del file)
+        '''
+        if self.__indice is None:
+            origine = self.carica_origine()
+            origine = pd.DataFrame({"NAME": origine[self.COLONNA_NOME], "MSP": origine[self.COLONNA_MSP]}).dropna()
+            origine["NAME"] = self.normalizza_nomi(origine["NAME"].astype(str))
+            conflitti = origine.groupby("NAME")["MSP"].nunique()
+            conflitti = conflitti[conflitti > 1]
+            if len(conflitti) > 0:
+                self.log.write_log(f"{len(conflitti)} nomi con più MSP nel file GMO, usato il primo: {', '.join(conflitti.index[:20])}", level="WARNING")
+            origine = origine.drop_duplicates("NAME", keep="first")
+            self.__indice = pd.Series(origine["MSP"].to_numpy(), index=pd.Index(origine["NAME"].to_numpy()), name="MSP")
+        return self.__indice
 
+    def carica_origine(self):
+        # File GMO con i nomi (COLONNA_NOME) già puliti, dalla cache di ReferenceLoader
+        def normalizza(origine):
+            origine[self.COLONNA_NOME] = origine[self.COLONNA_NOME].apply(self.pulisci_stringa)
+            return origine
+        return self.loader.load(self.gmo_path, "pulisci_stringa", normalizza, engine="xlrd")
+
+    def aggiungi_colonna_msp(self, df):
         # Applica la rimozione degli zeri direttamente al DataFrame del dataset
         df = self.rimuovi_zero_dopo_brca_hc_dataset(df)
 
-        # Esegue il merge tra il DataFrame in input e il DataFrame originale
-        risultati = pd.merge(df, origine, left_on="NAME", right_on="Informazione addizionale: GEN-MOL1", how="left")
+        # Join con l'indice nome -> MSP, per posizione e non per indice
+        indice = self.indice_msp()
+        nomi = df["NAME"]
+        if isinstance(nomi.dtype, pd.CategoricalDtype):
+            # Join sulle sole categorie, esteso alle righe tramite i codici (-1 per i nomi mancanti)
+            msp = pd.Series(nomi.cat.categories.map(indice))
+            df["MSP"] = msp.reindex(nomi.cat.codes.to_numpy()).to_numpy()
+        else:
+            df["MSP"] = nomi.map(indice).to_numpy()
 
-        # Aggiunge la colonna "MSP" al DataFrame in input
-        df["MSP"] = risultati["Codice Esterno"]
+        # Nomi non trovati: un solo avviso riassuntivo con i nomi non ancora segnalati
+        nomi_non_trovati = set(pd.unique(df.loc[df["MSP"].isna(), "NAME"])) - self.nomi_non_trovati_registrati
+        if len(nomi_non_trovati) > 0:
+            self.log.write_log(f"Nomi non trovati: {len(nomi_non_trovati)} ({', '.join(sorted(map(str, nomi_non_trovati)))})", level="WARNING")
+            self.nomi_non_trovati_registrati |= nomi_non_trovati
         df = df.dropna(subset=["MSP"])
 
-        # Identifica i nomi non trovati e registra un avviso nel log
-        nomi_non_trovati = risultati[pd.isna(risultati["Codice Esterno"])]
-        for nome_non_trovato in nomi_non_trovati["NAME"]:
-            if nome_non_trovato not in self.nomi_non_trovati_registrati:
-                self.log.write_log(f"Nome non trovato: {nome_non_trovato}", level="WARNING")
-                self.nomi_non_trovati_registrati.add(nome_non_trovato)
-
         return df  # Restituisci il DataFrame con la colonna "MSP"
 '''
 # Esempio di utilizzo della classe
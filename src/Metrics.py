@@ -0,0 +1,116 @@
+import os, json, time, resource, cProfile, pstats, io
+from contextlib import contextmanager
+import pendulum
+from src.Log import Log
+
+
+class Metrics:
+    '''
+    Metriche di un run della pipeline: tempi per stage (wall e CPU), righe in ingresso e in uscita,
+    contatori (chiamate HTTP, retry, cache hit/miss, byte letti, record letti) e picco di RSS.
+    Alla fine del run write salva un report JSON e un file in formato testo Prometheus.
+    Gli stage indicati in profile vengono eseguiti sotto cProfile, con il profilo salvato in <profile_dir>/<stage>.prof
+    '''
+    PREFIX = "variant_pipeline"
+
+    def __init__(self, log:Log = None, profile:list = None, profile_dir:str = "logs/profiles") -> None:
+        self.__log = log
+        self.profile = set(profile) if profile is not None else set()
+        self.profile_dir = profile_dir
+        self.started = pendulum.now()
+        self.__start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    @staticmethod
+    def peak_rss()->int:
+        # Picco di RSS in byte del processo e dei figli terminati (ru_maxrss è in KiB su Linux)
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return max(self_rss, children_rss) * 1024
+
+    @contextmanager
+    def stage(self, name:str, rows_in:int = None):
+        '''
+        Misura di uno stage: with metrics.stage("annotation", rows_in=len(df)) as stage: ... stage["rows_out"] = len(df)
+        '''
+        record = {"rows_in": rows_in, "rows_out": None}
+        profiler = cProfile.Profile() if name in self.profile else None
+        start, cpu_start = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.__save_profile(name, profiler)
+            record["seconds"] = time.perf_counter() - start
+            record["cpu_seconds"] = time.process_time() - cpu_start
+            record["peak_rss_bytes"] = self.peak_rss()
+            self.stages[name] = record
+            if self.__log is not None:
+                self.__log.write_log(f"Stage {name}: {record['seconds']:.2f} seconds, rows {record['rows_in']} -> {record['rows_out']}", "DEBUG")
+
+    def __save_profile(self, name:str, profiler:cProfile.Profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}.prof")
+        profiler.dump_stats(path)
+        if self.__log is not None:
+            self.__log.write_log(lambda: self.__top_functions(profiler, name, path), "DEBUG")
+
+    @staticmethod
+    def __top_functions(profiler:cProfile.Profile, name:str, path:str, limit:int = 20)->str:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(limit)
+        return f"Profile of stage {name} saved to {path}\n{stream.getvalue()}"
+
+    def inc(self, name:str, n:int = 1):
+        # Contatori cumulativi, es. http_requests, http_retries, cache_hits, cache_misses, bytes_read, records_parsed
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self)->dict:
+        return {
+            "started": self.started.isoformat(),
+            "seconds": time.perf_counter() - self.__start,
+            "peak_rss_bytes": self.peak_rss(),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+    def prometheus(self)->str:
+        # Formato testo di Prometheus (per il node exporter textfile collector o un push gateway)
+        report = self.report()
+        lines = []
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE {self.PREFIX}_{name} {kind}")
+            lines.extend(f"{self.PREFIX}_{name}{labels} {value}" for labels, value in samples)
+
+        metric("run_seconds", "gauge", [("", f"{report['seconds']:.6f}")])
+        metric("peak_rss_bytes", "gauge", [("", report["peak_rss_bytes"])])
+        for field, name in [("seconds", "stage_seconds"), ("cpu_seconds", "stage_cpu_seconds"), ("rows_in", "stage_rows_in"),
+                            ("rows_out", "stage_rows_out"), ("peak_rss_bytes", "stage_peak_rss_bytes")]:
+            samples = [(f'{{stage="{stage}"}}', record[field]) for stage, record in self.stages.items() if record.get(field) is not None]
+            if len(samples) > 0:
+                metric(name, "gauge", samples)
+        for name, value in sorted(self.counters.items()):
+            metric(f"{name}_total", "counter", [("", value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, output_dir:str = "logs/metrics")->str:
+        '''
+        Salva <output_dir>/<data>.json e <output_dir>/metrics.prom (sovrascritto ad ogni run). Ritorna il percorso del JSON
+        '''
+        os.makedirs(output_dir, exist_ok=True)
+        date = self.started
+        json_path = os.path.join(output_dir, f"{date.year}-{date.month}-{date.day}-{date.hour}-{date.minute}-{date.second}.json")
+        with open(json_path, "w") as f:
+            json.dump(self.report(), f, indent=4)
+        # Scrittura atomica: il collector non legge mai un file a metà
+        prom_path = os.path.join(output_dir, "metrics.prom")
+        with open(prom_path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(prom_path + ".tmp", prom_path)
+        if self.__log is not None:
+            self.__log.write_log(f"Metrics saved to {json_path} and {prom_path}", "INFO")
+        return json_path
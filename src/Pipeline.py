@@ -0,0 +1,177 @@
+import os, json, hashlib
+import pandas as pd
+import pendulum
+from src.Log import Log
+from src.utils import file_hash, arrow_compatible, from_arrow
+
+
+class Stage:
+    '''
+    Stage della pipeline: function riceve i DataFrame degli stage in inputs (nello stesso ordine) e ritorna un DataFrame.
+    files: file esterni letti dallo stage (lista o funzione che la ritorna, es. i VCF di una cartella),
+    sources: file sorgente del codice dello stage, config: parametri che cambiano il risultato,
+    outputs: file scritti dallo stage oltre al suo Parquet (es. il CSV finale), lo stage viene rieseguito se mancano.
+    version va incrementata quando cambia il comportamento in modo non coperto da sources
+    '''
+    def __init__(self, name:str, function, inputs:list = None, files = None, sources:list = None, config:dict = None,
+                 outputs:list = None, version:int = 1) -> None:
+        self.name = name
+        self.function = function
+        self.inputs = inputs if inputs is not None else []
+        self.files = files if files is not None else []
+        self.sources = sources if sources is not None else []
+        self.config = config if config is not None else {}
+        self.outputs = outputs if outputs is not None else []
+        self.version = version
+
+    def input_files(self)->list:
+        return list(self.files()) if callable(self.files) else list(self.files)
+
+
+class Pipeline:
+    '''
+    Esecuzione a stage con risultati intermedi in Parquet (<cache_dir>/<stage>.parquet).
+    La chiave di uno stage è l'hash di nome, version, config, hash dei sorgenti, hash dei file esterni
+    e hash dei Parquet degli stage in ingresso: uno stage con la stessa chiave dell'ultimo run non viene rieseguito.
+    Come in IngestCache l'hash di un file esterno viene ricalcolato solo se size o mtime cambiano.
+    Gli stage vanno aggiunti in ordine topologico; run esegue un intervallo di stage e legge gli ingressi precedenti dal disco.
+    '''
+    def __init__(self, log:Log, cache_dir:str = "data/pipeline", metrics = None) -> None:
+        self.__log = log
+        self.__metrics = metrics
+        self.cache_dir = cache_dir
+        self.stages = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.__manifest = {"stages": {}, "files": {}}
+        if os.path.exists(self.__manifest_path):
+            with open(self.__manifest_path) as f:
+                self.__manifest = json.load(f)
+
+    def add(self, stage:Stage)->"Pipeline":
+        if stage.name in self.stages:
+            raise ValueError(f"Stage {stage.name} already defined")
+        for name in stage.inputs:
+            if name not in self.stages:
+                raise ValueError(f"Stage {stage.name}: input {name} must be added before it")
+        self.stages[stage.name] = stage
+        return self
+
+    def names(self)->list:
+        return list(self.stages)
+
+    def select(self, start:str = None, stop:str = None)->list:
+        # Stage da start a stop compresi, nell'ordine di inserimento
+        names = self.names()
+        for name in [start, stop]:
+            if name is not None and name not in self.stages:
+                raise ValueError(f"Unknown stage: {name}. Stages: {names}")
+        first = names.index(start) if start is not None else 0
+        last = names.index(stop) if stop is not None else len(names) - 1
+        if first > last:
+            raise ValueError(f"Stage {start} comes after {stop}")
+        return names[first:last + 1]
+
+    def output_path(self, name:str)->str:
+        return os.path.join(self.cache_dir, f"{name}.parquet")
+
+    def __save_manifest(self):
+        # Scrittura atomica: un run interrotto lascia il manifest precedente
+        with open(self.__manifest_path + ".tmp", "w") as f:
+            json.dump(self.__manifest, f, indent=1, sort_keys=True)
+        os.replace(self.__manifest_path + ".tmp", self.__manifest_path)
+
+    def __file_hash(self, path:str)->str:
+        stat = os.stat(path)
+        entry = self.__manifest["files"].get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            return entry[2]
+        digest = file_hash(path)
+        self.__manifest["files"][path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def key(self, stage:Stage)->str:
+        inputs = {}
+        for name in stage.inputs:
+            entry = self.__manifest["stages"].get(name)
+            inputs[name] = entry["output_hash"] if entry is not None else None
+        content = {
+            "name": stage.name,
+            "version": stage.version,
+            "config": stage.config,
+            "inputs": inputs,
+            "sources": [[path, self.__file_hash(path)] for path in stage.sources],
+            "files": [[path, self.__file_hash(path)] for path in stage.input_files()],
+        }
+        return hashlib.blake2b(json.dumps(content, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+    def is_current(self, stage:Stage, key:str = None)->bool:
+        entry = self.__manifest["stages"].get(stage.name)
+        key = key if key is not None else self.key(stage)
+        return (entry is not None and entry["key"] == key and os.path.exists(self.output_path(stage.name))
+                and all(os.path.exists(path) for path in stage.outputs))
+
+    def load(self, name:str)->pd.DataFrame:
+        path = self.output_path(name)
+        if name not in self.__manifest["stages"] or not os.path.exists(path):
+            raise FileNotFoundError(f"Stage {name} has no saved output in {self.cache_dir}, run it first")
+        # Valori mancanti come NaN e colonne miste (es. MSP numerici e testuali) con i tipi originali
+        return from_arrow(pd.read_parquet(path))
+
+    def __save(self, stage:Stage, key:str, df:pd.DataFrame):
+        path = self.output_path(stage.name)
+        arrow_compatible(df, self.__log).reset_index(drop=True).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.__manifest["stages"][stage.name] = {
+            "key": key,
+            "output_hash": file_hash(path),
+            "rows": int(df.shape[0]),
+            "finished": pendulum.now().isoformat(),
+        }
+        self.__save_manifest()
+
+    def run(self, start:str = None, stop:str = None, force = False)->list:
+        '''
+        Esegue gli stage da start a stop saltando quelli con la stessa chiave dell'ultimo run.
+        force: True per rieseguire tutti gli stage selezionati oppure lista di nomi. Ritorna i nomi degli stage eseguiti
+        '''
+        selected = self.select(start, stop)
+        forced = set(selected) if force is True else set(force or [])
+        frames = {}
+        executed = []
+        for name in selected:
+            stage = self.stages[name]
+            for upstream in stage.inputs:
+                if upstream not in selected and not self.is_current(self.stages[upstream]):
+                    self.__log.write_log(f"Stage {upstream} is outside the selected range and out of date, using its last output", "WARNING")
+
+            key = self.key(stage)
+            if name not in forced and self.is_current(stage, key):
+                self.__log.write_log(f"Stage {name} up to date, skipped", "INFO")
+                if self.__metrics is not None:
+                    self.__metrics.inc("pipeline_stages_skipped")
+                continue
+
+            inputs = []
+            for upstream in stage.inputs:
+                if upstream not in frames:
+                    frames[upstream] = self.load(upstream)
+                inputs.append(frames[upstream])
+            rows_in = sum(df.shape[0] for df in inputs) if len(inputs) > 0 else None
+            self.__log.write_log(f"Running stage {name}", "INFO")
+            if self.__metrics is not None:
+                with self.__metrics.stage(name, rows_in=rows_in) as record:
+                    df = stage.function(*inputs)
+                    record["rows_out"] = df.shape[0]
+                self.__metrics.inc("pipeline_stages_executed")
+            else:
+                df = stage.function(*inputs)
+            self.__save(stage, key, df)
+            frames[name] = df
+            executed.append(name)
+            # In memoria restano solo i risultati che servono agli stage successivi
+            needed = {upstream for later in selected[selected.index(name) + 1:] for upstream in self.stages[later].inputs}
+            frames = {upstream: frame for upstream, frame in frames.items() if upstream in needed}
+        # Hash dei file esterni ricalcolati anche negli stage saltati
+        self.__save_manifest()
+        return executed
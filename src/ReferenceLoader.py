@@ -0,0 +1,78 @@
+import os, json, hashlib
+import pandas as pd
+import pyarrow.feather as feather
+from src.Log import Log
+from src.utils import file_hash, arrow_compatible, from_arrow
+
+
+class ReferenceLoader:
+    '''
+    Cache colonnare (Feather non compresso, letto in memory map) dei fogli Excel di riferimento (GMO, BRCA, HC).
+    Ogni foglio viene convertito una volta con la sua normalizzazione (es. filtro ANNO > 2017, pulizia dei nomi):
+    la cache <nome>.feather è accompagnata da <nome>.json con size, mtime e hash del file di origine.
+    Come in IngestCache il file viene riconvertito solo se size o mtime cambiano e il nuovo hash non coincide.
+    Le colonne con valori di tipi diversi (es. codici MSP numerici e testuali) sono salvate come testo
+    con una colonna <nome>__type che permette di rileggere ogni valore con il suo tipo originale.
+    '''
+    # Da incrementare quando cambia la conversione, invalida tutte le cache
+    VERSION = 3
+
+    def __init__(self, log:Log, cache_dir:str = "data/reference_cache") -> None:
+        self.__log = log
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __cache_path(self, path:str, name:str)->str:
+        # Un file di cache per coppia (file di origine, normalizzazione)
+        digest = hashlib.blake2b(f"{os.path.abspath(path)}|{name}".encode(), digest_size=8).hexdigest()
+        stem = os.path.splitext(os.path.basename(path))[0].replace(" ", "_")
+        return os.path.join(self.cache_dir, f"{stem}-{name}-{digest}")
+
+    def __is_valid(self, path:str, meta_path:str, version:str)->bool:
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("version") != version:
+            return False
+        stat = os.stat(path)
+        if meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime:
+            return True
+        if meta["size"] == stat.st_size and meta["hash"] == file_hash(path):
+            # File toccato ma con lo stesso contenuto: aggiornamento del solo mtime
+            meta["mtime"] = stat.st_mtime
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+            return True
+        return False
+
+    def __to_arrow_compatible(self, df:pd.DataFrame)->pd.DataFrame:
+        # Feather vuole nomi di colonna stringa e colonne di un solo tipo: le colonne miste diventano testo con il tipo a parte
+        df = df.reset_index(drop=True)
+        df.columns = [str(column) for column in df.columns]
+        return arrow_compatible(df, self.__log)
+
+    def load(self, path:str, name:str = "raw", normalize = None, **read_kwargs)->pd.DataFrame:
+        '''
+        DataFrame del foglio Excel path dopo normalize (funzione DataFrame -> DataFrame), dalla cache se valida.
+        name identifica la normalizzazione: va cambiato quando cambia normalize. read_kwargs vanno a pd.read_excel
+        '''
+        cache_path = self.__cache_path(path, name)
+        version = f"{self.VERSION}:{name}:{json.dumps(read_kwargs, sort_keys=True, default=str)}"
+        if self.__is_valid(path, cache_path + ".json", version) and os.path.exists(cache_path + ".feather"):
+            self.__log.write_log(f"Reference {path} loaded from {cache_path}.feather", "DEBUG")
+            return from_arrow(feather.read_table(cache_path + ".feather", memory_map=True).to_pandas())
+
+        self.__log.write_log(f"Converting {path} to {cache_path}.feather", "INFO")
+        stat = os.stat(path)
+        meta = {"version": version, "size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash(path)}
+        df = pd.read_excel(path, **read_kwargs)
+        if normalize is not None:
+            df = normalize(df)
+        df = self.__to_arrow_compatible(df)
+        feather.write_feather(df, cache_path + ".feather", compression="uncompressed")
+        # Il json viene scritto per ultimo: una conversione interrotta non lascia una cache valida
+        with open(cache_path + ".json", "w") as f:
+            json.dump(meta, f)
+        # Stessa lettura della cache, così il risultato non dipende dalla presenza della cache
+        return from_arrow(feather.read_table(cache_path + ".feather", memory_map=True).to_pandas())
@@ -1,18 +1,32 @@
+import numbers
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from src.ReferenceLoader import ReferenceLoader
 
 
 class RisComparator: #TODO cambiare readcsv to readexcel
-    def __init__(self, brca_path, hc_path, log):
+    '''
+    Assegnazione della colonna RIS. ai campioni tramite MSP.
+    Per ogni MSP conta la prima riga dei database BRCA/HC: se RIS. contiene NEG tutte le varianti sono NEG,
+    altrimenti sono NEG tranne quelle il cui hgvsc (parte dopo ":") compare in VARIANTE, che prendono RIS. del database.
+    VARIANTE viene normalizzato una sola volta per MSP (senza spazi e a capo), le righe vengono associate al riferimento
+    con un merge sul codice MSP in forma testuale (msp_key) e confrontate con una sola ricerca vettoriale come sottostringa.
+    '''
+
+    def __init__(self, brca_path, hc_path, log, loader:ReferenceLoader = None):
+        self.__log = log
+        self.__loader = loader if loader is not None else ReferenceLoader(log)
         self.brca_df = self.__load_dataframe(brca_path)
         self.hc_df = self.__load_dataframe(hc_path)
         self._full_df = pd.concat([self.brca_df, self.hc_df])
-        self.__log = log
+        self.__references = None
+        # MSP del dataset assenti dai database e MSP senza nessuna variante riconosciuta, aggiornati da compare_vcf_xlsx
+        self.unmatched_msp = pd.DataFrame(columns=["MSP"])
+        self.unmatched_hgvs = pd.DataFrame(columns=["MSP", "VARIANTE", "HGVS"])
 
     def __load_dataframe(self, path):
-        df = pd.read_excel(path)
-        df = df[df["ANNO"]>2017]
-        return df
+        # Filtro sull'anno applicato una sola volta, nella conversione in cache
+        return self.__loader.load(path, "anno2017", lambda df: df[df["ANNO"]>2017])
 
     def __missing_MSP(self,vcf_df, msp_df, identificativo):
         msp_hc_brca = set(vcf_df["MSP"])
@@ -20,36 +34,71 @@ class RisComparator: #TODO cambiare readcsv to readexcel
         for x in list(msp_hc_brca - msp):
             self.__log.write_log(level="DEBUG",message=f"Nel dataframe {identificativo}, abbiamo un MSP IN più con codice: {x}")
 
+    @staticmethod
+    def msp_key(msp:pd.Series)->pd.Series:
+        '''
+        Codice MSP come testo, per unire colonne MSP di tipo diverso (int64 dei database, int e str del file GMO):
+        1234, 1234.0 e "1234" danno "1234", i valori mancanti restano mancanti
+        '''
+        def key(value):
+            if isinstance(value, numbers.Real) and not isinstance(value, (bool, np.bool_)) and float(value).is_integer():
+                return str(int(value))
+            return str(value).strip()
+        codes, uniques = pd.factorize(msp, use_na_sentinel=True)
+        keys = np.array([key(value) for value in uniques] + [np.nan], dtype=object)
+        return pd.Series(keys[codes], index=msp.index, name="MSP_KEY")
+
+    def references(self)->pd.DataFrame:
+        '''
+        Una riga per MSP (la prima dei database) con MSP_KEY (msp_key), RIS., VARIANTE, NEG (RIS. contiene NEG)
+        e HGVS (VARIANTE senza spazi e a capo, None se mancante)
+        '''
+        if self.__references is None:
+            references = self._full_df[["MSP", "RIS.", "VARIANTE"]].assign(MSP_KEY=lambda df: self.msp_key(df["MSP"]))
+            references = references.dropna(subset=["MSP_KEY"]).drop_duplicates("MSP_KEY", keep="first").reset_index(drop=True)
+            references["NEG"] = references["RIS."].astype(str).str.contains("NEG", regex=False) & references["RIS."].notna()
+            hgvs = references["VARIANTE"].where(references["VARIANTE"].map(lambda value: isinstance(value, str)))
+            references["HGVS"] = hgvs.str.replace(" ", "", regex=False).str.replace("\n", "", regex=False)
+            self.__references = references
+        return self.__references
+
     def compare_vcf_xlsx(self, df:pd.DataFrame):
-        for msp in tqdm(set(df["MSP"])):
-            found = False
-            msp_df = df[df["MSP"] == msp]
-            genes_ris = self._full_df[self._full_df["MSP"] == msp]
-            
-            if genes_ris.empty:
-                self.__log.write_log(level="ERROR",message=f"MSP: {msp}, non trovato")
-                continue
-            
-            if "NEG" in genes_ris["RIS."].values[0]:
-                df.loc[df["MSP"] == msp, "RIS."] = "NEG"
-            else:
-                
-                df.loc[df["MSP"] == msp, "RIS."] = "NEG"
-                hgvs = genes_ris["VARIANTE"].values[0]
-                if isinstance(hgvs, float):
-                    self.__log.write_log(level="ERROR",message=f"MSP: {msp}, HGVS sbagliato: {hgvs}")
-                    continue
-                hgvs = hgvs.replace(" ", "").replace("\n", "")
-                for _, row in msp_df.iterrows():
-                    if isinstance(row["hgvsc"], float):
-                        continue
-
-                    if row["hgvsc"].split(":")[1] in hgvs:
-                        found = True
-                        df.loc[(df["MSP"] == msp) & (df["hgvsc"] == row["hgvsc"]), "RIS."] = genes_ris["RIS."].values[0]
-                
-                if not found:
-                    self.__log.write_log(level="ERROR",message=f"MSP: {msp}, HGVS sbagliato: {hgvs}")
-        
+        references = self.references()
+        keys = self.msp_key(df["MSP"])
+        msps = pd.DataFrame({"MSP": df["MSP"].to_numpy(), "MSP_KEY": keys.to_numpy()}).dropna(subset=["MSP_KEY"]).drop_duplicates("MSP_KEY")
+
+        # Anti-join: MSP del dataset senza riferimento, le loro righe restano senza RIS.
+        known = msps.merge(references[["MSP_KEY"]], on="MSP_KEY", how="left", indicator=True)
+        self.unmatched_msp = known.loc[known["_merge"] == "left_only", ["MSP"]].reset_index(drop=True)
+        for msp in self.unmatched_msp["MSP"]:
+            self.__log.write_log(level="ERROR",message=f"MSP: {msp}, non trovato")
+
+        # Riferimento di ogni riga, allineato alle righe di df
+        rows = keys.reset_index(drop=True).to_frame().merge(references, on="MSP_KEY", how="left", indicator=True)
+        found = (rows["_merge"] == "both").to_numpy()
+        ris = np.full(len(rows), np.nan, dtype=object)
+        ris[found] = "NEG"
+
+        # Parte HGVS di hgvsc, solo per le righe degli MSP non NEG con VARIANTE valida
+        token = np.array([value.split(":", 1)[1] if isinstance(value, str) and ":" in value else None for value in df["hgvsc"]], dtype=object)
+        candidates = found & ~rows["NEG"].eq(True).to_numpy() & rows["HGVS"].notna().to_numpy() & (token != None)
+
+        # Ricerca vettoriale di hgvsc come sottostringa di VARIANTE normalizzato, una volta per coppia distinta
+        index = np.flatnonzero(candidates)
+        pairs = pd.DataFrame({"TOKEN": token[index], "HGVS": rows["HGVS"].to_numpy()[index]})
+        distinct = pairs.drop_duplicates()
+        found = np.char.find(distinct["HGVS"].to_numpy(dtype=str), distinct["TOKEN"].to_numpy(dtype=str)) >= 0
+        matched = found[pairs.groupby(["TOKEN", "HGVS"], sort=False).ngroup().to_numpy()] if len(index) > 0 else np.zeros(0, dtype=bool)
+        ris[index[matched]] = rows["RIS."].to_numpy()[index[matched]]
+        df["RIS."] = ris
+
+        # MSP non NEG per cui nessuna variante è stata riconosciuta (VARIANTE mancante compresa)
+        positive = references[~references["NEG"]]
+        positive = positive[positive["MSP_KEY"].isin(msps["MSP_KEY"])]
+        hit = rows.loc[index[matched], "MSP_KEY"].unique()
+        self.unmatched_hgvs = positive.loc[~positive["MSP_KEY"].isin(hit), ["MSP", "VARIANTE", "HGVS"]].reset_index(drop=True)
+        for msp, variante, hgvs in self.unmatched_hgvs.itertuples(index=False):
+            self.__log.write_log(level="ERROR",message=f"MSP: {msp}, HGVS sbagliato: {hgvs if isinstance(hgvs, str) else variante}")
+        self.__log.write_log(level="INFO",message=f"RIS.: {len(msps)} MSP, {len(self.unmatched_msp)} non trovati, {len(self.unmatched_hgvs)} senza varianti riconosciute, {int(matched.sum())} varianti riconosciute")
+
         return df
-        
\ No newline at end of file
@@ -0,0 +1,331 @@
+import os, json, socket, time, threading, shutil, hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from src.Log import Log
+from src.VariantNormalizer import VariantNormalizer
+from src.utils import arrow_compatible, from_arrow
+
+
+class ShardPlan:
+    '''
+    Partizione deterministica delle varianti distinte in shards gruppi: lo shard dipende solo da cromosoma e hash della variante
+    (pd.util.hash_array usa una chiave fissa, quindi è lo stesso su ogni macchina e ad ogni run).
+    Con block_size l'hash è calcolato su cromosoma e blocco di posizioni (POS // block_size): le varianti vicine
+    finiscono nello stesso shard, ma su un pannello di pochi geni gli shard risultano sbilanciati
+    '''
+    def __init__(self, shards:int, block_size:int = None) -> None:
+        if shards < 1:
+            raise ValueError(f"Invalid number of shards: {shards}")
+        self.shards = shards
+        self.block_size = block_size
+
+    def assign(self, variants:pd.DataFrame)->np.ndarray:
+        key = variants["CHROM"].astype(str) + ":"
+        if self.block_size is not None:
+            key = key + (variants["POS"].astype(np.int64) // self.block_size).astype(str)
+        else:
+            key = key + variants["POS"].astype(str) + ":" + variants["REF"].astype(str) + ":" + variants["ALT"].astype(str)
+            if "END" in variants.columns:
+                key = key + ":" + variants["END"].astype(str)
+        hashes = pd.util.hash_array(key.to_numpy(dtype=object))
+        return (hashes % np.uint64(self.shards)).astype(np.int64)
+
+
+class ShardCoordinator:
+    '''
+    Annotazione a shard coordinata da una cartella condivisa (locale o su un file system di rete), senza altri servizi:
+      plan.json                  piano (id del dataset, numero di shard, block_size), scritto per ultimo da prepare
+      input/shard-NNNNN.parquet  varianti distinte dello shard
+      claims/shard-NNNNN.claim   lock dello shard, creato con O_EXCL e rinnovato dal worker ogni lease / 3 secondi
+      output/shard-NNNNN.parquet annotazioni dello shard, la sua presenza segna lo shard come completato
+      cache/shard-NNNNN.sqlite   segmento di AnnotationCache dello shard, con seed le voci della cache principale già note
+                                 per le sue varianti; checkpoints/shard-NNNNN/ i checkpoint di ripresa
+    Un claim non rinnovato da più di lease secondi (worker terminato) può essere preso da un altro worker,
+    che riprende dai checkpoint dello shard
+    '''
+    def __init__(self, coord_dir:str, log:Log, lease:float = 600) -> None:
+        self.coord_dir = coord_dir
+        self.lease = lease
+        self.__log = log
+        # Varianti annotate in modo diverso da più shard, aggiornato da merge
+        self.conflicts = pd.DataFrame(columns=VariantNormalizer.KEY_COLUMNS + ["SHARD"])
+        for folder in ["input", "claims", "output", "cache", "checkpoints", "logs"]:
+            os.makedirs(os.path.join(coord_dir, folder), exist_ok=True)
+
+    def __path(self, folder:str, shard:int, extension:str = "")->str:
+        return os.path.join(self.coord_dir, folder, f"shard-{shard:05d}{extension}")
+
+    def input_path(self, shard:int)->str:
+        return self.__path("input", shard, ".parquet")
+
+    def output_path(self, shard:int)->str:
+        return self.__path("output", shard, ".parquet")
+
+    def cache_path(self, shard:int)->str:
+        return self.__path("cache", shard, ".sqlite")
+
+    def checkpoint_dir(self, shard:int)->str:
+        return self.__path("checkpoints", shard)
+
+    def __claim_path(self, shard:int)->str:
+        return self.__path("claims", shard, ".claim")
+
+    @staticmethod
+    def __write_parquet(df:pd.DataFrame, path:str):
+        # Scrittura atomica: un worker interrotto non lascia un file a metà
+        arrow_compatible(df).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def variants(df:pd.DataFrame)->pd.DataFrame:
+        # Varianti distinte con chiavi semplici, come in EnsemblAPI.get_api_info_from_df
+        variants = df[VariantNormalizer.key_columns(df)].drop_duplicates()
+        variants = variants.astype({key: object for key in variants.columns if isinstance(variants[key].dtype, pd.CategoricalDtype)})
+        return variants.reset_index(drop=True)
+
+    def plan(self)->dict:
+        path = os.path.join(self.coord_dir, "plan.json")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No shard plan in {self.coord_dir}, run prepare first")
+        with open(path) as f:
+            return json.load(f)
+
+    def prepare(self, df:pd.DataFrame, shards:int, block_size:int = None, reset:bool = False)->dict:
+        '''
+        Divisione delle varianti di df in shards shard. Con lo stesso dataset e gli stessi parametri il piano esistente
+        viene tenuto (gli shard completati non vengono rifatti); un piano diverso richiede reset, che rimuove ingressi,
+        claim, risultati e checkpoint ma tiene i segmenti di cache
+        '''
+        variants = self.variants(df)
+        # Id del piano indipendente dall'ordine delle righe
+        hashes = np.sort(pd.util.hash_pandas_object(variants, index=False).to_numpy())
+        digest = hashlib.blake2b(hashes.tobytes() + f"{shards}:{block_size}".encode(), digest_size=16).hexdigest()
+        plan_path = os.path.join(self.coord_dir, "plan.json")
+        if os.path.exists(plan_path):
+            if self.plan()["id"] == digest:
+                self.__log.write_log(f"Shard plan {digest} already prepared in {self.coord_dir}", "INFO")
+                return self.plan()
+            if not reset:
+                raise RuntimeError(f"{self.coord_dir} contains a different shard plan, prepare it with reset to replace it")
+            self.__log.write_log(f"Replacing the shard plan in {self.coord_dir}", "WARNING")
+            os.remove(plan_path)
+            for folder in ["input", "claims", "output", "checkpoints"]:
+                shutil.rmtree(os.path.join(self.coord_dir, folder))
+                os.makedirs(os.path.join(self.coord_dir, folder))
+
+        assignment = ShardPlan(shards, block_size).assign(variants)
+        sizes = np.bincount(assignment, minlength=shards)
+        for shard in range(shards):
+            # Varianti ordinate per posizione dentro ogni shard
+            self.__write_parquet(variants[assignment == shard].sort_values(["CHROM", "POS"], kind="stable"), self.input_path(shard))
+        plan = {"id": digest, "shards": shards, "block_size": block_size, "variants": int(variants.shape[0]), "sizes": sizes.tolist()}
+        with open(plan_path + ".tmp", "w") as f:
+            json.dump(plan, f, indent=1)
+        os.replace(plan_path + ".tmp", plan_path)
+        self.__log.write_log(f"Prepared {shards} shards of {variants.shape[0]} variants in {self.coord_dir} (sizes {sizes.min()}-{sizes.max()})", "INFO")
+        return plan
+
+    def seed(self, cache)->int:
+        '''
+        Copia nel segmento di ogni shard non completato delle voci di cache (AnnotationCache principale) per le sue varianti:
+        i worker, anche su altre macchine, non richiedono alle API le varianti già annotate. Ritorna il numero di voci copiate
+        '''
+        normalizer = VariantNormalizer(self.__log)
+        copied = 0
+        for shard in range(self.plan()["shards"]):
+            if os.path.exists(self.output_path(shard)):
+                continue
+            variants = self.load_input(shard)
+            if variants.shape[0] > 0:
+                copied += cache.copy_to(self.cache_path(shard), normalizer.normalize(variants)["KEY"].tolist())
+        self.__log.write_log(f"Seeded the shard segments with {copied} cached responses from {cache.path}", "INFO")
+        return copied
+
+    def __try_claim(self, shard:int, worker:str)->bool:
+        path = self.__claim_path(shard)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(path).st_mtime <= self.lease:
+                    return False
+                # Claim scaduto: solo un worker riesce a rinominarlo. Se due worker lo vedono scaduto insieme il secondo può
+                # rinominare il claim appena creato dal primo e lo shard viene annotato due volte: i risultati sono uguali
+                # e vengono scritti in modo atomico, merge segnala comunque le differenze
+                os.rename(path, f"{path}.expired-{worker}")
+            except FileNotFoundError:
+                # Claim rilasciato o preso da un altro worker nel frattempo
+                return False
+            self.__log.write_log(f"Claim of shard {shard} expired, taking it over", "WARNING")
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{worker}\n")
+        return True
+
+    def claim(self, worker:str)->int:
+        # Primo shard non completato e non preso da un worker attivo, None se non ce ne sono
+        for shard in range(self.plan()["shards"]):
+            if os.path.exists(self.output_path(shard)) or not self.__try_claim(shard, worker):
+                continue
+            # Un altro worker può aver completato lo shard tra il controllo e il claim
+            if os.path.exists(self.output_path(shard)):
+                self.release(shard)
+                continue
+            return shard
+        return None
+
+    def heartbeat(self, shard:int):
+        try:
+            os.utime(self.__claim_path(shard))
+        except FileNotFoundError:
+            # Claim già rilasciato
+            pass
+
+    def release(self, shard:int):
+        # Rilascio del claim senza risultato (errore del worker): lo shard torna disponibile
+        try:
+            os.remove(self.__claim_path(shard))
+        except FileNotFoundError:
+            pass
+
+    def load_input(self, shard:int)->pd.DataFrame:
+        return from_arrow(pd.read_parquet(self.input_path(shard)))
+
+    def complete(self, shard:int, annotations:pd.DataFrame):
+        self.__write_parquet(annotations.reset_index(drop=True), self.output_path(shard))
+        self.release(shard)
+
+    def status(self)->dict:
+        shards = self.plan()["shards"]
+        done = [shard for shard in range(shards) if os.path.exists(self.output_path(shard))]
+        claimed = [shard for shard in range(shards) if shard not in done and os.path.exists(self.__claim_path(shard))]
+        return {"shards": shards, "done": len(done), "claimed": len(claimed), "pending": shards - len(done) - len(claimed)}
+
+    def wait(self, poll:float = 10, timeout:float = None)->dict:
+        # Attesa del completamento di tutti gli shard, anche da parte di worker su altre macchine
+        start = time.monotonic()
+        status = self.status()
+        while status["done"] < status["shards"]:
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"Shards not completed after {timeout} seconds: {status}")
+            self.__log.write_log(lambda: f"Waiting for shards: {status}", "DEBUG")
+            time.sleep(poll)
+            status = self.status()
+        return status
+
+    def merge(self, df:pd.DataFrame, cache = None)->pd.DataFrame:
+        '''
+        Unione dei risultati degli shard con df. Una variante presente in più shard (piano cambiato, shard rifatti a mano)
+        tiene la riga dello shard con numero più basso; se le annotazioni differiscono finisce in conflicts.
+        Con cache (AnnotationCache) vi vengono copiati anche i segmenti di cache degli shard
+        '''
+        from src.EnsemblAPI import EnsemblAPI
+        shards = self.plan()["shards"]
+        missing = [shard for shard in range(shards) if not os.path.exists(self.output_path(shard))]
+        if len(missing) > 0:
+            raise RuntimeError(f"Shards not completed: {missing}")
+        parts = [from_arrow(pd.read_parquet(self.output_path(shard))).assign(SHARD=shard) for shard in range(shards)]
+        annotations = pd.concat(parts, ignore_index=True)
+        keys = VariantNormalizer.key_columns(annotations)
+
+        repeated = annotations[annotations.duplicated(keys, keep=False)]
+        if repeated.shape[0] > 0:
+            # Righe diverse per la stessa variante: le varianti con più di una versione distinta sono in conflitto
+            versions = repeated.drop(columns="SHARD").drop_duplicates()
+            conflicting = versions[versions.duplicated(keys, keep=False)][keys].drop_duplicates()
+            self.conflicts = repeated.merge(conflicting, on=keys).sort_values(keys + ["SHARD"]).reset_index(drop=True)
+            self.__log.write_log(f"{repeated[keys].drop_duplicates().shape[0]} variants found in more than one shard, "
+                                 f"{conflicting.shape[0]} with different annotations", "WARNING" if conflicting.shape[0] > 0 else "DEBUG")
+            annotations = annotations.drop_duplicates(keys, keep="first")
+        else:
+            self.conflicts = pd.DataFrame(columns=keys + ["SHARD"])
+        annotations = annotations.drop(columns="SHARD")
+
+        variants = self.variants(df)
+        absent = variants.shape[0] - variants.merge(annotations[keys].astype({key: variants[key].dtype for key in keys}), on=keys).shape[0]
+        if absent > 0:
+            self.__log.write_log(f"{absent} variants of the dataset are not in the shard results", "WARNING")
+
+        if cache is not None:
+            copied = sum(cache.merge_from(self.cache_path(shard)) for shard in range(shards) if os.path.exists(self.cache_path(shard)))
+            self.__log.write_log(f"Copied {copied} cached responses from the shard segments into {cache.path}", "INFO")
+        return EnsemblAPI.merge_annotations(df, annotations)
+
+
+def run_worker(coord_dir:str, worker:str = None, options:dict = None)->int:
+    '''
+    Worker di annotazione: prende shard dalla cartella di coordinamento finché ce ne sono e ritorna quanti ne ha completati.
+    Ogni worker ha il suo log (logs/<worker>) e le sue metriche (metrics/<worker>).
+    options: concurrency, rate, chain (file per il liftover locale), checkpoint_every, lease,
+    backend e archive (modalità di EnsemblBackend; in registrazione {worker} nel percorso dà un archivio per worker)
+    '''
+    from src.EnsemblAPI import EnsemblAPI
+    from src.EnsemblBackend import EnsemblBackend
+    from src.Liftover import Liftover
+    from src.Metrics import Metrics
+    worker = worker if worker is not None else f"{socket.gethostname()}-{os.getpid()}"
+    options = options if options is not None else {}
+    os.makedirs(os.path.join(coord_dir, "logs"), exist_ok=True)
+    log = Log(dir_path=os.path.join(coord_dir, "logs", worker))
+    metrics = Metrics(log)
+    coordinator = ShardCoordinator(coord_dir, log, lease=options.get("lease", 600))
+    api = None
+    completed = 0
+    try:
+        while True:
+            shard = coordinator.claim(worker)
+            if shard is None:
+                break
+            if api is None:
+                chain = options.get("chain")
+                liftover = Liftover(chain, log) if chain is not None and os.path.exists(chain) else None
+                archive = options.get("archive")
+                backend = EnsemblBackend(log, options.get("backend", "live"), archive.replace("{worker}", worker) if archive is not None else None)
+                api = EnsemblAPI(log, concurrency=options.get("concurrency", 10), rate=options.get("rate", 15), liftover=liftover,
+                                 backend=backend, metrics=metrics)
+            # Rinnovo del claim mentre lo shard viene annotato
+            stop = threading.Event()
+            def heartbeat():
+                while not stop.wait(coordinator.lease / 3):
+                    coordinator.heartbeat(shard)
+            thread = threading.Thread(target=heartbeat, daemon=True)
+            thread.start()
+            try:
+                log.write_log(f"Worker {worker} annotating shard {shard}", "INFO")
+                with metrics.stage(f"shard-{shard:05d}") as stage:
+                    variants = coordinator.load_input(shard)
+                    stage["rows_in"] = variants.shape[0]
+                    annotations = api.get_api_info_from_df(variants, path_cache=coordinator.cache_path(shard),
+                                                           checkpoint_dir=coordinator.checkpoint_dir(shard),
+                                                           checkpoint_every=options.get("checkpoint_every", 1000), resume=True, path_csv=None)
+                    stage["rows_out"] = annotations.shape[0]
+                coordinator.complete(shard, annotations)
+                completed += 1
+            except BaseException:
+                coordinator.release(shard)
+                raise
+            finally:
+                stop.set()
+                thread.join()
+    finally:
+        if api is not None:
+            api.close()
+        metrics.write(os.path.join(coord_dir, "metrics", worker))
+        log.close()
+    return completed
+
+
+def run_local(coord_dir:str, workers:int, options:dict = None)->int:
+    '''
+    workers processi worker sulla macchina locale (spawn: ogni processo ha il suo log e le sue connessioni).
+    Ritorna il numero di shard completati
+    '''
+    host = socket.gethostname()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(run_worker, coord_dir, f"{host}-local{i}", options) for i in range(workers)]
+        return sum(future.result() for future in futures)
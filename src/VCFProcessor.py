@@ -1,129 +1,365 @@
 
 
 import os
-import allel
+import shutil
 import pandas as pd
 from tqdm import tqdm
 import time
 import numpy as np
+import pyarrow.dataset as ds
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from src.VCFReader import VCFReader
+from src.GeneIndex import GeneIndex
+from src.IngestCache import IngestCache
+from src.DuplicatePolicy import DuplicatePolicy, MostRecordsPolicy
 
 class VCFProcessor:
-    def __init__(self, log):
+    # Colonne del dataset pulito e campi del VCF da cui derivano: gli altri campi non vengono mai decodificati
+    COLUMNS_TO_KEEP = ["CHROM", "POS", "REF", "ALT", "END", "AF", "GENEINFO", "NAME", "TISSUE", "CTYPE", "GT"]
+    READ_FIELDS = ["CHROM", "POS", "REF", "ALT", "END", "AF", "GENEINFO", "GT"]
+
+    def __init__(self, log, fields=None, region_bed=None, cache_dir=None, duplicate_policy:DuplicatePolicy = None, metrics=None):
+        '''
+        fields: campi del VCF da leggere, "*" per tutti (default READ_FIELDS)
+        region_bed: BED delle regioni del pannello (es. data/HCS_region_map.bed) per scartare i record fuori regione
+        cache_dir: cartella della cache incrementale (IngestCache), vengono letti solo i file nuovi o modificati
+        duplicate_policy: scelta tra i file con lo stesso campione (default MostRecordsPolicy, vedi src/DuplicatePolicy.py)
+        metrics: Metrics opzionale per file e byte letti, record letti e file presi dalla cache
+        '''
         self.log = log
         self.identifier_set = set()
         #self.cleaner = DataCleaner(log)
         self.duplicated_files = []
+        fields = fields if fields is not None else self.READ_FIELDS
+        regions = GeneIndex(region_bed, log).intervals() if region_bed is not None else None
+        self.reader = VCFReader(None if fields == "*" else fields, regions)
+        self.cache_dir = cache_dir
+        self.duplicate_policy = duplicate_policy if duplicate_policy is not None else MostRecordsPolicy()
+        self.metrics = metrics
 
     @staticmethod
     def should_process_file(file_name, exclude_patterns):
-        result = file_name.endswith(".vcf") and not any(x in file_name.upper() for x in exclude_patterns)
+        result = (file_name.endswith(".vcf") or file_name.endswith(".vcf.gz")) and not any(x in file_name.upper() for x in exclude_patterns)
         return result
 
     @staticmethod
     def extract_identifier(vcf_file):
-        with open(vcf_file, 'r') as f:
-            for line in f:
-                if line.startswith("#CHROM"):
-                    identifier = line.strip().split('\t')[-1]
-                    if "full_variant" in vcf_file.lower() or "full-variant" in vcf_file.lower():
-                        identifier = identifier.split('_')[1]
-                    try:
-                        identifier = identifier.split('_')[0]
-                        identifier = identifier.replace("-", "/")
-                        if (identifier.startswith("BRCA") and identifier[4] == "/") or (identifier.startswith("HC") and identifier[2] == "/"):
-                            identifier = identifier.replace("/", "", 1)
-
-                        sub_identifier = identifier.split("/")
-                        sub_identifier[1] = sub_identifier[1][:2]
-                        identifier = sub_identifier[0] + "/" + sub_identifier[1]
-
-                    except Exception as e:
-                        pass
-
-                    return identifier
-        return None
+        with VCFReader.open(vcf_file) as f:
+            header = VCFReader().read_header(f)
+        return VCFReader.parse_identifier(header["sample"], vcf_file) if header is not None else None
 
-    def process_vcf_file(self, vcf_file):
+    @staticmethod
+    def is_excluded_sample(vcf_file, identifier):
+        # Campioni FC: nome del campione, del file o della cartella
+        splitted_path = vcf_file.split(os.sep)
+        return identifier.upper().startswith("FC") or splitted_path[-1].upper().startswith("FC") or splitted_path[-2].upper().startswith("FC")
+
+    @staticmethod
+    def add_file_columns(temp_df, vcf_file, identifier, messages):
+        '''
+        Colonne NAME, TISSUE e CTYPE ricavate dal campione e dal percorso del file
+        '''
         splitted_path = vcf_file.split(os.sep)
         origin_folder = splitted_path[-2].upper()
-        identifier = self.extract_identifier(vcf_file)
-        
-        if identifier is None:
-            if self.log is not None: self.log.write_log(f"Unable to extract identifier from {vcf_file}", level="ERROR")
-            return None
+        temp_df['NAME'] = identifier
+        if origin_folder == "HC" or origin_folder == "GERMLINE":
+            temp_df["TISSUE"] = "GERMLINE"
+        elif origin_folder == "SOMATIC":
+            temp_df["TISSUE"] = "SOMATIC"
+        else:
+            temp_df["TISSUE"] = "UNKNOWN"
 
-        if identifier in self.identifier_set:
-            if self.log is not None: self.log.write_log(f"Duplicate identifier found: {identifier}, File path: {vcf_file}", level="WARNING")
-            self.duplicated_files.append(vcf_file)
-            return None
+        if "BRCA" in splitted_path[-1].upper() and "HC" not in splitted_path[-1].upper():
+            temp_df["CTYPE"] = "BRCA"
 
-        self.identifier_set.add(identifier)
-        if not identifier.upper().startswith("FC") and not splitted_path[-1].upper().startswith("FC") and not splitted_path[-2].upper().startswith("FC"):
-            temp_df = allel.vcf_to_dataframe(vcf_file, fields='*', alt_number=1)
-            if temp_df is not None:
-                temp_df['NAME'] = identifier
-                if origin_folder == "HC" or origin_folder == "GERMLINE":
-                    temp_df["TISSUE"] = "GERMLINE"
-                elif origin_folder == "SOMATIC":
-                    temp_df["TISSUE"] = "SOMATIC"
-                else:
-                    temp_df["TISSUE"] = "UNKNOWN"
-
-                if "BRCA" in splitted_path[-1].upper() and "HC" not in splitted_path[-1].upper():
-                    temp_df["CTYPE"] = "BRCA"
-
-                elif "HC" in splitted_path[-1].upper() and "BRCA" not in splitted_path[-1].upper():
-                    temp_df["CTYPE"] = "HC"
-                elif "HC" in splitted_path[-1].upper() and "BRCA" in splitted_path[-1].upper():
-                    if splitted_path[-1].upper().index("BRCA") < splitted_path[-1].upper().index("HC"):
-                        temp_df["CTYPE"] = "BRCA"
-                        if self.log is not None: self.log.write_log(f"found both so choosing BRCA {vcf_file}", level="DEBUG")
-                    else:
-                        temp_df["CTYPE"] = "HC"
-                        if self.log is not None: self.log.write_log(f"found both so choosing HC {vcf_file}", level="DEBUG")
-                else:
-                    temp_df["CTYPE"] = np.nan
-                    if self.log is not None: self.log.write_log(f"Unable to extract CTYPE from {vcf_file}", level="WARNING")
-                
-                with open(vcf_file, 'r') as f:
-                    index = 0
-                    for line in f.readlines():
-                        if not line.startswith("#"):
-                            try:
-                                gt = line.split('GT:')[1].split('/')
-                                gt1 = gt[0][-1]
-                                gt2 = gt[1][0]
-                                temp_df.loc[index, "GT"] = f"{gt1}/{gt2}"
-                                index += 1
-                            except Exception as e:
-                                if self.log is not None: self.log.write_log(f"Unable to extract GT from {vcf_file}", level="WARNING")
-                                temp_df.loc[index, "GT"] = np.nan
-                return temp_df
+        elif "HC" in splitted_path[-1].upper() and "BRCA" not in splitted_path[-1].upper():
+            temp_df["CTYPE"] = "HC"
+        elif "HC" in splitted_path[-1].upper() and "BRCA" in splitted_path[-1].upper():
+            if splitted_path[-1].upper().index("BRCA") < splitted_path[-1].upper().index("HC"):
+                temp_df["CTYPE"] = "BRCA"
+                messages.append(("DEBUG", f"found both so choosing BRCA {vcf_file}"))
+            else:
+                temp_df["CTYPE"] = "HC"
+                messages.append(("DEBUG", f"found both so choosing HC {vcf_file}"))
         else:
+            temp_df["CTYPE"] = np.nan
+            messages.append(("WARNING", f"Unable to extract CTYPE from {vcf_file}"))
+
+        if "GT" in temp_df.columns:
+            temp_df["GT"] = temp_df.pop("GT")
+            missing_gt = int(temp_df["GT"].isna().sum())
+            if missing_gt > 0:
+                messages.append(("WARNING", f"Unable to extract GT for {missing_gt} records from {vcf_file}"))
+        return temp_df
+
+    @staticmethod
+    def parse_vcf_file(vcf_file, identifier, reader):
+        '''
+        Parsing di un singolo VCF, eseguibile in un processo separato.
+        Ritorna (DataFrame o None, messaggi [(level, message)], secondi, pid): i messaggi vengono scritti nel Log dal processo principale
+        '''
+        start_time = time.time()
+        messages = []
+        temp_df = None
+        if not VCFProcessor.is_excluded_sample(vcf_file, identifier):
+            _, temp_df = reader.read(vcf_file)
+            if temp_df is not None:
+                temp_df = VCFProcessor.add_file_columns(temp_df, vcf_file, identifier, messages)
+        return temp_df, messages, time.time() - start_time, os.getpid()
+
+    @staticmethod
+    def _parse_vcf_task(vcf_file, identifier, reader):
+        # Gli errori di un file non interrompono il pool, vengono riportati come messaggi
+        try:
+            return VCFProcessor.parse_vcf_file(vcf_file, identifier, reader)
+        except Exception as e:
+            return None, [("ERROR", f"Unable to parse {vcf_file}: {type(e).__name__}: {e}")], 0.0, os.getpid()
+
+    @staticmethod
+    def _scan_task(vcf_file):
+        # Identificativo, numero di record e mtime senza parsing, usati per risolvere i duplicati
+        try:
+            identifier, records = VCFReader.scan(vcf_file)
+            return identifier, records, os.stat(vcf_file).st_mtime, []
+        except Exception as e:
+            return None, 0, 0.0, [("ERROR", f"Unable to scan {vcf_file}: {type(e).__name__}: {e}")]
+
+    @staticmethod
+    def _ingest_task(vcf_file, reader, part_path):
+        '''
+        Lettura di un VCF per la cache incrementale: identificativo e record in un passaggio, record salvati in part_path.
+        Ritorna (fingerprint del file, identificativo, numero di record, messaggi, secondi, pid), fingerprint None in caso di errore
+        '''
+        start_time = time.time()
+        messages = []
+        try:
+            fingerprint = IngestCache.fingerprint_file(vcf_file)
+            identifier, temp_df = reader.read(vcf_file, lambda identifier: not VCFProcessor.is_excluded_sample(vcf_file, identifier))
+            records = 0
+            if temp_df is not None:
+                temp_df = VCFProcessor.add_file_columns(temp_df, vcf_file, identifier, messages)
+                temp_df.to_parquet(part_path, index=False)
+                records = temp_df.shape[0]
+            elif os.path.exists(part_path):
+                os.remove(part_path)
+            return fingerprint, identifier, records, messages, time.time() - start_time, os.getpid()
+        except Exception as e:
+            return None, None, 0, [("ERROR", f"Unable to parse {vcf_file}: {type(e).__name__}: {e}")], time.time() - start_time, os.getpid()
+
+    def __write_messages(self, messages):
+        if self.log is not None:
+            for level, message in messages:
+                self.log.write_log(message, level=level)
+
+    def process_vcf_file(self, vcf_file):
+        # Identificativo, record e GT letti dallo stesso stream, i record dei duplicati non vengono letti
+        def accept(identifier):
+            if identifier in self.identifier_set:
+                if self.log is not None: self.log.write_log(f"Duplicate identifier found: {identifier}, File path: {vcf_file}", level="WARNING")
+                self.duplicated_files.append(vcf_file)
+                return False
+            self.identifier_set.add(identifier)
+            return not self.is_excluded_sample(vcf_file, identifier)
+
+        identifier, temp_df = self.reader.read(vcf_file, accept)
+        if identifier is None:
+            if self.log is not None: self.log.write_log(f"Unable to extract identifier from {vcf_file}", level="ERROR")
             return None
+        if temp_df is None:
+            return None
+        messages = []
+        temp_df = self.add_file_columns(temp_df, vcf_file, identifier, messages)
+        self.__write_messages(messages)
+        return temp_df
 
-    def get_dataframe(self, path="Data/VCF", exclude_patterns=None):
+    def list_vcf_files(self, path="Data/VCF", exclude_patterns=None):
+        # File da processare in ordine di percorso, così il risultato non dipende dall'ordine di os.walk
         if exclude_patterns is None:
             exclude_patterns = ["POS", "NEG", "PROVA", "VEQ", "EM", "CTRL","DB","DM"]
-        
         data_folder = os.path.join(os.getcwd(), path)
-        df_list = []
-
+        vcf_files = []
         for root, dirs, files in os.walk(data_folder):
-            print(f"Processing: {root}")
-            if self.log is not None: self.log.write_log(f"Starting processing directory {root}", level="INFO")
-            start_time = time.time()
+            vcf_files.extend(os.path.join(root, file) for file in files if self.should_process_file(file, exclude_patterns))
+        return sorted(vcf_files)
+
+    def __map(self, function, iterables, workers, chunksize, description):
+        # Esecuzione nel pool di processi (o in serie con un solo worker), i risultati tornano nell'ordine di input
+        if workers <= 1:
+            return list(tqdm(map(function, *iterables), total=len(iterables[0]), desc=description, leave=False))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(tqdm(executor.map(function, *iterables, chunksize=chunksize), total=len(iterables[0]), desc=description, leave=False))
+
+    def __imap(self, function, iterables, workers, chunksize, description):
+        '''
+        Come __map ma un risultato alla volta: i task vengono inviati ai worker a gruppi di chunksize
+        e al massimo 2 * workers gruppi sono in volo, così i DataFrame già letti ma non ancora consumati restano pochi
+        '''
+        tasks = list(zip(*iterables))
+        progress = tqdm(total=len(tasks), desc=description, leave=False)
+        if workers <= 1:
+            for task in tasks:
+                yield function(*task)
+                progress.update()
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for start in range(0, len(tasks), chunksize):
+                    pending.append(executor.submit(self._chunk_task, function, tasks[start:start + chunksize]))
+                    if len(pending) >= 2 * workers:
+                        for result in pending.popleft().result():
+                            yield result
+                            progress.update()
+                while len(pending) > 0:
+                    for result in pending.popleft().result():
+                        yield result
+                        progress.update()
+        progress.close()
+
+    @staticmethod
+    def _chunk_task(function, tasks):
+        # Gruppo di task eseguito da un worker con un solo invio al pool
+        return [function(*task) for task in tasks]
+
+    @staticmethod
+    def __pool_size(tasks, workers, chunksize):
+        workers = workers if workers is not None else os.cpu_count() or 1
+        workers = max(1, min(workers, tasks))
+        chunksize = chunksize if chunksize is not None else max(1, tasks // (workers * 4))
+        return workers, chunksize
+
+    def resolve_duplicates(self, candidates):
+        '''
+        Risoluzione dei campioni duplicati prima del parsing.
+        candidates: dict con path, identifier, records e mtime nell'ordine dei file; i campioni esclusi (FC) contano 0 record.
+        Per ogni identificativo duplicate_policy sceglie un file, gli altri finiscono in duplicated_files.
+        Ritorna i candidati scelti nell'ordine della prima occorrenza di ogni identificativo
+        '''
+        groups = {}
+        for order, candidate in enumerate(candidates):
+            if candidate["identifier"] is None:
+                if self.log is not None: self.log.write_log(f"Unable to extract identifier from {candidate['path']}", level="ERROR")
+                continue
+            candidate["order"] = order
+            if candidate["identifier"] in groups:
+                if self.log is not None: self.log.write_log(f"Duplicate identifier found: {candidate['identifier']}, File path: {candidate['path']}", level="WARNING")
+            groups.setdefault(candidate["identifier"], []).append(candidate)
+
+        chosen = []
+        for identifier, group in groups.items():
+            self.identifier_set.add(identifier)
+            winner = self.duplicate_policy.choose(group) if len(group) > 1 else group[0]
+            self.duplicated_files.extend(candidate["path"] for candidate in group if candidate is not winner)
+            if winner is not group[0] and self.log is not None:
+                self.log.write_log(f"Replaced {identifier} with {winner['path']}", level="DEBUG")
+            chosen.append(winner)
+        return chosen
+
+    def read_vcf_files(self, vcf_files, workers=None, chunksize=None):
+        '''
+        Lettura parallela dei VCF in un pool di processi.
+        Una scansione leggera (VCFReader.scan) ricava identificativo e numero di record di ogni file,
+        i duplicati vengono risolti da duplicate_policy e solo i file scelti vengono letti,
+        quindi il risultato non dipende dall'ordine di completamento.
+        chunksize: file per task inviato al pool, sia nella scansione sia nella lettura (di default 1 file per task nella lettura)
+        Ritorna la lista dei DataFrame nell'ordine della prima occorrenza di ogni campione
+        '''
+        return list(self.iter_vcf_files(vcf_files, workers, chunksize))
+
+    def iter_vcf_files(self, vcf_files, workers=None, chunksize=None):
+        # Come read_vcf_files, un DataFrame alla volta
+
+        scan_workers, scan_chunksize = self.__pool_size(len(vcf_files), workers, chunksize)
+        scans = self.__map(self._scan_task, [vcf_files], scan_workers, scan_chunksize, "Scan")
+        candidates = []
+        for vcf_file, (identifier, records, mtime, messages) in zip(vcf_files, scans):
+            self.__write_messages(messages)
+            if identifier is not None and self.is_excluded_sample(vcf_file, identifier):
+                records = 0
+            candidates.append({"path": vcf_file, "identifier": identifier, "records": records, "mtime": mtime})
+        selected = [candidate for candidate in self.resolve_duplicates(candidates) if candidate["records"] > 0]
+
+        # Lettura in streaming: senza chunksize un file per task, così in memoria restano al più 2 * workers DataFrame
+        workers, chunksize = self.__pool_size(len(selected), workers, chunksize if chunksize is not None else 1)
+        results = self.__imap(self._parse_vcf_task, [[c["path"] for c in selected], [c["identifier"] for c in selected], [self.reader] * len(selected)], workers, chunksize, "VCF")
+        worker_stats = {}
+        for candidate, (temp_df, messages, elapsed, pid) in zip(selected, results):
+            self.__write_messages(messages)
+            self.__add_worker_stats(worker_stats, pid, temp_df.shape[0] if temp_df is not None else 0, elapsed, messages)
+            self.__add_metrics(candidate["path"], temp_df.shape[0] if temp_df is not None else 0)
+            if temp_df is not None:
+                yield temp_df
+        self.__log_worker_stats(worker_stats)
+
+    @staticmethod
+    def __add_worker_stats(worker_stats, pid, records, elapsed, messages):
+        files, rows, seconds, errors = worker_stats.get(pid, (0, 0, 0.0, 0))
+        worker_stats[pid] = (files + 1, rows + records, seconds + elapsed, errors + sum(1 for level, _ in messages if level == "ERROR"))
+
+    def __add_metrics(self, vcf_file, records):
+        if self.metrics is not None:
+            self.metrics.inc("vcf_files_parsed")
+            self.metrics.inc("vcf_bytes_read", os.path.getsize(vcf_file))
+            self.metrics.inc("vcf_records_parsed", records)
+
+    def __log_worker_stats(self, worker_stats):
+        if self.log is not None:
+            for pid, (files, rows, seconds, errors) in sorted(worker_stats.items()):
+                self.log.write_log(f"Worker {pid}: {files} files, {rows} rows, {seconds:.2f} seconds, {errors} errors", level="DEBUG")
+
+    def read_vcf_files_cached(self, vcf_files, workers=None, chunksize=None, rebuild=False):
+        '''
+        Lettura incrementale dei VCF tramite IngestCache: vengono letti (in parallelo) solo i file nuovi o modificati,
+        i duplicati sono risolti da duplicate_policy con il numero di record e l'mtime del manifest, senza rileggere i file.
+        Ritorna la lista dei DataFrame nell'ordine della prima occorrenza di ogni campione
+        '''
+        return list(self.iter_vcf_files_cached(vcf_files, workers, chunksize, rebuild))
 
-            for file in tqdm(files, leave=False):
-                if self.should_process_file(file, exclude_patterns):
-                    vcf_file = os.path.join(root, file)
-                    df_processed = self.process_vcf_file(vcf_file)
-                    if df_processed is not None:
-                        df_list.append(df_processed)
+    def iter_vcf_files_cached(self, vcf_files, workers=None, chunksize=None, rebuild=False):
+        # Come read_vcf_files_cached, i part vengono caricati uno alla volta
+        cache = IngestCache(self.cache_dir, self.log, self.reader.fingerprint())
+        if rebuild:
+            if self.log is not None: self.log.write_log(f"Rebuilding the ingestion cache in {self.cache_dir}", level="INFO")
+            cache.clear()
+        cache.prune(vcf_files)
+        changed = cache.changed(vcf_files)
+        if self.log is not None: self.log.write_log(f"{len(changed)} new or changed files, {len(vcf_files) - len(changed)} from cache", level="INFO")
 
-            if self.log is not None: self.log.write_log(f"Finished processing directory {root}", level="SUCCESS")
-            if self.log is not None: self.log.write_log(f"Processing time: {time.time() - start_time} seconds", level="DEBUG")
-            print("Done!\n")
+        if len(changed) > 0:
+            workers, chunksize = self.__pool_size(len(changed), workers, chunksize)
+            results = self.__map(self._ingest_task, [changed, [self.reader] * len(changed), [cache.part_path(f) for f in changed]], workers, chunksize, "VCF")
+            worker_stats = {}
+            for vcf_file, (fingerprint, identifier, records, messages, elapsed, pid) in zip(changed, results):
+                self.__write_messages(messages)
+                self.__add_worker_stats(worker_stats, pid, records, elapsed, messages)
+                self.__add_metrics(vcf_file, records)
+                # I file in errore restano fuori dal manifest e vengono riletti al prossimo run
+                if fingerprint is not None:
+                    cache.update(vcf_file, fingerprint, identifier, records)
+            cache.commit()
+            self.__log_worker_stats(worker_stats)
+
+        # I campioni esclusi non hanno part e risultano con 0 record
+        candidates = [{"path": path, "identifier": identifier, "records": records, "mtime": mtime} for path, identifier, records, mtime in cache.entries(vcf_files)]
+        try:
+            if self.metrics is not None:
+                self.metrics.inc("vcf_files_cached", len(vcf_files) - len(changed))
+            for candidate in self.resolve_duplicates(candidates):
+                if candidate["records"] > 0:
+                    yield cache.load(candidate["path"])
+        finally:
+            cache.close()
+
+    def get_dataframe(self, path="Data/VCF", exclude_patterns=None, workers=None, chunksize=None, rebuild=False):
+        vcf_files = self.list_vcf_files(path, exclude_patterns)
+        if self.log is not None: self.log.write_log(f"Starting processing {len(vcf_files)} files in {path}", level="INFO")
+        start_time = time.time()
+        if self.cache_dir is not None:
+            df_list = self.read_vcf_files_cached(vcf_files, workers, chunksize, rebuild)
+        else:
+            df_list = self.read_vcf_files(vcf_files, workers, chunksize)
+        if self.log is not None: self.log.write_log(f"Finished processing {path}", level="SUCCESS")
+        if self.log is not None: self.log.write_log(f"Processing time: {time.time() - start_time} seconds", level="DEBUG")
 
         df = pd.concat(df_list, ignore_index=True)
         df["GENEINFO"] = df["GENEINFO"].apply(lambda x: x.split(":")[0] if pd.notnull(x) else x)
@@ -131,11 +367,70 @@ class VCFProcessor:
         if self.log is not None: self.log.write_log(f"Found {len(self.duplicated_files)} duplicates", level="WARNING")
         self.log.write_log(f"Dataset grezzo: {df.shape}", level="SUCCESS")
         cleaner = DataCleaner(self.log)
-        cleaned_df = cleaner.clean_dataframe(df, columns_to_keep=["CHROM", "POS", "REF", "ALT", "AF", "GENEINFO", "NAME", "TISSUE", "CTYPE","GT"], duplicated_files=self.duplicated_files)
+        cleaned_df = cleaner.clean_dataframe(df, columns_to_keep=self.COLUMNS_TO_KEEP)
         self.log.write_log(f"Dataset pulito: {cleaned_df.shape}", level="SUCCESS")
         return cleaned_df
 
 
+    @staticmethod
+    def rebatch(frames, batch_size):
+        # DataFrame dei file raggruppati in batch di circa batch_size righe, i file più grandi vengono spezzati
+        buffer, rows = [], 0
+        for frame in frames:
+            buffer.append(frame)
+            rows += frame.shape[0]
+            if rows >= batch_size:
+                batch = pd.concat(buffer, ignore_index=True)
+                for start in range(0, batch.shape[0] - batch_size + 1, batch_size):
+                    yield batch.iloc[start:start + batch_size].reset_index(drop=True)
+                buffer = [batch.iloc[batch.shape[0] - batch.shape[0] % batch_size:]]
+                rows = buffer[0].shape[0]
+        if rows > 0:
+            yield pd.concat(buffer, ignore_index=True)
+
+    def iter_batches(self, path="Data/VCF", exclude_patterns=None, workers=None, chunksize=None, rebuild=False, batch_size=100000):
+        '''
+        Ingestione in streaming: file -> batch -> pulizia, normalizzazione di CHROM e GENEINFO -> schema.
+        In memoria restano solo i file in lettura e il batch corrente, mai l'intera coorte
+        '''
+        vcf_files = self.list_vcf_files(path, exclude_patterns)
+        if self.log is not None: self.log.write_log(f"Streaming {len(vcf_files)} files in {path} (batch of {batch_size} rows)", level="INFO")
+        if self.cache_dir is not None:
+            frames = self.iter_vcf_files_cached(vcf_files, workers, chunksize, rebuild)
+        else:
+            frames = self.iter_vcf_files(vcf_files, workers, chunksize)
+        return DataCleaner(self.log).clean_batches(self.rebatch(frames, batch_size), self.COLUMNS_TO_KEEP)
+
+    def write_dataset(self, output_dir="data/vcf_dataset", partition_cols=["CTYPE"], path="Data/VCF", exclude_patterns=None,
+                      workers=None, chunksize=None, rebuild=False, batch_size=100000):
+        '''
+        Scrittura dei batch di iter_batches in un dataset Parquet partizionato (es. CTYPE=BRCA/part-00000-0.parquet),
+        output_dir viene ricreata. Si rilegge con load_dataset(output_dir). Ritorna il numero di righe scritte
+        '''
+        start_time = time.time()
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        rows = 0
+        for part, batch in enumerate(self.iter_batches(path, exclude_patterns, workers, chunksize, rebuild, batch_size)):
+            # Le categorie di ogni batch sono diverse e pyarrow non unifica in lettura dizionari con valori nulli,
+            # quindi vengono scritte come stringhe (Parquet le codifica comunque a dizionario), load_dataset ripristina lo schema
+            batch = batch.astype({column: object for column in batch.columns if isinstance(batch[column].dtype, pd.CategoricalDtype)})
+            batch.to_parquet(output_dir, partition_cols=partition_cols, index=False, basename_template=f"part-{part:05d}-{{i}}.parquet")
+            rows += batch.shape[0]
+        if self.log is not None: self.log.write_log(f"Found {len(self.duplicated_files)} duplicates", level="WARNING")
+        if self.log is not None: self.log.write_log(f"Written {rows} rows to {output_dir} in {time.time() - start_time:.2f} seconds", level="SUCCESS")
+        return rows
+
+    @staticmethod
+    def load_dataset(output_dir="data/vcf_dataset", columns=None, filters=None):
+        # Lettura del dataset di write_dataset con lo schema del dataset pulito, filters come in pd.read_parquet (es. [("CTYPE", "==", "HC")]).
+        # Partizioni lette come stringhe: con i dizionari dedotti da pyarrow la partizione nulla non si converte in pandas
+        # Le colonne di partizione arrivano per ultime: ordine di columns o del dataset pulito (come get_dataframe)
+        df = pd.read_parquet(output_dir, columns=columns, filters=filters, partitioning=ds.partitioning(flavor="hive"))
+        order = columns if columns is not None else [column for column in VCFProcessor.COLUMNS_TO_KEEP if column in df.columns]
+        df = df[order + [column for column in df.columns if column not in order]]
+        return DataCleaner.apply_schema(df)
+
     def load_data(self,path="Data/processed_data.csv",log=None ):
         try:
             df = pd.read_csv(path)
@@ -147,9 +442,15 @@ class VCFProcessor:
         return df
     
 class DataCleaner:
+    # Schema del dataset pulito: colonne a bassa cardinalità come categorie, valori mancanti come NaN.
+    # END (INFO/END delle varianti strutturali) resta intero con -1 se assente, come gli INFO Integer di VCFReader
+    SCHEMA = {
+        "CHROM": "category", "POS": np.int32, "REF": "category", "ALT": "category", "END": np.int32, "AF": np.float32,
+        "GENEINFO": "category", "NAME": "category", "TISSUE": "category", "CTYPE": "category", "GT": "category"
+    }
+
     def __init__(self, log):
         self.log = log
-        self.processor = VCFProcessor(None)
     
     def drop_nan_columns(self, dataframe):
         df = dataframe.copy()
@@ -158,20 +459,10 @@ class DataCleaner:
                 df.drop(col, axis=1, inplace=True)
         return df
 
-    def clean_dataframe(self, dataframe, columns_to_keep=["CHROM", "POS", "REF", "ALT", "AF", "GENEINFO", "NAME", "TISSUE", "CTYPE","GT"], duplicated_files=[]):
-
+    def clean_dataframe(self, dataframe, columns_to_keep=["CHROM", "POS", "REF", "ALT", "END", "AF", "GENEINFO", "NAME", "TISSUE", "CTYPE","GT"]):
+        # I duplicati sono già risolti da VCFProcessor prima del parsing
         df = dataframe.copy()
         pre_num_cols = len(df.columns)
-        self.log.write_log(f"Going trough {len(duplicated_files)} files", level="DEBUG")
-        for file in duplicated_files:
-            old_df = df[df["NAME"] == self.processor.extract_identifier(file)]
-            new_df = self.processor.process_vcf_file(file)
-
-            if new_df is not None and new_df.shape[0] > 0 and new_df.shape[0] > old_df.shape[0]: 
-                df = df[df["NAME"] != self.processor.extract_identifier(file)]
-                df = pd.concat([df, new_df], ignore_index=True)
-                if self.log is not None: self.log.write_log(f"Replaced {self.processor.extract_identifier(file)} with {file}", level="DEBUG")
-
         df = self.drop_nan_columns(df)
         if self.log is not None: self.log.write_log(f"Dropped {pre_num_cols - len(df.columns)} NaN columns", level="DEBUG")
         pre_num_cols = len(df.columns)
@@ -183,4 +474,25 @@ class DataCleaner:
         df["CHROM"] = df["CHROM"].apply(lambda x: x.replace("chr", "") if pd.notnull(x) else x)
         
         if self.log is not None: self.log.write_log(f"Dropped {pre_num_cols - len(df.columns)} columns", level="DEBUG")
-        return df.astype(str)
\ No newline at end of file
+        # Colonne nell'ordine di columns_to_keep come in clean_batches, non in quello degli INFO del VCF
+        return self.apply_schema(df[[column for column in columns_to_keep if column in df.columns]])
+
+    def clean_batches(self, batches, columns_to_keep=["CHROM", "POS", "REF", "ALT", "END", "AF", "GENEINFO", "NAME", "TISSUE", "CTYPE","GT"]):
+        '''
+        Pulizia di un batch alla volta. Le colonne sono sempre columns_to_keep (quelle assenti restano nulle)
+        perché i batch devono avere lo stesso schema: le colonne vuote non vengono scartate come in clean_dataframe
+        '''
+        for batch in batches:
+            batch = batch.reindex(columns=columns_to_keep)
+            # Le colonne interamente nulle non hanno l'accessor .str
+            if batch["CHROM"].notna().any():
+                batch["CHROM"] = batch["CHROM"].str.replace("chr", "", regex=False)
+            if batch["GENEINFO"].notna().any():
+                batch["GENEINFO"] = batch["GENEINFO"].str.split(":").str[0]
+            yield self.apply_schema(batch)
+
+    @staticmethod
+    def apply_schema(df):
+        if "END" in df.columns:
+            df = df.assign(END=df["END"].fillna(VCFReader.INFO_FILLS["Integer"]))
+        return df.astype({column: dtype for column, dtype in DataCleaner.SCHEMA.items() if column in df.columns})
\ No newline at end of file
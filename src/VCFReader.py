@@ -0,0 +1,301 @@
+import csv, gzip, hashlib, io, json, os, re
+import numpy as np
+import pandas as pd
+from src.GeneIndex import GeneIndex
+
+try:
+    # Accesso per regioni ai .vcf.gz indicizzati con tabix, se installato
+    import pysam
+except ImportError:
+    pysam = None
+
+
+class VCFReader:
+    '''
+    Lettura in un solo passaggio di un VCF a campione singolo: header, identificativo, record e genotipo dallo stesso stream.
+    Le colonne seguono allel.vcf_to_dataframe(fields='*', alt_number=1):
+      CHROM, POS (int32), ID, REF, ALT (primo allele), QUAL (float32), FILTER_PASS e FILTER_<id>,
+      un campo per ogni INFO dichiarato nell'header, numalt, altlen, is_snp
+    con gli stessi valori mancanti (NaN, -1 per gli interi, False per i flag). In più GT è letto dai campi FORMAT/campione.
+
+    fields limita le colonne prodotte: i campi non richiesti non vengono decodificati.
+    regions (GeneIndex.intervals()) limita i record alle regioni del pannello; per i .vcf.gz con indice tabix
+    e pysam installato vengono lette solo le regioni, altrimenti i record fuori regione sono scartati dopo il parsing.
+    '''
+    INFO_FILLS = {"Integer": -1, "Float": np.nan, "Flag": False, "String": np.nan, "Character": np.nan}
+    INFO_DTYPES = {"Integer": np.int32, "Float": np.float32, "Flag": bool, "String": object, "Character": object}
+    # Versione dei record prodotti, da incrementare quando cambia il parsing (invalida le cache di ingestione)
+    VERSION = 1
+
+    def __init__(self, fields:list = None, regions:dict = None) -> None:
+        self.fields = set(fields) if fields is not None else None
+        self.regions = regions
+
+    def fingerprint(self)->str:
+        # Configurazione di lettura: versione, campi e regioni
+        digest = hashlib.blake2b(digest_size=12)
+        digest.update(json.dumps([self.VERSION, sorted(self.fields) if self.fields is not None else "*"]).encode())
+        for chrom in sorted(self.regions or {}):
+            starts, ends = self.regions[chrom]
+            digest.update(chrom.encode() + np.asarray(starts, dtype=np.int64).tobytes() + np.asarray(ends, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def wants(self, name:str)->bool:
+        return self.fields is None or name in self.fields
+
+    @staticmethod
+    def parse_identifier(sample:str, vcf_file:str)->str:
+        # Identificativo del campione dall'ultima colonna dell'header ("BRCA-123-22_S1" -> "BRCA123/22")
+        identifier = sample
+        if "full_variant" in vcf_file.lower() or "full-variant" in vcf_file.lower():
+            identifier = identifier.split('_')[1]
+        try:
+            identifier = identifier.split('_')[0]
+            identifier = identifier.replace("-", "/")
+            if (identifier.startswith("BRCA") and identifier[4] == "/") or (identifier.startswith("HC") and identifier[2] == "/"):
+                identifier = identifier.replace("/", "", 1)
+
+            sub_identifier = identifier.split("/")
+            sub_identifier[1] = sub_identifier[1][:2]
+            identifier = sub_identifier[0] + "/" + sub_identifier[1]
+
+        except Exception as e:
+            pass
+        return identifier
+
+    @staticmethod
+    def __parse_meta(line:str)->dict:
+        # ##INFO=<ID=AF,Number=A,Type=Float,Description="..."> -> {"ID": "AF", "Number": "A", "Type": "Float", ...}
+        body = line[line.index("<") + 1:line.rindex(">")]
+        meta = {}
+        for item in csv.reader([body], skipinitialspace=True):
+            for field in item:
+                key, _, value = field.partition("=")
+                meta[key] = value
+        return meta
+
+    def read_header(self, f)->dict:
+        '''
+        Lettura dell'header fino alla riga #CHROM compresa, il file resta posizionato sul primo record.
+        Ritorna None se la riga #CHROM manca
+        '''
+        info, filters = {}, []
+        for line in iter(f.readline, ""):
+            if line.startswith("##INFO=<"):
+                meta = self.__parse_meta(line)
+                info[meta["ID"]] = (meta.get("Number", "1"), meta.get("Type", "String"))
+            elif line.startswith("##FILTER=<"):
+                filters.append(self.__parse_meta(line)["ID"])
+            elif line.startswith("#CHROM"):
+                columns = line.strip().split('\t')
+                return {"columns": [columns[0].lstrip("#")] + columns[1:], "info": info, "filters": filters, "sample": columns[-1]}
+        return None
+
+    def __info_columns(self, info:pd.Series, fields:dict)->dict:
+        columns = {}
+        for key, (number, vtype) in fields.items():
+            if vtype == "Flag":
+                columns[key] = info.str.contains(rf"(?:^|;){re.escape(key)}(?:;|$|=)", regex=True).to_numpy(dtype=bool)
+                continue
+
+            if number == "R":
+                width = 2
+            elif number.isdigit() and int(number) > 1:
+                width = int(number)
+            else:
+                width = 1
+            if width == 1:
+                # Solo il primo valore (alt_number=1), estratto direttamente senza split
+                parts = [info.str.extract(rf"(?:^|;){re.escape(key)}=([^;,]*)", expand=False)]
+            else:
+                split = info.str.extract(rf"(?:^|;){re.escape(key)}=([^;]*)", expand=False).str.split(",")
+                parts = [split.str[i] for i in range(width)]
+            for i in range(width):
+                name = key if width == 1 else f"{key}_{i + 1}"
+                column = parts[i].where(parts[i].notna() & (parts[i] != ".") & (parts[i] != ""))
+                if vtype in ["Integer", "Float"]:
+                    column = pd.to_numeric(column, errors="coerce")
+                    columns[name] = column.fillna(self.INFO_FILLS[vtype]).to_numpy(dtype=self.INFO_DTYPES[vtype])
+                else:
+                    columns[name] = column.fillna(self.INFO_FILLS[vtype]).to_numpy(dtype=object)
+        return columns
+
+    @staticmethod
+    def __genotype(format_:pd.Series, sample:pd.Series)->pd.Series:
+        # GT dalla posizione della chiave GT in FORMAT, calcolata una volta per ogni FORMAT distinto
+        gt = pd.Series(np.nan, index=sample.index, dtype=object)
+        for keys in format_.dropna().unique():
+            keys = keys.split(":")
+            if "GT" not in keys:
+                continue
+            rows = format_ == ":".join(keys)
+            gt[rows] = sample[rows].str.extract(rf"^(?:[^:]*:){{{keys.index('GT')}}}([^:]*)", expand=False)
+        return gt.where(gt.notna() & (gt != ""))
+
+    def __info_names(self, key:str, number:str, vtype:str)->list:
+        # Colonne prodotte da un campo INFO: KEY oppure KEY_1..KEY_n per Number=R e Number>1
+        if vtype == "Flag":
+            return [key]
+        if number == "R":
+            width = 2
+        elif number.isdigit() and int(number) > 1:
+            width = int(number)
+        else:
+            width = 1
+        return [key] if width == 1 else [f"{key}_{i + 1}" for i in range(width)]
+
+    def __in_regions(self, chrom:pd.Series, pos:np.ndarray)->np.ndarray:
+        # Record con POS all'interno delle regioni (estremi inclusi)
+        chrom = chrom.map(GeneIndex.normalize_chrom).to_numpy()
+        inside = np.zeros(len(chrom), dtype=bool)
+        for c in pd.unique(chrom):
+            if c not in self.regions:
+                continue
+            starts, ends = self.regions[c]
+            rows = np.flatnonzero(chrom == c)
+            interval = np.searchsorted(starts, pos[rows], side="right") - 1
+            valid = interval >= 0
+            inside[rows[valid]] = pos[rows[valid]] <= ends[interval[valid]]
+        return inside
+
+    def read_records(self, f, header:dict)->pd.DataFrame:
+        '''
+        Lettura vettoriale dei record dallo stesso handle di read_header.
+        Vengono lette e decodificate solo le colonne del VCF necessarie ai campi richiesti.
+        Ritorna None se il file non contiene varianti, come vcf_to_dataframe
+        '''
+        columns = header["columns"]
+        info_fields = {key: spec for key, spec in header["info"].items() if any(self.wants(name) for name in self.__info_names(key, *spec))}
+        filters = [name for name in ["PASS"] + [f for f in header["filters"] if f != "PASS"] if self.wants(f"FILTER_{name}")]
+        alleles = any(self.wants(name) for name in ["numalt", "altlen", "is_snp"])
+        has_sample = "FORMAT" in columns and len(columns) > columns.index("FORMAT") + 1
+        needed = {
+            "CHROM": self.wants("CHROM") or self.regions is not None,
+            "POS": self.wants("POS") or self.regions is not None,
+            "ID": self.wants("ID"),
+            "REF": self.wants("REF") or alleles,
+            "ALT": self.wants("ALT") or alleles,
+            "QUAL": self.wants("QUAL"),
+            "FILTER": len(filters) > 0,
+            "INFO": len(info_fields) > 0,
+            "FORMAT": self.wants("GT") and has_sample,
+        }
+        usecols = [c for c in columns[:8] if needed.get(c)] + (["FORMAT", columns[-1]] if needed["FORMAT"] else [])
+        try:
+            raw = pd.read_csv(f, sep="\t", header=None, names=columns, usecols=usecols, dtype=str, keep_default_na=False,
+                              quoting=csv.QUOTE_NONE, engine="c")
+        except pd.errors.EmptyDataError:
+            return None
+        if self.regions is not None:
+            raw = raw[self.__in_regions(raw["CHROM"], raw["POS"].to_numpy(dtype=np.int64))].reset_index(drop=True)
+        if raw.shape[0] == 0:
+            return None
+
+        df = {}
+        for name in ["CHROM", "ID", "REF"]:
+            if self.wants(name):
+                df[name] = raw[name].to_numpy(dtype=object)
+        if self.wants("POS"):
+            df["POS"] = raw["POS"].to_numpy(dtype=np.int32)
+        if needed["ALT"]:
+            alts = raw["ALT"].where(raw["ALT"] != ".", "")
+            alt = alts.str.replace(r",.*", "", regex=True)
+            numalt = np.where(alts == "", 0, alts.str.count(",") + 1).astype(np.int32)
+            if self.wants("ALT"):
+                df["ALT"] = alt.where(numalt > 0).to_numpy(dtype=object)
+        if self.wants("QUAL"):
+            df["QUAL"] = pd.to_numeric(raw["QUAL"].where(raw["QUAL"] != "."), errors="coerce").to_numpy(dtype=np.float32)
+        if needed["INFO"]:
+            info = self.__info_columns(raw["INFO"], info_fields)
+            df.update({name: values for name, values in info.items() if self.wants(name)})
+        for name in filters:
+            df[f"FILTER_{name}"] = raw["FILTER"].str.contains(rf"(?:^|;){re.escape(name)}(?:;|$)", regex=True).to_numpy(dtype=bool)
+        if alleles:
+            ref_len = raw["REF"].str.len().to_numpy()
+            alt_len = alt.str.len().to_numpy()
+            if self.wants("numalt"):
+                df["numalt"] = numalt
+            if self.wants("altlen"):
+                df["altlen"] = np.where(numalt > 0, alt_len - ref_len, 0).astype(np.int32)
+            if self.wants("is_snp"):
+                df["is_snp"] = (ref_len == 1) & (alt_len == 1) & (numalt > 0)
+
+        # Ordine delle colonne di vcf_to_dataframe anche con un sottoinsieme di campi
+        df = pd.DataFrame({name: df[name] for name in ["CHROM", "POS", "ID", "REF", "ALT", "QUAL"] + list(df) if name in df})
+        if self.wants("GT"):
+            df["GT"] = self.__genotype(raw["FORMAT"], raw[columns[-1]]).to_numpy() if needed["FORMAT"] else np.nan
+        return df
+
+    @staticmethod
+    def open(vcf_file:str):
+        # VCF in chiaro oppure compresso (.vcf.gz, bgzip compreso)
+        if vcf_file.endswith(".gz"):
+            return gzip.open(vcf_file, "rt")
+        return open(vcf_file, "r")
+
+    @staticmethod
+    def has_index(vcf_file:str)->bool:
+        return vcf_file.endswith(".gz") and (os.path.exists(vcf_file + ".tbi") or os.path.exists(vcf_file + ".csi"))
+
+    def __read_tabix(self, vcf_file:str, accept):
+        # Lettura delle sole regioni tramite l'indice tabix, i record fuori pannello non vengono nemmeno decompressi
+        with pysam.TabixFile(vcf_file) as tabix:
+            header = self.read_header(io.StringIO("\n".join(tabix.header) + "\n"))
+            if header is None:
+                return None, None
+            identifier = self.parse_identifier(header["sample"], vcf_file)
+            if accept is not None and not accept(identifier):
+                return identifier, None
+            lines = []
+            for contig in tabix.contigs:
+                chrom = GeneIndex.normalize_chrom(contig)
+                if chrom not in self.regions:
+                    continue
+                # fetch ritorna i record che si sovrappongono alla regione: come senza indice si tengono solo quelli con POS
+                # nella regione, e una sola volta anche se il record si sovrappone a più regioni
+                covered = 0
+                for start, end in zip(*self.regions[chrom]):
+                    first = max(int(start), covered + 1)
+                    for line in tabix.fetch(contig, max(int(start) - 1, 0), int(end)):
+                        if first <= int(line.split("\t", 2)[1]) <= end:
+                            lines.append(line)
+                    covered = max(covered, int(end))
+            return identifier, self.read_records(io.StringIO("\n".join(lines) + "\n" if len(lines) > 0 else ""), header)
+
+    @staticmethod
+    def scan(vcf_file:str, chunk_size:int = 1 << 20):
+        '''
+        Scansione leggera senza parsing: (identificativo, numero di righe di record), (None, 0) se la riga #CHROM manca.
+        Le righe vengono solo contate (anche quelle fuori dalle regioni del pannello)
+        '''
+        with (gzip.open(vcf_file, "rb") if vcf_file.endswith(".gz") else open(vcf_file, "rb")) as f:
+            for line in iter(f.readline, b""):
+                if line.startswith(b"#CHROM"):
+                    sample = line.decode().strip().split('\t')[-1]
+                    break
+            else:
+                return None, 0
+            records, last = 0, b"\n"
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                records += chunk.count(b"\n")
+                last = chunk[-1:]
+            # Ultima riga senza a capo finale
+            if last != b"\n":
+                records += 1
+        return VCFReader.parse_identifier(sample, vcf_file), records
+
+    def read(self, vcf_file:str, accept = None):
+        '''
+        Ritorna (identificativo, DataFrame) leggendo il file una sola volta.
+        accept: funzione opzionale dell'identificativo, se ritorna False i record non vengono letti (DataFrame None)
+        '''
+        if self.regions is not None and pysam is not None and self.has_index(vcf_file):
+            return self.__read_tabix(vcf_file, accept)
+        with self.open(vcf_file) as f:
+            header = self.read_header(f)
+            if header is None:
+                return None, None
+            identifier = self.parse_identifier(header["sample"], vcf_file)
+            if accept is not None and not accept(identifier):
+                return identifier, None
+            return identifier, self.read_records(f, header)
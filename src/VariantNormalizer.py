@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+from src.Log import Log
+
+
+class VariantNormalizer:
+    '''
+    Costruzione vettoriale delle notazioni usate dalle API di Ensembl a partire dalle colonne CHROM, POS, REF, ALT (ed END per le varianti strutturali).
+
+        1 182712 . A C          --> SNV    1:182712-182712:1/C
+        3 319780 . GA G         --> DEL    3:319781-319781:1/-
+        3 319780 . GAA G        --> DEL    3:319781-319782:1/-
+        19 110747 . G GT        --> INS    19:110748-110747:1/T
+        19 110747 . G GTT       --> INS    19:110748-110747:1/TT
+        7 55249071 . CG TA      --> MNV    7:55249071-55249072:1/TA
+        1 160283 . N <DUP> END=471362   --> SV_DUP 1:160283-471362:1/DUP
+        1 1385015 . N <DEL> END=1387562 --> SV_DEL 1:1385015-1387562:1/DEL
+
+    Colonne prodotte:
+        KEY            chiave della variante in memoria ("chrom pos . ref alt . . .", "chrom pos . ref alt . . END=end" per le SV)
+        VARIANT_CLASS  SNV, MNV, INS, DEL, SV_DEL, SV_DUP oppure UNSUPPORTED
+        REGION         notazione region di VEP, nulla per le varianti non supportate
+        REGION_QUOTED  REGION codificata per l'URL
+        VCF_INPUT      riga VCF per il POST /vep/human/region
+        LIFTOVER_KEY   regione della sola POS per /map ("chrom:pos..pos:1")
+    '''
+    COLUMNS = ["KEY", "VARIANT_CLASS", "REGION", "REGION_QUOTED", "VCF_INPUT", "LIFTOVER_KEY"]
+    KEY_COLUMNS = ["CHROM", "POS", "REF", "ALT"]
+
+    def __init__(self, log:Log) -> None:
+        self.__log = log
+
+    @classmethod
+    def key_columns(cls, df:pd.DataFrame)->list:
+        # Colonne che identificano una variante: END (INFO/END, -1 se assente) distingue le varianti strutturali con lo stesso inizio
+        return cls.KEY_COLUMNS + (["END"] if "END" in df.columns else [])
+
+    @staticmethod
+    def end_positions(df:pd.DataFrame)->np.ndarray:
+        # INFO/END come float, NaN se la colonna manca o il valore è assente (-1 del VCFReader)
+        if "END" not in df.columns:
+            return np.full(len(df), np.nan)
+        end = pd.to_numeric(df["END"], errors="coerce").to_numpy(dtype=float)
+        return np.where(end > 0, end, np.nan)
+
+    @staticmethod
+    def reverse_complement(alleles:pd.Series)->pd.Series:
+        # Reverse complement degli alleli di basi, gli alleli simbolici e "-" restano invariati
+        alleles = alleles.astype(str)
+        bases = alleles.str.fullmatch(r"[ACGTNacgtn]+")
+        complement = alleles[bases].str.translate(str.maketrans("ACGTNacgtn", "TGCANtgcan")).str[::-1]
+        return alleles.where(~bases, complement)
+
+    def normalize(self, df:pd.DataFrame)->pd.DataFrame:
+        '''
+        Ritorna un DataFrame con lo stesso indice di df e le colonne in COLUMNS
+        '''
+        chrom = df["CHROM"].astype(str)
+        pos_str = df["POS"].astype(str)
+        pos = pd.to_numeric(df["POS"], errors="coerce").to_numpy(dtype=float)
+        ref = df["REF"].astype(str)
+        alt = df["ALT"].astype(str)
+        len_ref = ref.str.len().to_numpy()
+        len_alt = alt.str.len().to_numpy()
+
+        sv_type = alt.str.extract(r"^<(DEL|DUP)(?::[^>]*)?>$", expand=False)
+        is_sv = sv_type.notna().to_numpy()
+        is_bases = (ref.str.fullmatch(r"[ACGTN]+") & alt.str.fullmatch(r"[ACGTN]+")).to_numpy() & ~np.isnan(pos)
+        end_sv = self.end_positions(df)
+        is_sv = is_sv & ~np.isnan(end_sv) & ~np.isnan(pos)
+
+        variant_class = np.select(
+            [is_sv & (sv_type == "DEL").to_numpy(), is_sv & (sv_type == "DUP").to_numpy(),
+             is_bases & (len_ref == 1) & (len_alt == 1), is_bases & (len_ref == len_alt),
+             is_bases & (len_ref > len_alt), is_bases & (len_ref < len_alt)],
+            ["SV_DEL", "SV_DUP", "SNV", "MNV", "DEL", "INS"],
+            "UNSUPPORTED"
+        )
+        supported = variant_class != "UNSUPPORTED"
+
+        # Inizio, fine e allele della notazione region per ogni classe
+        start = np.select([variant_class == "DEL", variant_class == "INS"], [pos + len_alt, pos + len_ref], pos)
+        end = np.select([np.isin(variant_class, ["SV_DEL", "SV_DUP"])], [end_sv], pos + len_ref - 1)
+        allele = alt.to_numpy(dtype=object).copy()
+        allele[variant_class == "DEL"] = "-"
+        allele[is_sv] = sv_type.to_numpy(dtype=object)[is_sv]
+        insertion = np.flatnonzero(variant_class == "INS")
+        allele[insertion] = [a[n:] for a, n in zip(alt.to_numpy()[insertion], len_ref[insertion])]
+
+        start_str = pd.Series(np.where(supported, start, 0).astype(np.int64), index=df.index).astype(str)
+        end_str = pd.Series(np.where(supported, end, 0).astype(np.int64), index=df.index).astype(str)
+        region = chrom + ":" + start_str + "-" + end_str + ":1/" + pd.Series(allele, index=df.index).astype(str)
+        region = region.where(supported, None)
+
+        vcf_input = chrom + " " + pos_str + " . " + ref + " " + alt + " . . ."
+        sv_info = chrom + " " + pos_str + " . " + ref + " " + alt + " . . SVTYPE=" + sv_type.fillna("") + ";END=" + end_str
+        vcf_input = vcf_input.where(~is_sv, sv_info).where(supported, None)
+
+        unsupported = int((~supported).sum())
+        if unsupported > 0:
+            self.__log.write_log(f"{unsupported} variants with an unsupported notation (e.g. {df.loc[~supported].iloc[0][['CHROM', 'POS', 'REF', 'ALT']].tolist()})", "ERROR")
+
+        # Chiave in memoria: riga VCF della variante, con END nel campo INFO per le varianti strutturali
+        key = chrom + " " + pos_str + " . " + ref + " " + alt + " . . ."
+        key = key.where(~is_sv, chrom + " " + pos_str + " . " + ref + " " + alt + " . . END=" + end_str)
+
+        return pd.DataFrame({
+            "KEY": key,
+            "VARIANT_CLASS": variant_class,
+            "REGION": region,
+            "REGION_QUOTED": region.str.replace(":", "%3A", regex=False),
+            "VCF_INPUT": vcf_input,
+            "LIFTOVER_KEY": chrom + ":" + pos_str + ".." + pos_str + ":1",
+        }, index=df.index)
+
+    def normalize_lifted(self, df:pd.DataFrame, strand:pd.Series)->pd.DataFrame:
+        '''
+        normalize per varianti dopo il liftover. df ha le posizioni GRCh38 della prima base dell'allele (POS) e della fine
+        delle varianti strutturali (END) con gli alleli GRCh37, strand è il filamento della catena (1 o -1) con lo stesso indice.
+        Sul filamento opposto l'allele va letto al contrario: POS passa all'altro estremo (POS - len(REF) + 1, per le SV
+        l'intervallo POS-END viene ribaltato) e gli alleli diventano il reverse complement.
+        Nelle inserzioni e delezioni la base di ancoraggio VCF finisce a destra e la nuova base a sinistra non è nota
+        senza la sequenza di riferimento: viene costruita solo la notazione region, senza VCF_INPUT
+        '''
+        df = df.copy()
+        flip = (strand < 0).to_numpy()
+        if flip.any():
+            pos = pd.to_numeric(df["POS"], errors="coerce")
+            len_ref = df["REF"].astype(str).str.len()
+            sv = np.zeros(len(df), dtype=bool)
+            if "END" in df.columns:
+                end = pd.Series(self.end_positions(df), index=df.index)
+                sv = flip & end.notna().to_numpy()
+                df.loc[sv, "END"] = pos[sv]
+                df.loc[sv, "POS"] = pos[sv] - (end[sv] - pos[sv])
+            bases = flip & ~sv
+            df.loc[bases, "POS"] = pos[bases] - len_ref[bases] + 1
+            df.loc[flip, "REF"] = self.reverse_complement(df.loc[flip, "REF"])
+            df.loc[flip, "ALT"] = self.reverse_complement(df.loc[flip, "ALT"])
+
+        result = self.normalize(df)
+        indel = flip & result["VARIANT_CLASS"].isin(["INS", "DEL"]).to_numpy()
+        if indel.any():
+            region = self.__right_anchored_regions(df[indel])
+            result.loc[indel, "REGION"] = region
+            result.loc[indel, "REGION_QUOTED"] = region.str.replace(":", "%3A", regex=False)
+            result.loc[indel, "VCF_INPUT"] = None
+        return result
+
+    @staticmethod
+    def __right_anchored_regions(df:pd.DataFrame)->pd.Series:
+        # Notazione region di inserzioni e delezioni con le basi comuni a destra (POS è la prima base di REF)
+        chrom = df["CHROM"].astype(str)
+        pos = pd.to_numeric(df["POS"], errors="coerce").astype(np.int64)
+        ref = df["REF"].astype(str)
+        alt = df["ALT"].astype(str)
+        len_ref = ref.str.len()
+        len_alt = alt.str.len()
+        deletion = len_ref > len_alt
+        # Delezione: basi REF[:len_ref - len_alt] da POS; inserzione: basi ALT[:len_alt - len_ref] prima di POS
+        end = np.where(deletion, pos + len_ref - len_alt - 1, pos - 1)
+        allele = ["-" if d else a[:la - lr] for d, a, la, lr in zip(deletion, alt, len_alt, len_ref)]
+        return chrom + ":" + pos.astype(str) + "-" + pd.Series(end, index=df.index).astype(str) + ":1/" + pd.Series(allele, index=df.index)
@@ -1,24 +1,92 @@
-import json
-
-def check_integrity(dataframe, log):
-    df = dataframe.copy()
-    
-    for col in df.columns:
-        assert not df[col].isnull().all()
-
-    column_data = {}
-    for col in df.columns:
-        nan_percentage = df[col].isnull().sum() / len(df)
-        notnan_percentage = 1 - nan_percentage
-        
-        non_nan_values = df[col].dropna().value_counts(normalize=True).to_dict()
-        
-        column_data[col] = {
-            'NaN_percentage': nan_percentage,
-            'notNaN_percentage': notnan_percentage,
-            'unique_values': non_nan_values
-        }
-
-    with open("Data/column_data.json", "w") as f:
-        json.dump(column_data, f, indent=4)
+import hashlib, numbers, datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 
+def check_integrity(dataframe, log, path="Data/column_data.json", chunk_size=100000):
+    # Profilo delle colonne (DatasetProfiler): tasso di nulli, valori distinti e valori più frequenti
+    from src.DatasetProfiler import DatasetProfiler
+    profile = DatasetProfiler.profile_frame(dataframe, chunk_size).write(path)
+    for col, column in profile["columns"].items():
+        assert column["nulls"] < profile["rows"] or profile["rows"] == 0, f"Column {col} is empty"
+    if log is not None:
+        log.write_log(f"Column profile of {profile['rows']} rows saved to {path}", level="DEBUG")
+    return profile
+
+
+def file_hash(path, chunk_size=1 << 20):
+    # Hash del contenuto di un file, letto a blocchi
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Suffisso delle colonne con il tipo dei valori delle colonne miste, e lettura dei valori dal testo per tipo
+TYPE_SUFFIX = "__type"
+VALUE_PARSERS = {"bool": lambda value: value == "True", "int": int, "float": float, "str": str, "datetime": pd.Timestamp}
+
+
+def value_type(value):
+    # Tipo di un valore tra quelli di VALUE_PARSERS, None se non è rileggibile dal testo
+    if isinstance(value, (bool, np.bool_)):
+        return "bool"
+    if isinstance(value, numbers.Integral):
+        return "int"
+    if isinstance(value, numbers.Real):
+        return "float"
+    if isinstance(value, str):
+        return "str"
+    if isinstance(value, datetime.datetime):
+        return "datetime"
+    return None
+
+
+def arrow_compatible(dataframe, log=None):
+    '''
+    DataFrame scrivibile con Arrow (Parquet, Feather): le colonne object con valori di tipi diversi (es. MSP numerici e testuali)
+    diventano testo con una colonna <nome>__type che permette a from_arrow di rileggere ogni valore con il suo tipo.
+    I valori non rileggibili dal testo (es. liste nelle risposte VEP) restano come sono se Arrow li converte, altrimenti
+    diventano testo. I valori mancanti restano mancanti e le altre colonne non vengono toccate
+    '''
+    df = dataframe
+    for column in dataframe.columns[dataframe.dtypes == object]:
+        values = dataframe[column]
+        if pd.api.types.infer_dtype(values, skipna=True) in ["string", "empty", "bytes"]:
+            continue
+        missing = values.isna()
+        types = values.map(value_type).where(~missing)
+        unsupported = types.isna() & ~missing
+        if not unsupported.any() and types.nunique() <= 1:
+            # Un solo tipo: Arrow lo converte direttamente
+            continue
+        if unsupported.any():
+            try:
+                pa.array(values, from_pandas=True)
+                continue
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                if log is not None:
+                    log.write_log(f"Column {column} has values of unsupported types, saved as text", "WARNING")
+                types = types.where(~unsupported, "str")
+        if df is dataframe:
+            df = dataframe.copy()
+        df[column + TYPE_SUFFIX] = types
+        df[column] = values.where(missing, values.astype(str))
+    return df
+
+
+def from_arrow(df):
+    # Inverso di arrow_compatible su un DataFrame letto con Arrow: valori delle colonne miste riportati al tipo originale
+    for type_column in [column for column in df.columns if str(column).endswith(TYPE_SUFFIX)]:
+        column = type_column[:-len(TYPE_SUFFIX)]
+        types = df.pop(type_column).to_numpy(dtype=object)
+        values = df[column].to_numpy(dtype=object).copy()
+        for name, parse in VALUE_PARSERS.items():
+            mask = types == name
+            values[mask] = [parse(value) for value in values[mask]]
+        df[column] = values
+    # Arrow rilegge i valori mancanti delle colonne object come None, pandas li dà come NaN
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
@@ -0,0 +1,80 @@
+import os, re, sys, json, shutil
+import httpx
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Percorso assoluto del repository: i worker avviati con spawn lo ricevono anche dopo il chdir dei test
+sys.path.insert(0, ROOT)
+
+from src.Log import Log
+from src.EnsemblBackend import ResponseArchive
+
+
+@pytest.fixture
+def log():
+    return Log(save_file=False)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Cartella di lavoro con i file di supporto letti da EnsemblAPI (regioni del pannello, transcript MANE, key.json)
+    os.makedirs(tmp_path / "data")
+    (tmp_path / "data" / "HCS_region_map.bed").write_text("13\t32889610\t32973805\t1\tBRCA2\n17\t41196311\t41277500\t1\tBRCA1\n")
+    (tmp_path / "data" / "GRCh38_genes_MANE_Select.txt").write_text("BRCA2\tENST00000380152.8\tNM_000059.4\nBRCA1\tENST00000357654.9\tNM_007294.4\n")
+    shutil.copy(os.path.join(ROOT, "key.json"), tmp_path / "key.json")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def vep_response(variant:str)->dict:
+    # Risposta VEP sintetica per una variante in formato VCF ("13 32890010 . A T . . .")
+    chrom, pos, _, ref, alt = variant.split()[:5]
+    return {"input": variant, "seq_region_name": chrom, "most_severe_consequence": "missense_variant",
+            "transcript_consequences": [{"strand": 1, "hgvsc": f"ENST00000380152.8:c.{pos}{ref}>{alt}", "sift_score": 0.1}],
+            "colocated_variants": [{"id": "rs1", "clin_sig_allele": f"{alt}:benign", "frequencies": {alt: {"af": 0.1}}}]}
+
+
+def fake_ensembl(request:httpx.Request)->httpx.Response:
+    # Stand-in di Ensembl: release, liftover GRCh37 -> GRCh38 (+100) e VEP singolo o a batch
+    path = request.url.path
+    if path == "/info/software":
+        return httpx.Response(200, json={"release": 110})
+    mapping = re.search(r"/map/human/GRCh37/(\w+):(\d+)", path)
+    if mapping is not None:
+        start = int(mapping.group(2)) + 100
+        return httpx.Response(200, json={"mappings": [{"mapped": {"seq_region_name": mapping.group(1), "start": start, "end": start, "strand": 1}}]})
+    if request.method == "POST":
+        return httpx.Response(200, json=[vep_response(variant) for variant in json.loads(request.content)["variants"]])
+    return httpx.Response(200, json=[vep_response("13 1 . A T")])
+
+
+class RecordingBackend:
+    # Backend in registrazione su fake_ensembl invece del server reale
+    def __init__(self, archive:ResponseArchive) -> None:
+        self.archive = archive
+        self.transport = httpx.MockTransport(fake_ensembl)
+        self.on_response = archive.record
+
+    def server_url(self, server:str)->str:
+        return "http://ensembl.test"
+
+    def close(self):
+        self.archive.close()
+
+
+def variants_frame(n:int = 60)->pd.DataFrame:
+    # Due campioni con le stesse n varianti di BRCA2
+    rows = [("13", 32890000 + 7 * i, "A", "T", f"S{j}") for i in range(n) for j in range(2)]
+    return pd.DataFrame(rows, columns=["CHROM", "POS", "REF", "ALT", "NAME"]).astype({"CHROM": "category", "REF": "category", "ALT": "category"})
+
+
+@pytest.fixture
+def archive(workdir, log):
+    # Archivio di replay registrato annotando variants_frame
+    from src.EnsemblAPI import EnsemblAPI
+    path = str(workdir / "archive.jsonl.gz")
+    api = EnsemblAPI(log, backend=RecordingBackend(ResponseArchive(path, log)))
+    api.get_api_info_from_df(variants_frame(), path_cache=str(workdir / "record.sqlite"), path_csv=None)
+    api.close()
+    return path
@@ -0,0 +1,64 @@
+import json
+import httpx
+from src.AnnotationCache import AnnotationCache
+from src.EnsemblAPI import EnsemblAPI
+
+
+def test_release_change_keeps_unknown_release_entries(log, tmp_path):
+    path = str(tmp_path / "memory.sqlite")
+    memory = tmp_path / "memory.json"
+    memory.write_text(json.dumps({"13 1 . A G . . .": {"input": "a"}}))
+
+    # Release mai letta: voci e import con release NULL
+    cache = AnnotationCache(path, log)
+    cache.import_json(str(memory))
+    cache.put("13 2 . A G . . .", {"input": "b"})
+    cache.close()
+
+    cache = AnnotationCache(path, log, release="110")
+    cache.put("13 3 . A G . . .", {"input": "c"})
+    assert len(cache) == 3
+    cache.close()
+
+    # Senza release la cache usa l'ultima vista
+    cache = AnnotationCache(path, log)
+    assert cache.release == "110"
+    cache.put("13 4 . A G . . .", {"input": "d"})
+    assert cache.set_release(None) == 0
+    # Stessa release: nessuna rimozione
+    assert cache.set_release("110") == 0
+    # Nuova release: rimosse solo le voci della release 110, l'import non viene ripetuto
+    assert cache.set_release("111") == 2
+    assert sorted(key for key, _ in cache.items()) == ["13 1 . A G . . .", "13 2 . A G . . ."]
+    assert cache.import_json(str(memory)) == 0
+    cache.close()
+
+
+class Backend:
+    # Backend minimo su httpx.MockTransport che conta le letture della release
+    def __init__(self):
+        self.release_calls = 0
+        self.transport = httpx.MockTransport(self.handler)
+        self.on_response = None
+
+    def handler(self, request):
+        if request.url.path == "/info/software":
+            self.release_calls += 1
+            return httpx.Response(200, json={"release": 110})
+        return httpx.Response(404, json={"error": "not found"})
+
+    def server_url(self, server):
+        return "http://ensembl.test"
+
+    def close(self):
+        pass
+
+
+def test_open_cache_reads_release_once_per_interval(log, workdir):
+    path = str(workdir / "memory.sqlite")
+    backend = Backend()
+    for _ in range(2):
+        api = EnsemblAPI(log, backend=backend)
+        assert api.open_cache(path).release == "110"
+        api.close()
+    assert backend.release_calls == 1
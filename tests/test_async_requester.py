@@ -0,0 +1,75 @@
+import time
+import httpx
+import pytest
+from src.AsyncRequester import AsyncRequester, TokenBucket
+
+
+def requester(log, handler, **kwargs):
+    # Stand-in di Ensembl in-process: nessun socket, le risposte arrivano da handler
+    return AsyncRequester(log, base_url="http://ensembl.test", transport=httpx.MockTransport(handler), rate=1000, **kwargs)
+
+
+def responses(*items):
+    # Handler che ritorna le risposte nell'ordine dato e conta le richieste
+    calls = []
+    def handler(request):
+        calls.append(request.url.path)
+        return items[min(len(calls), len(items)) - 1]
+    return handler, calls
+
+
+@pytest.mark.parametrize("remaining, reset, rate", [("20", "10", 2.0), ("0", "10", 0.5), ("1000", "1", 15.0), ("x", "10", 15.0)])
+def test_token_bucket_adapts_to_rate_limit_headers(remaining, reset, rate):
+    bucket = TokenBucket(15)
+    bucket.update(httpx.Headers({"X-RateLimit-Remaining": remaining, "X-RateLimit-Reset": reset}))
+    assert bucket.rate == rate
+
+
+def test_rate_limit_headers_from_responses(log):
+    handler, calls = responses(httpx.Response(200, json={"ok": 1}, headers={"X-RateLimit-Remaining": "30", "X-RateLimit-Reset": "10"}))
+    api = requester(log, handler)
+    assert api.get("/info/ping") == {"ok": 1}
+    assert api._AsyncRequester__bucket.rate == 3.0
+    api.close()
+
+
+def test_retry_after_pauses_requests(log):
+    handler, calls = responses(httpx.Response(429, json={"error": "slow down"}, headers={"Retry-After": "0.3"}),
+                               httpx.Response(200, json={"ok": 1}))
+    api = requester(log, handler)
+    start = time.monotonic()
+    assert api.get("/info/ping") == {"ok": 1}
+    assert time.monotonic() - start >= 0.3
+    assert len(calls) == 2
+    api.close()
+
+
+def test_bad_request_is_not_retried(log):
+    handler, calls = responses(httpx.Response(400, json={"error": "bad region"}))
+    recorded = []
+    api = requester(log, handler, on_response=lambda *args: recorded.append(args))
+    assert api.get("/vep/human/region/x") is None
+    assert len(calls) == 1
+    assert recorded == [("GET", "/vep/human/region/x", None, 400, None)]
+    api.close()
+
+
+def test_server_errors_retry_with_jittered_backoff(log, monkeypatch):
+    waits = []
+    monkeypatch.setattr("src.AsyncRequester.random.uniform", lambda low, high: waits.append((low, high)) or 0.0)
+    handler, calls = responses(httpx.Response(503), httpx.Response(200, text="<html>proxy</html>"), httpx.Response(200, json=[1]))
+    api = requester(log, handler, backoff=0.01, max_backoff=0.03)
+    assert api.post("/vep/human/region", {"variants": []}) == [1]
+    assert len(calls) == 3
+    # Full jitter tra 0 e backoff * 2^tentativo, limitato da max_backoff; JSON non valido ritentato come un 503
+    assert waits == [(0, 0.02), (0, 0.03)]
+    api.close()
+
+
+def test_gives_up_after_max_retries(log, monkeypatch):
+    monkeypatch.setattr("src.AsyncRequester.random.uniform", lambda low, high: 0.0)
+    handler, calls = responses(httpx.Response(503))
+    api = requester(log, handler, max_retries=3)
+    assert api.run([("GET", "/a", None), ("GET", "/b", None)]) == [None, None]
+    assert len(calls) == 6
+    api.close()
@@ -0,0 +1,96 @@
+import os
+import pandas as pd
+import pytest
+from src.DuplicatePolicy import MostRecordsPolicy, NewestFilePolicy, PreferredFolderPolicy
+from src.VCFProcessor import VCFProcessor
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=13>
+##INFO=<ID=AF,Number=A,Type=Float,Description="AF">
+##INFO=<ID=GENEINFO,Number=1,Type=String,Description="GENEINFO">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{sample}
+"""
+# (cartella, file, campione, record, mtime): BRCA12 è duplicato con più record e più recente in SOMATIC,
+# BRCA14 ha un file vuoto più recente che non deve mai vincere
+FILES = [
+    ("GERMLINE", "BRCA12_run1.vcf", "BRCA-12-22_S1", 2, 1000),
+    ("SOMATIC", "BRCA12_run2.vcf", "BRCA-12-22_S2", 3, 2000),
+    ("GERMLINE", "BRCA13_run1.vcf", "BRCA-13-22_S1", 1, 1000),
+    ("GERMLINE", "BRCA14_run1.vcf", "BRCA-14-22_S1", 1, 1000),
+    ("SOMATIC", "BRCA14_run2.vcf", "BRCA-14-22_S2", 0, 3000),
+]
+
+
+def candidate(path, records, mtime):
+    return {"path": path, "identifier": "BRCA12/22", "records": records, "mtime": mtime}
+
+
+@pytest.fixture
+def candidates():
+    return [candidate(os.path.join("VCF", "GERMLINE", "a.vcf"), 5, 100), candidate(os.path.join("VCF", "SOMATIC", "b.vcf"), 9, 50),
+            candidate(os.path.join("VCF", "HC", "c.vcf"), 9, 300), candidate(os.path.join("VCF", "SOMATIC", "d.vcf"), 0, 900)]
+
+
+def test_most_records_first_on_ties(candidates):
+    assert MostRecordsPolicy().choose(candidates)["path"].endswith("b.vcf")
+
+
+def test_newest_file_ignores_empty(candidates):
+    assert NewestFilePolicy().choose(candidates)["path"].endswith("c.vcf")
+    # Solo file senza record: vince comunque il più recente
+    assert NewestFilePolicy().choose([candidates[3], dict(candidates[3], mtime=1)])["mtime"] == 900
+
+
+def test_preferred_folder(candidates):
+    assert PreferredFolderPolicy(["germline", "hc"]).choose(candidates)["path"].endswith("a.vcf")
+    assert PreferredFolderPolicy(["HC", "GERMLINE"]).choose(candidates)["path"].endswith("c.vcf")
+    # Nessuna cartella preferita: decide il fallback tra tutti
+    assert PreferredFolderPolicy(["OTHER"], fallback=NewestFilePolicy()).choose(candidates)["path"].endswith("c.vcf")
+
+
+@pytest.fixture
+def vcf_files(tmp_path):
+    paths = []
+    for folder, name, sample, records, mtime in FILES:
+        os.makedirs(tmp_path / "VCF" / folder, exist_ok=True)
+        path = str(tmp_path / "VCF" / folder / name)
+        with open(path, "w") as f:
+            f.write(HEADER.format(sample=sample) + "".join(f"13\t{32890000 + i}\t.\tA\tT\t.\tPASS\tAF=0.{records};GENEINFO=BRCA2:675\tGT\t0/1\n" for i in range(records)))
+        os.utime(path, (mtime, mtime))
+        paths.append(path)
+    return sorted(paths)
+
+
+@pytest.mark.parametrize("policy, chosen", [(MostRecordsPolicy(), "BRCA12_run2.vcf"), (NewestFilePolicy(), "BRCA12_run2.vcf"),
+                                            (PreferredFolderPolicy(["GERMLINE"]), "BRCA12_run1.vcf")])
+def test_resolve_duplicates(log, vcf_files, policy, chosen):
+    processor = VCFProcessor(log, duplicate_policy=policy)
+    records = {name: (records, mtime) for _, name, _, records, mtime in FILES}
+    candidates = [{"path": path, "identifier": VCFProcessor.extract_identifier(path), "records": records[os.path.basename(path)][0],
+                   "mtime": records[os.path.basename(path)][1]} for path in vcf_files]
+    selected = processor.resolve_duplicates(candidates)
+    # Ordine della prima occorrenza di ogni campione
+    assert [c["identifier"] for c in selected] == ["BRCA12/22", "BRCA13/22", "BRCA14/22"]
+    assert os.path.basename(selected[0]["path"]) == chosen
+    assert os.path.basename(selected[2]["path"]) == "BRCA14_run1.vcf"
+    assert len(processor.duplicated_files) == 2
+
+
+@pytest.mark.parametrize("policy", [MostRecordsPolicy(), NewestFilePolicy(), PreferredFolderPolicy(["GERMLINE"])])
+def test_cached_matches_uncached(log, tmp_path, vcf_files, policy):
+    expected = pd.concat(VCFProcessor(log, duplicate_policy=policy).read_vcf_files(vcf_files, workers=1), ignore_index=True)
+    cached = VCFProcessor(log, cache_dir=str(tmp_path / "cache"), duplicate_policy=policy)
+    # Primo run (file letti e messi in cache) e secondo run (tutto dalla cache)
+    for _ in range(2):
+        result = pd.concat(cached.read_vcf_files_cached(vcf_files, workers=1), ignore_index=True)
+        pd.testing.assert_frame_equal(result, expected)
+    assert expected.groupby("NAME").size().to_dict() == {"BRCA12/22": 2 if isinstance(policy, PreferredFolderPolicy) else 3,
+                                                         "BRCA13/22": 1, "BRCA14/22": 1}
+
+
+def test_get_dataframe_cached_matches_uncached(log, tmp_path, vcf_files, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    expected = VCFProcessor(log).get_dataframe("VCF", workers=1)
+    result = VCFProcessor(log, cache_dir=str(tmp_path / "cache")).get_dataframe("VCF", workers=1)
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,96 @@
+import gzip
+import pandas as pd
+import pytest
+from src.AsyncRequester import AsyncRequester
+from src.EnsemblAPI import EnsemblAPI
+from src.EnsemblBackend import EnsemblBackend, ResponseArchive, ReplayResponder, ReplayTransport
+from conftest import RecordingBackend, vep_response, variants_frame
+
+QUERY = "/vep/human/region?hgvs=1"
+V1, V2, V3 = "13 100 . A T . . .", "13 200 . C G . . .", "13 300 . G A . . ."
+
+
+@pytest.fixture
+def recorded(log, tmp_path):
+    path = str(tmp_path / "archive.jsonl.gz")
+    archive = ResponseArchive(path, log)
+    archive.record("GET", "/info/software", None, 200, {"release": 110})
+    archive.record("POST", QUERY, {"variants": [V1, V2]}, 200, [vep_response(V1), vep_response(V2)])
+    archive.record("POST", QUERY, {"variants": [V3]}, 200, [vep_response(V3)])
+    archive.close()
+    return path
+
+
+def test_archive_reload(log, recorded):
+    archive = ResponseArchive(recorded, log)
+    assert len(archive) == 3
+    assert archive.respond("GET", "/info/software") == (200, {"release": 110})
+    assert archive.respond("GET", "/info/rest") is None
+
+
+def test_truncated_archive_keeps_complete_lines(log, recorded, tmp_path):
+    with gzip.open(recorded, "rt") as f:
+        lines = f.read().splitlines()
+    path = str(tmp_path / "truncated.jsonl.gz")
+    with gzip.open(path, "wt") as f:
+        f.write("\n".join(lines[:2]) + "\n" + lines[2][:20])
+    assert len(ResponseArchive(path, log)) == 2
+
+
+def test_batches_recomposed_per_variant(log, recorded):
+    archive = ResponseArchive(recorded, log)
+    # Batch mai registrato: le varianti vengono dalle risposte di batch diversi, quelle assenti sono omesse come fa VEP
+    status, body = archive.respond("POST", QUERY, {"variants": [V3, "13 400 . T C . . .", V1]})
+    assert status == 200
+    assert [variant["input"] for variant in body] == [V3, V1]
+    # La query string fa parte della chiave: parametri VEP diversi non vengono serviti
+    assert archive.respond("POST", "/vep/human/region?hgvs=0", {"variants": [V1]}) is None
+    assert archive.respond("POST", QUERY, {"variants": ["13 400 . T C . . ."]}) is None
+
+
+def test_responder_injected_errors(log, recorded):
+    archive = ResponseArchive(recorded, log)
+    assert ReplayResponder(archive, error_rate=1.0).respond("GET", "/info/software") == (503, {"error": "Injected error"}, {})
+    status, _, headers = ReplayResponder(archive, error_rate=1.0, retry_after=0.5).respond("GET", "/info/software")
+    assert (status, headers) == (429, {"Retry-After": "0.5"})
+    responder = ReplayResponder(archive)
+    assert responder.respond("GET", "/info/rest")[0] == 400
+    assert responder.respond("GET", "/info/software") == (200, {"release": 110}, {})
+    assert responder.stats == {"served": 1, "missing": 1, "errors": 0}
+
+
+@pytest.mark.parametrize("retry_after", [None, 0.01])
+def test_requester_recovers_from_injected_errors(log, recorded, retry_after):
+    # 503 con backoff oppure 429 con Retry-After: con lo stesso seed le risposte finali sono quelle registrate
+    responder = ReplayResponder(ResponseArchive(recorded, log), error_rate=0.5, retry_after=retry_after, seed=7)
+    requester = AsyncRequester(log, base_url="http://ensembl.test", transport=ReplayTransport(responder), rate=1000,
+                               backoff=0.001, max_retries=20)
+    results = requester.run([("POST", QUERY, {"variants": [V1]}), ("POST", QUERY, {"variants": [V2, V3]}), ("GET", "/info/software", None)])
+    requester.close()
+    assert results == [[vep_response(V1)], [vep_response(V2), vep_response(V3)], {"release": 110}]
+    assert responder.stats["errors"] > 0 and responder.stats["served"] == 3
+
+
+def test_localhost_server(log, recorded):
+    backend = EnsemblBackend(log, "replay", recorded, serve=True)
+    requester = AsyncRequester(log, base_url=backend.server_url("https://rest.ensembl.org"), transport=backend.transport)
+    try:
+        assert backend.server_url("https://rest.ensembl.org").startswith("http://127.0.0.1:")
+        assert requester.post(QUERY, {"variants": [V2]}) == [vep_response(V2)]
+    finally:
+        requester.close()
+        backend.close()
+
+
+def test_replay_matches_recorded_annotation(log, workdir, archive):
+    # Stessa annotazione della registrazione, senza rete e con batch composti in modo diverso (concorrenza 1, ordine inverso)
+    live = EnsemblAPI(log, backend=RecordingBackend(ResponseArchive(str(workdir / "again.jsonl.gz"), log)))
+    expected = live.get_api_info_from_df(variants_frame(), path_cache=str(workdir / "live.sqlite"), path_csv=None)
+    live.close()
+    api = EnsemblAPI(log, concurrency=1, backend=EnsemblBackend(log, "replay", archive))
+    df = variants_frame().iloc[::-1].reset_index(drop=True)
+    result = api.get_api_info_from_df(df, path_cache=str(workdir / "replay.sqlite"), path_csv=None)
+    api.close()
+    key = list(variants_frame().columns)
+    pd.testing.assert_frame_equal(result.sort_values(key).reset_index(drop=True)[expected.columns],
+                                  expected.sort_values(key).reset_index(drop=True), check_categorical=False)
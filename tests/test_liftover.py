@@ -0,0 +1,79 @@
+import os
+import pandas as pd
+import pytest
+from src.Log import Log
+from src.Liftover import Liftover
+from src.VariantNormalizer import VariantNormalizer
+
+# Blocco di 100 basi di 13 (GRCh37, 0-based [100, 200)) allineato al filamento opposto di 13 (GRCh38, lunghezza 1000):
+# la posizione 1-based p va in 801 - p (101 -> 700, 102 -> 699)
+MINUS_CHAIN = "chain 1000 13 1000 + 100 200 13 1000 - 300 400 1\n100\n\n"
+
+
+@pytest.fixture
+def log():
+    return Log(save_file=False)
+
+
+@pytest.fixture
+def chain(tmp_path):
+    path = tmp_path / "minus.chain"
+    path.write_text(MINUS_CHAIN)
+    return str(path)
+
+
+def lifted_variants(liftover, normalizer, variants):
+    # Stessi passi di EnsemblAPI.__prepare_variants con il solo liftover locale
+    df = pd.DataFrame(variants, columns=["CHROM", "POS", "REF", "ALT", "END"])
+    lifted = liftover.lift(df["CHROM"], df["POS"])
+    grch38 = pd.DataFrame({"CHROM": lifted["CHROM"], "POS": lifted["POS"], "REF": df["REF"], "ALT": df["ALT"],
+                           "END": pd.to_numeric(df["END"]) + (lifted["POS"] - df["POS"])})
+    return normalizer.normalize_lifted(grch38, lifted["STRAND"])
+
+
+def test_minus_strand_positions(log, chain):
+    lifted = Liftover(chain, log).lift(pd.Series(["13", "13"]), pd.Series([101, 102]))
+    assert lifted["POS"].tolist() == [700, 699]
+    assert lifted["STRAND"].tolist() == [-1, -1]
+
+
+def test_minus_strand_variants(log, chain):
+    result = lifted_variants(Liftover(chain, log), VariantNormalizer(log), [
+        ("13", 110, "A", "G", None),        # SNV: 691, complemento
+        ("13", 110, "ACG", "TTA", None),    # MNV: GRCh37 110-112 -> GRCh38 689-691
+        ("13", 110, "ACG", "A", None),      # DEL di CG (111-112) -> 689-690, ancoraggio a destra
+        ("13", 110, "A", "AGT", None),      # INS di GT dopo 110 -> tra 690 e 691, reverse complement AC
+        ("13", 110, "N", "<DEL>", 150),     # SV 110-150 -> 651-691
+    ])
+    assert result["REGION"].tolist() == [
+        "13:691-691:1/C",
+        "13:689-691:1/TAA",
+        "13:689-690:1/-",
+        "13:691-690:1/AC",
+        "13:651-691:1/DEL",
+    ]
+    assert result["VCF_INPUT"].tolist() == [
+        "13 691 . T C . . .",
+        "13 689 . CGT TAA . . .",
+        None,
+        None,
+        "13 651 . N <DEL> . . SVTYPE=DEL;END=691",
+    ]
+
+
+def test_plus_strand_unchanged(log):
+    normalizer = VariantNormalizer(log)
+    df = pd.DataFrame({"CHROM": ["1", "3"], "POS": [182712, 319780], "REF": ["A", "GA"], "ALT": ["C", "G"]})
+    result = normalizer.normalize_lifted(df, pd.Series([1, 1]))
+    assert result.equals(normalizer.normalize(df))
+
+
+def test_cache_path_without_suffix(log, chain, tmp_path):
+    cache_path = str(tmp_path / "parsed")
+    liftover = Liftover(chain, log, cache_path=cache_path)
+    assert liftover.cache_path == cache_path + ".npz"
+    assert os.path.exists(liftover.cache_path)
+    mtime = os.path.getmtime(liftover.cache_path)
+    # Secondo caricamento dalla cache, senza riscriverla
+    assert Liftover(chain, log, cache_path=cache_path).lift(pd.Series(["13"]), pd.Series([101]))["POS"].tolist() == [700]
+    assert os.path.getmtime(liftover.cache_path) == mtime
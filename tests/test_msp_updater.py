@@ -0,0 +1,60 @@
+import pandas as pd
+import pytest
+from src.MSPUpdater import MSPUpdater
+
+NOME, MSP = MSPUpdater.COLONNA_NOME, MSPUpdater.COLONNA_MSP
+
+
+class FrameLoader:
+    # Stand-in di ReferenceLoader: restituisce il foglio GMO già letto dopo normalize
+    def __init__(self, frame:pd.DataFrame) -> None:
+        self.frame = frame
+        self.loads = 0
+
+    def load(self, path, name = "raw", normalize = None, **read_kwargs):
+        self.loads += 1
+        frame = self.frame.copy()
+        return normalize(frame) if normalize is not None else frame
+
+
+@pytest.fixture
+def updater(log):
+    gmo = pd.DataFrame({NOME: [" brca05", "BRCA20", "hc07", "BRCA5", "BRCA7", "HC9"],
+                        MSP: ["MSP1", "MSP2", "MSP3", "MSP9", None, "MSP8"]})
+    return MSPUpdater("gmo.xls", log, loader=FrameLoader(gmo))
+
+
+def test_leading_zero_only(updater):
+    nomi = pd.Series(["BRCA05", "BRCA20", "HC07", "HC0", "BRCA100", "XBRCA05"])
+    assert updater.normalizza_nomi(nomi).tolist() == ["BRCA5", "BRCA20", "HC7", "HC0", "BRCA100", "XBRCA05"]
+
+
+def test_categorical_names_merge_categories(updater):
+    nomi = pd.Series(pd.Categorical(["BRCA05", "BRCA5", None, "BRCA20"]), index=[10, 11, 12, 13], name="NAME")
+    result = updater.normalizza_nomi(nomi)
+    assert isinstance(result.dtype, pd.CategoricalDtype)
+    assert sorted(result.cat.categories) == ["BRCA20", "BRCA5"]
+    assert result.index.tolist() == [10, 11, 12, 13]
+    assert result.tolist()[:2] == ["BRCA5", "BRCA5"] and pd.isna(result.iloc[2]) and result.iloc[3] == "BRCA20"
+
+
+def test_duplicate_gmo_names_first_row_wins(updater):
+    # " brca05" e "BRCA5" diventano lo stesso nome: vale la prima riga del file
+    indice = updater.indice_msp()
+    assert indice["BRCA5"] == "MSP1"
+    assert indice.index.is_unique
+    assert "BRCA7" not in indice
+    updater.indice_msp()
+    assert updater.loader.loads == 1
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_add_msp_non_default_index(updater, categorical):
+    nomi = ["BRCA05", "BRCA20", "HC07", "BRCA7", "BRCA05"]
+    df = pd.DataFrame({"NAME": pd.Categorical(nomi) if categorical else nomi, "POS": range(5)}, index=[50, 40, 30, 20, 10])
+    result = updater.aggiungi_colonna_msp(df)
+    assert result.index.tolist() == [50, 40, 30, 10]
+    assert result["MSP"].tolist() == ["MSP1", "MSP2", "MSP3", "MSP1"]
+    assert result["POS"].tolist() == [0, 1, 2, 4]
+    assert list(map(str, result["NAME"])) == ["BRCA5", "BRCA20", "HC7", "BRCA5"]
+    assert updater.nomi_non_trovati_registrati == {"BRCA7"}
@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+from src.Log import Log
+from src.Pipeline import Pipeline, Stage
+from src.ReferenceLoader import ReferenceLoader
+from src.RisComparator import RisComparator
+
+
+@pytest.fixture
+def log():
+    return Log(save_file=False)
+
+
+@pytest.fixture
+def references(tmp_path):
+    # Database BRCA e HC con MSP numerici, come nei fogli Excel
+    paths = []
+    for name, rows in [("brca", [(1234, "POS", "c.100A>G", 2020), (1235, "NEG", None, 2021)]),
+                       ("hc", [(2001, "POS", "c.5del; p.X", 2019)])]:
+        path = str(tmp_path / f"{name}.xlsx")
+        pd.DataFrame(rows, columns=["MSP", "RIS.", "VARIANTE", "ANNO"]).to_excel(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def msp_stage():
+    # Uscita dello stage msp: codici MSP del file GMO numerici e testuali nella stessa colonna
+    return pd.DataFrame({
+        "NAME": ["BRCA5", "BRCA5", "HC7", "BRCA12"],
+        "MSP": [1234, 1234, 2001, "MSP-55"],
+        "hgvsc": ["ENST1:c.100A>G", "ENST1:c.1A>T", "ENST2:c.5del", "ENST3:c.9C>A"],
+    })
+
+
+def test_mixed_column_round_trip(log, tmp_path):
+    pipeline = Pipeline(log, cache_dir=str(tmp_path / "pipeline")).add(Stage("msp", msp_stage))
+    pipeline.run()
+    reloaded = Pipeline(log, cache_dir=str(tmp_path / "pipeline")).load("msp")
+    pd.testing.assert_frame_equal(reloaded, msp_stage())
+    assert [type(value) for value in reloaded["MSP"]] == [int, int, int, str]
+
+
+def test_ris_from_saved_msp_matches_in_memory_run(log, tmp_path, references):
+    def build():
+        loader = ReferenceLoader(log, cache_dir=str(tmp_path / "reference_cache"))
+        ris = lambda df: RisComparator(*references, log, loader).compare_vcf_xlsx(df)
+        return (Pipeline(log, cache_dir=str(tmp_path / "pipeline"))
+                .add(Stage("msp", msp_stage)).add(Stage("ris", ris, inputs=["msp"])))
+    in_memory = build()
+    in_memory.run()
+    expected = in_memory.load("ris")
+
+    # Solo lo stage ris, con l'uscita di msp riletta dal Parquet
+    cached = build()
+    assert cached.run(start="ris", force=True) == ["ris"]
+    result = cached.load("ris")
+    pd.testing.assert_frame_equal(result, expected)
+    assert result["RIS."].fillna("-").tolist() == ["POS", "NEG", "POS", "-"]
@@ -0,0 +1,33 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from src.Log import Log
+from src.ReferenceLoader import ReferenceLoader
+
+
+@pytest.fixture
+def sheet(tmp_path):
+    # Codici MSP numerici e testuali nella stessa colonna, come nel file GMO
+    path = str(tmp_path / "gmo.xlsx")
+    pd.DataFrame({
+        "NAME": ["BRCA5", "HC7", "BRCA12", "HC3"],
+        "Codice Esterno": [1234, "MSP-55", None, 98.5],
+        "MISTA": [True, "x", datetime.datetime(2020, 1, 2, 3, 4, 5), 7],
+        "ANNO": [2018, 2016, 2020, 2021],
+    }).to_excel(path, index=False)
+    return path
+
+
+def test_cached_load_matches_uncached(sheet, tmp_path):
+    loader = ReferenceLoader(Log(save_file=False), cache_dir=str(tmp_path / "cache"))
+    normalize = lambda df: df[df["ANNO"] > 2017]
+    uncached = loader.load(sheet, "anno2017", normalize)
+    cached = loader.load(sheet, "anno2017", normalize)
+    pd.testing.assert_frame_equal(uncached, cached)
+
+    # Stessi valori e tipi della lettura diretta del foglio
+    expected = normalize(pd.read_excel(sheet)).reset_index(drop=True)
+    pd.testing.assert_frame_equal(cached, expected)
+    assert [type(value) for value in cached["Codice Esterno"]] == [int, float, float]
+    assert np.isnan(cached.loc[1, "Codice Esterno"])
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.ReferenceLoader import ReferenceLoader
+from src.RisComparator import RisComparator
+
+
+@pytest.fixture
+def comparator(log, tmp_path):
+    # Database con MSP numerici (int64 dopo la lettura), il secondo MSP 1234 del file HC viene ignorato
+    paths = []
+    for name, rows in [("brca", [(1234, "POS", "c.100A>G ,\nc.200del", 2020), (1235, "NEG", None, 2021), (1236, "VUS", None, 2022)]),
+                       ("hc", [(1234, "NEG", None, 2020), (2001, "POS", "c.5delAG (p.X)", 2019)])]:
+        path = str(tmp_path / f"{name}.xlsx")
+        pd.DataFrame(rows, columns=["MSP", "RIS.", "VARIANTE", "ANNO"]).to_excel(path, index=False)
+        paths.append(path)
+    return RisComparator(*paths, log, ReferenceLoader(log, cache_dir=str(tmp_path / "cache")))
+
+
+def test_msp_key():
+    keys = RisComparator.msp_key(pd.Series([1234, "1234", 1234.0, " MSP-5 ", np.nan, None], dtype=object))
+    assert keys.iloc[:4].tolist() == ["1234", "1234", "1234", "MSP-5"]
+    assert keys.iloc[4:].isna().all()
+
+
+def test_compare_with_mixed_msp_types(comparator):
+    # MSP del file GMO: numeri e testo nella stessa colonna, indice non di default
+    df = pd.DataFrame({
+        "MSP": [1234, "1234", 1235, 2001.0, "MSP-9", 1236],
+        "hgvsc": ["ENST1:c.200del", "ENST1:c.300A>T", "ENST1:c.100A>G", "ENST2:c.5del", "ENST3:c.1A>G", np.nan],
+    }, index=[10, 11, 12, 13, 14, 15])
+    result = comparator.compare_vcf_xlsx(df)
+    assert result["RIS."].fillna("-").tolist() == ["POS", "NEG", "NEG", "POS", "-", "NEG"]
+    assert comparator.unmatched_msp["MSP"].tolist() == ["MSP-9"]
+    # 1236 (VUS) non ha VARIANTE, nessuna variante riconosciuta
+    assert comparator.unmatched_hgvs["MSP"].tolist() == [1236]
@@ -0,0 +1,52 @@
+import time
+import pandas as pd
+import pytest
+from src.EnsemblAPI import EnsemblAPI
+from src.EnsemblBackend import EnsemblBackend
+from src.Sharding import ShardCoordinator, run_local
+from conftest import variants_frame
+
+
+def single_process(log, workdir, archive):
+    api = EnsemblAPI(log, backend=EnsemblBackend(log, "replay", archive))
+    try:
+        return api.get_api_info_from_df(variants_frame(), path_cache=str(workdir / "single.sqlite"), path_csv=None)
+    finally:
+        api.close()
+
+
+def test_run_local_matches_single_process(log, workdir, archive):
+    expected = single_process(log, workdir, archive)
+    assert expected["hgvsc"].notna().all()
+
+    coordinator = ShardCoordinator(str(workdir / "coord"), log)
+    coordinator.prepare(variants_frame(), 3)
+    assert run_local(str(workdir / "coord"), 2, {"backend": "replay", "archive": archive}) == 3
+    assert coordinator.status()["done"] == 3
+    merged = coordinator.merge(variants_frame())
+    pd.testing.assert_frame_equal(merged, expected)
+    assert len(coordinator.conflicts) == 0
+
+    # Una variante in due shard con annotazioni diverse: vince lo shard con numero più basso
+    first = pd.read_parquet(coordinator.output_path(0))
+    changed = first.head(1).assign(hgvsc="ENST00000380152.8:c.changed")
+    pd.concat([pd.read_parquet(coordinator.output_path(2)), changed]).to_parquet(coordinator.output_path(2), index=False)
+    merged = coordinator.merge(variants_frame())
+    pd.testing.assert_frame_equal(merged, expected)
+    assert coordinator.conflicts[["POS", "SHARD"]].values.tolist() == [[first["POS"].iloc[0], 0], [first["POS"].iloc[0], 2]]
+
+
+def test_expired_claim_is_taken_over(log, tmp_path):
+    coordinator = ShardCoordinator(str(tmp_path / "coord"), log, lease=0.3)
+    coordinator.prepare(variants_frame(), 3)
+    assert coordinator.claim("A") == 0
+    assert coordinator.claim("B") == 1
+    # Claim attivi: lo shard libero va al terzo worker, poi non restano shard
+    assert coordinator.claim("C") == 2
+    assert coordinator.claim("D") is None
+    time.sleep(0.4)
+    coordinator.heartbeat(1)
+    # Il claim di A è scaduto, quello di B è stato rinnovato
+    assert coordinator.claim("E") == 0
+    assert coordinator.claim("F") == 2
+    assert coordinator.claim("G") is None
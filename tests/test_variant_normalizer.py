@@ -0,0 +1,13 @@
+import pandas as pd
+from src.Log import Log
+from src.VariantNormalizer import VariantNormalizer
+
+
+def test_structural_variant_key_includes_end():
+    # Due <DEL> con lo stesso inizio e END diverso sono varianti distinte anche in memoria; END = -1 (assente) non cambia la chiave
+    df = pd.DataFrame({"CHROM": ["13", "13", "13"], "POS": [100, 100, 100], "REF": ["N", "N", "A"],
+                       "ALT": ["<DEL>", "<DEL>", "G"], "END": [200, 300, -1]})
+    result = VariantNormalizer(Log(save_file=False)).normalize(df)
+    assert result["KEY"].tolist() == ["13 100 . N <DEL> . . END=200", "13 100 . N <DEL> . . END=300", "13 100 . A G . . ."]
+    assert result["REGION"].tolist() == ["13:100-200:1/DEL", "13:100-300:1/DEL", "13:100-100:1/G"]
+    assert VariantNormalizer.key_columns(df) == ["CHROM", "POS", "REF", "ALT", "END"]
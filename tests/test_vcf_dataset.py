@@ -0,0 +1,35 @@
+import os
+import pandas as pd
+from src.VCFProcessor import VCFProcessor
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=13>
+##INFO=<ID=AF,Number=A,Type=Float,Description="AF">
+##INFO=<ID=END,Number=1,Type=Integer,Description="END">
+##INFO=<ID=GENEINFO,Number=1,Type=String,Description="GENEINFO">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{sample}
+"""
+
+
+def write_vcf(path, sample, positions):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(HEADER.format(sample=sample) + "".join(f"13\t{pos}\t.\tA\tT\t.\tPASS\tAF=0.5;END={pos};GENEINFO=BRCA2:675\tGT\t0/1\n" for pos in positions))
+
+
+def test_load_dataset_matches_get_dataframe(log, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_vcf(str(tmp_path / "VCF" / "GERMLINE" / "BRCA12_run1.vcf"), "BRCA-12-22_S1", [32890000, 32890010])
+    write_vcf(str(tmp_path / "VCF" / "GERMLINE" / "HC07_run1.vcf"), "HC-07-22_S1", [32890020])
+    write_vcf(str(tmp_path / "VCF" / "SOMATIC" / "BRCA13_run1.vcf"), "BRCA-13-22_S1", [32890030, 32890040, 32890050])
+    expected = VCFProcessor(log).get_dataframe("VCF", workers=1)
+    assert VCFProcessor(log).write_dataset(str(tmp_path / "dataset"), path="VCF", workers=1, batch_size=2) == expected.shape[0]
+
+    result = VCFProcessor.load_dataset(str(tmp_path / "dataset"))
+    # Partizione CTYPE al suo posto e non in fondo
+    assert list(result.columns) == list(expected.columns)
+    key = ["NAME", "POS"]
+    sort = lambda df: df.sort_values(key).reset_index(drop=True).astype({c: str for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+    pd.testing.assert_frame_equal(sort(result), sort(expected))
+    assert list(VCFProcessor.load_dataset(str(tmp_path / "dataset"), columns=["CTYPE", "POS"]).columns) == ["CTYPE", "POS"]
@@ -0,0 +1,43 @@
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+from src.VCFReader import VCFReader
+
+pysam = pytest.importorskip("pysam")
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=13>
+##INFO=<ID=AF,Number=A,Type=Float,Description="AF">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="GT">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1
+"""
+RECORDS = [
+    (90, "ACGTACGTACGTA", "A"),      # delezione che inizia prima della prima regione e la sovrappone
+    (100, "A", "G"),
+    (150, "A" + "C" * 60, "A"),      # delezione nella prima regione che arriva nella seconda
+    (195, "C", "T"),                 # tra le due regioni
+    (200, "G", "A"),
+    (260, "T", "C"),                 # dopo l'ultima regione
+]
+# Regioni fuse come GeneIndex.intervals: 100-150 e 200-250, estremi inclusi
+REGIONS = {"13": (np.array([100, 200]), np.array([150, 250]))}
+
+
+@pytest.fixture
+def vcf_files(tmp_path):
+    plain = str(tmp_path / "A_B_C_D_E_F_G_H.vcf")
+    with open(plain, "w") as f:
+        f.write(HEADER + "".join(f"13\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\tAF=0.5\tGT\t0/1\n" for pos, ref, alt in RECORDS))
+    indexed = pysam.tabix_index(shutil.copy(plain, str(tmp_path / "I_B_C_D_E_F_G_H.vcf")), preset="vcf", force=True)
+    return plain, indexed
+
+
+def test_tabix_regions_match_plain_read(vcf_files):
+    plain, indexed = vcf_files
+    assert VCFReader.has_index(indexed)
+    reader = VCFReader(["CHROM", "POS", "REF", "ALT", "GT"], regions=REGIONS)
+    _, expected = reader.read(plain)
+    _, result = reader.read(indexed)
+    assert expected["POS"].tolist() == [100, 150, 200]
+    pd.testing.assert_frame_equal(result, expected)